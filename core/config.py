@@ -0,0 +1,28 @@
+# core/config.py
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+MB = 1024 * 1024
+
+
+def _mb(name: str, default: int) -> int:
+    return int(os.getenv(name, default)) * MB
+
+
+# حقول النموذج وحدود multipart فوق حجم الملفات
+FORM_OVERHEAD = _mb("UPLOAD_FORM_OVERHEAD_MB", 1)
+
+# مسارات الرفع (POST) -> أقصى حجم لجسم الطلب كاملاً (المسار المنتهي بـ / يشمل ما بعده)
+UPLOAD_ROUTE_LIMITS = {
+    "/library/add": _mb("UPLOAD_LIMIT_LIBRARY_MB", 45) + FORM_OVERHEAD,   # الكتاب + صورة غلاف يدوية
+    "/gallery/add": _mb("UPLOAD_LIMIT_GALLERY_MB", 5) + FORM_OVERHEAD,
+    "/articles/add": _mb("UPLOAD_LIMIT_ARTICLES_MB", 5) + FORM_OVERHEAD,
+    "/articles/edit/": _mb("UPLOAD_LIMIT_ARTICLES_MB", 5) + FORM_OVERHEAD,
+    "/news/add": _mb("UPLOAD_LIMIT_NEWS_MB", 40) + FORM_OVERHEAD,
+    "/news/edit/": _mb("UPLOAD_LIMIT_NEWS_MB", 40) + FORM_OVERHEAD,
+    "/family/add": _mb("UPLOAD_LIMIT_FAMILY_MB", 5) + FORM_OVERHEAD,
+    "/family/edit/": _mb("UPLOAD_LIMIT_FAMILY_MB", 5) + FORM_OVERHEAD,
+}
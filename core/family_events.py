@@ -0,0 +1,35 @@
+# core/family_events.py
+import logging
+import threading
+from typing import Callable, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# المشترك يستلم (الأعضاء المتغيرون، الأعضاء المحذوفون، تغيير جماعي؟)
+FamilyListener = Callable[[List[str], List[str], bool], None]
+
+
+class FamilyEvents:
+    """
+    إشارة "تغيّر أعضاء العائلة": الفهارس المحفوظة في الذاكرة والمهام المشتقة من الشجرة تشترك فيها
+    عند بدء التشغيل، وFamilyService تنشر التغيير دون أن تعرف من يستمع.
+    المشتركون يُستدعون بترتيب اشتراكهم، وفشل أحدهم يُسجل ولا يمنع البقية.
+    """
+    _lock = threading.Lock()
+    _listeners: List[Tuple[str, FamilyListener]] = []
+
+    @classmethod
+    def subscribe(cls, name: str, listener: FamilyListener) -> None:
+        with cls._lock:
+            if all(existing != listener for _, existing in cls._listeners):
+                cls._listeners.append((name, listener))
+
+    @classmethod
+    def publish(cls, codes: List[str], removed: List[str], bulk: bool = False) -> None:
+        with cls._lock:
+            listeners = list(cls._listeners)
+        for name, listener in listeners:
+            try:
+                listener(codes, removed, bulk)
+            except Exception as e:
+                logger.warning(f"⚠️ تعذر تحديث {name} بعد تغيّر أعضاء العائلة: {e}")
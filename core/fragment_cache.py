@@ -0,0 +1,46 @@
+# core/fragment_cache.py
+import threading
+from typing import Any, Dict, Hashable, Iterable, Optional
+
+from cachetools import TTLCache
+
+
+class FragmentCache:
+    """
+    ذاكرة مؤقتة لأجزاء HTML المعروضة مسبقاً (مثل لوحة بيانات العضو وعلاقاته).
+    المفتاح يتضمن رقم جيل لكل عضو يُزاد عند الإبطال، فتصبح النسخ القديمة غير قابلة للوصول
+    وتخرج من الذاكرة تلقائياً مع سياسة LRU/TTL دون الحاجة لتتبع كل مفتاح.
+    """
+    MAX_ENTRIES = 2000
+    TTL_SECONDS = 6 * 3600
+
+    _lock = threading.Lock()
+    _cache: TTLCache = TTLCache(maxsize=MAX_ENTRIES, ttl=TTL_SECONDS)
+    _generations: Dict[str, int] = {}
+
+    @classmethod
+    def generation(cls, owner: str) -> int:
+        with cls._lock:
+            return cls._generations.get(owner, 0)
+
+    @classmethod
+    def get(cls, key: Hashable) -> Optional[Any]:
+        with cls._lock:
+            return cls._cache.get(key)
+
+    @classmethod
+    def set(cls, key: Hashable, value: Any) -> None:
+        with cls._lock:
+            cls._cache[key] = value
+
+    @classmethod
+    def invalidate(cls, owners: Iterable[str]) -> None:
+        with cls._lock:
+            for owner in owners:
+                if owner:
+                    cls._generations[owner] = cls._generations.get(owner, 0) + 1
+
+    @classmethod
+    def clear(cls) -> None:
+        with cls._lock:
+            cls._cache.clear()
@@ -23,6 +23,7 @@ from security.rate_limit import RateLimitService
 from services.analytics_service import AnalyticsService
 from services.google_service import GoogleService
 from services.home_service import HomeService
+from services.upload_service import UploadLimitMiddleware
 from routers import auth, admin, family, articles, news, permissions, data, profile, gallery, video, library, about
 from dotenv import load_dotenv
 
@@ -60,11 +61,33 @@ async def lifespan(app: FastAPI):
     
     # 1. تهيئة قاعدة البيانات
     init_database()
+
+    # 2. 📣 اشتراك فهارس الذاكرة والمهام المشتقة في إشارة تغيّر أعضاء العائلة (بترتيب الاستدعاء:
+    #    تخطيط الشجرة يُبطل مسار الأصول القديم قبل تحديث جدول القرابة ثم المسار الجديد بعده)
+    from core.family_events import FamilyEvents
+    from core.fragment_cache import FragmentCache
+    from services.name_index_service import NameIndexService
+    from services.kinship_service import KinshipService
+    from services.tree_layout_service import TreeLayoutService
+    from services.page_index_service import PageIndexService
+    from services.graph_snapshot_service import GraphSnapshotService
+    from services.demographics_service import DemographicsService
+    from services.search_refresh_service import SearchRefreshService
+    FamilyEvents.subscribe("فهرس الأسماء", NameIndexService.on_family_changed)
+    FamilyEvents.subscribe("تخطيط الشجرة", TreeLayoutService.on_family_changing)
+    FamilyEvents.subscribe("جدول القرابة", KinshipService.on_family_changed)
+    FamilyEvents.subscribe("تخطيط الشجرة", TreeLayoutService.on_family_changed)
+    # إبطال فوري للوحات التفاصيل في هذا العامل؛ بقية الـ workers يكتشفون التغيير من نسخة العضو في قاعدة البيانات
+    FamilyEvents.subscribe("لوحات التفاصيل", lambda codes, removed, bulk: FragmentCache.invalidate(codes + removed))
+    FamilyEvents.subscribe("فهرس الصفحات", lambda codes, removed, bulk: PageIndexService.invalidate())
+    FamilyEvents.subscribe("لقطة الشجرة", lambda codes, removed, bulk: GraphSnapshotService.schedule_rebuild())
+    FamilyEvents.subscribe("الإحصاءات السكانية", lambda codes, removed, bulk: DemographicsService.schedule_refresh())
+    FamilyEvents.subscribe("أسماء النسب", lambda codes, removed, bulk: SearchRefreshService.schedule())
     
-    # 2. تهيئة مقيد المعدل لمنع هجمات DOS
+    # 3. تهيئة مقيد المعدل لمنع هجمات DOS
     RateLimitService.initialize_rate_limiter()
     
-    # 3. 🧹 تنظيف سجلات المكتبة العالقة لتوفير المساحة السحابية
+    # 4. 🧹 تنظيف سجلات المكتبة العالقة لتوفير المساحة السحابية
     try:
         from services.library_service import LibraryService
         cleaned_count = LibraryService.cleanup_stuck_uploads()
@@ -73,8 +96,45 @@ async def lifespan(app: FastAPI):
     except Exception as e:
         logger.error(f"⚠️ تفادي فشل أثناء التنظيف التلقائي: {e}")
 
+    # 5. 🖼️ استكمال رفع صور الأعضاء التي لم تكتمل قبل إعادة التشغيل
+    try:
+        from services.family_service import FamilyService
+        resumed_count = FamilyService.resume_pending_pictures()
+        if resumed_count > 0:
+            logger.info(f"🖼️ جاري استكمال رفع {resumed_count} صور أعضاء معلقة.")
+    except Exception as e:
+        logger.error(f"⚠️ تفادي فشل أثناء استكمال رفع الصور: {e}")
+
+    # 6. 🔁 معالجة ما تبقى في طابور تحديث أسماء النسب
+    try:
+        from services.search_refresh_service import SearchRefreshService
+        SearchRefreshService.schedule()
+    except Exception as e:
+        logger.error(f"⚠️ تفادي فشل أثناء جدولة تحديث أسماء النسب: {e}")
+
+    # 7. 🗺️ ربط لقطة الشجرة المشتركة بين الـ workers (أو جدولة بنائها لأول مرة)
+    try:
+        from services.graph_snapshot_service import GraphSnapshotService
+        GraphSnapshotService.ensure_available()
+    except Exception as e:
+        logger.error(f"⚠️ تفادي فشل أثناء ربط لقطة الشجرة: {e}")
+
+    # 8. 📚 استكمال معالجة كتب المكتبة التي بقيت في الطابور قبل إعادة التشغيل
+    try:
+        from services.library_job_service import LibraryJobService
+        resumed_books = LibraryJobService.resume_pending_jobs()
+        if resumed_books > 0:
+            logger.info(f"📚 جاري استكمال معالجة {resumed_books} كتب معلقة.")
+    except Exception as e:
+        logger.error(f"⚠️ تفادي فشل أثناء استكمال معالجة الكتب: {e}")
+
     yield
     logger.info("🛑 جاري إغلاق السيرفر بسلام...")
+    try:
+        from services.pdf_render_service import PdfRenderService
+        PdfRenderService.shutdown()
+    except Exception:
+        pass
 
 # =========================================
 # إنشاء التطبيق
@@ -112,6 +172,7 @@ async def analytics_middleware(request: Request, call_next):
 
 # 🚨 الترتيب الذهبي لحقن الـ Middlewares في FastAPI (من الأسفل للأعلى في التنفيذ للـ Request)
 app.add_middleware(BaseHTTPMiddleware, dispatch=analytics_middleware)
+app.add_middleware(UploadLimitMiddleware)
 
 app.add_middleware(
     SessionMiddleware,
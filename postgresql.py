@@ -9,6 +9,20 @@ load_dotenv()
 # 🔒 تحديد ما إذا كانت البيئة هي إنتاج (على Render) أم محلي للتطوير
 IS_PROD = os.getenv("RENDER_EXTERNAL_URL") is not None or os.getenv("ENVIRONMENT") == "production"
 
+# 🔁 الجداول المتتبعة للتصدير التزايدي (الجدول، مفتاح الصف): updated_at لكل صف + شواهد الحذف
+SYNC_TABLES = (
+    ("family_name", "code"),
+    ("family_info", "code_info"),
+    ("family_age_search", "code"),
+    ("family_picture", "code_pic"),
+    ("family_search", "code"),
+    ("articles", "id"),
+    ("news", "id"),
+    ("gallery", "id"),
+    ("videos", "id"),
+    ("library", "id"),
+)
+
 @contextmanager
 def get_db_context():
     conn = None
@@ -111,6 +125,18 @@ def init_database():
             cur.execute("ALTER TABLE library ADD COLUMN IF NOT EXISTS downloads_count INTEGER DEFAULT 0;")
             cur.execute("ALTER TABLE library ADD COLUMN IF NOT EXISTS allow_download BOOLEAN DEFAULT TRUE;")
             cur.execute("CREATE INDEX IF NOT EXISTS idx_library_category ON library(category);")
+            # حالة طابور المعالجة في الخلفية: queued → processing → ready / error
+            cur.execute("ALTER TABLE library ADD COLUMN IF NOT EXISTS processing_status VARCHAR(20) DEFAULT 'ready';")
+            cur.execute("ALTER TABLE library ADD COLUMN IF NOT EXISTS processing_error TEXT;")
+            cur.execute("ALTER TABLE library ADD COLUMN IF NOT EXISTS processing_started_at TIMESTAMP;")
+            cur.execute("ALTER TABLE library ADD COLUMN IF NOT EXISTS processing_heartbeat_at TIMESTAMP;")
+            cur.execute("ALTER TABLE library ADD COLUMN IF NOT EXISTS page_count INTEGER;")
+            cur.execute("ALTER TABLE library ADD COLUMN IF NOT EXISTS preview_urls TEXT[];")
+            cur.execute("ALTER TABLE library ADD COLUMN IF NOT EXISTS content_sha256 CHAR(64);")
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS idx_library_processing ON library(processing_status)
+                WHERE processing_status IN ('queued', 'processing');
+            """)
             
             # =======================================================
             # 🔒 حماية بيانات العائلة: يتم إنشاؤها في السيرفر المحلي فقط
@@ -150,14 +176,67 @@ def init_database():
                     END $$;
                 """)
 
+                # مفتاح الترتيب المخزن: يُحسب مرة عند الكتابة بدل حساب normalize_arabic لكل صف مع كل عرض
+                cur.execute("""
+                    DO $$
+                    BEGIN
+                        IF NOT EXISTS (SELECT 1 FROM information_schema.columns
+                                       WHERE table_name='family_search' AND column_name='sort_key') THEN
+                            ALTER TABLE family_search
+                            ADD COLUMN sort_key TEXT
+                            GENERATED ALWAYS AS (public.normalize_arabic(full_name)) STORED;
+                        END IF;
+                    END $$;
+                """)
+                # فهرس الترقيم بالمفاتيح (Keyset): (sort_key, code) ترتيب كامل وفريد للقائمة
+                cur.execute("CREATE INDEX IF NOT EXISTS idx_family_search_sort ON family_search(sort_key, code) WHERE level >= 0;")
+
+                # عدد الذرية المحفوظ لكل عضو (الإجمالي، الأحياء، لكل جيل) يُحدّث تزايدياً على مسار الأصول
+                cur.execute("""
+                    ALTER TABLE family_search
+                        ADD COLUMN IF NOT EXISTS descendants_total INT NOT NULL DEFAULT 0,
+                        ADD COLUMN IF NOT EXISTS descendants_living INT NOT NULL DEFAULT 0,
+                        ADD COLUMN IF NOT EXISTS descendants_by_generation JSONB NOT NULL DEFAULT '{}'::jsonb;
+                """)
+                # وقت حفظ آخر صورة مربوطة (نانوثانية): صورة أقدم لا تتغلب على أحدث مهما كان الـ worker الذي يرفعها
+                cur.execute("ALTER TABLE family_picture ADD COLUMN IF NOT EXISTS staged_at BIGINT;")
+
+                # جمع عدادات الأجيال {"1": 3, "2": 7} مع دلتا موجبة أو سالبة وحذف المفاتيح الصفرية
+                cur.execute('''
+                    CREATE OR REPLACE FUNCTION public.add_generation_counts(base jsonb, delta jsonb, sign int)
+                    RETURNS jsonb AS $$
+                    SELECT COALESCE(jsonb_object_agg(k, v), '{}'::jsonb) FROM (
+                        SELECT k, SUM(v)::int AS v FROM (
+                            SELECT key AS k, value::int AS v FROM jsonb_each_text(COALESCE(base, '{}'::jsonb))
+                            UNION ALL
+                            SELECT key, sign * value::int FROM jsonb_each_text(COALESCE(delta, '{}'::jsonb))
+                        ) parts
+                        GROUP BY k
+                        HAVING SUM(v) <> 0
+                    ) merged
+                    $$ LANGUAGE SQL IMMUTABLE;
+                ''')
+
                 # فهارس البحث
+                cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
                 cur.execute("CREATE INDEX IF NOT EXISTS idx_family_search_gin ON family_search USING GIN (to_tsvector('arabic', search_text));")
                 cur.execute("CREATE INDEX IF NOT EXISTS idx_family_search_name ON family_search(full_name);")
+                # فهرس المقاطع الثلاثية لمطابقة أجزاء الأسماء (ILIKE '%...%') دون مسح تسلسلي
+                cur.execute("CREATE INDEX IF NOT EXISTS idx_family_search_trgm ON family_search USING GIN (search_text gin_trgm_ops);")
+                cur.execute("CREATE INDEX IF NOT EXISTS idx_family_search_code_trgm ON family_search USING GIN (code gin_trgm_ops);")
+
+                # فهارس روابط القرابة (الأبناء والأزواج) للتوسيع الكسول للشجرة
+                for column in ("f_code", "m_code", "w_code", "h_code"):
+                    cur.execute(f"CREATE INDEX IF NOT EXISTS idx_family_name_{column} ON family_name({column});")
 
                 # دالة الـ Trigger لتحديث البحث
                 cur.execute('''
                     CREATE OR REPLACE FUNCTION refresh_family_search() RETURNS trigger AS $$
                     BEGIN
+                        -- الاستيراد الجماعي يعطّل التحديث صفاً بصف ويعيد البناء مرة واحدة في النهاية
+                        IF current_setting('hottiyya.bulk_import', true) = 'on' THEN
+                            RETURN NEW;
+                        END IF;
                         INSERT INTO family_search (code, full_name, nick_name, level)
                         VALUES (
                             NEW.code,
@@ -184,10 +263,346 @@ def init_database():
                         FOR EACH ROW
                         EXECUTE FUNCTION refresh_family_search();
                 ''')
+
+                # جيل القائمة الكاملة وعدد أعضائها: صف واحد يرفعه Trigger على مستوى العبارة فقط حين يتغير
+                # ما يحدد مواقع الصفحات (code, sort_key, level)، فيتحقق كل worker من فهرس صفحاته بقراءة صف واحد
+                cur.execute('''
+                    CREATE TABLE IF NOT EXISTS family_list_state (
+                        id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+                        generation BIGINT NOT NULL DEFAULT 0,
+                        members INT NOT NULL DEFAULT 0
+                    )
+                ''')
+                cur.execute('''
+                    INSERT INTO family_list_state (id, members)
+                    SELECT TRUE, COUNT(*) FROM family_search WHERE level >= 0
+                    ON CONFLICT (id) DO UPDATE
+                        SET members = EXCLUDED.members, generation = family_list_state.generation + 1;
+                ''')
+                cur.execute('''
+                    CREATE OR REPLACE FUNCTION bump_family_list_generation() RETURNS trigger AS $$
+                    DECLARE
+                        v_delta INT := 0;
+                        v_changed BOOLEAN := FALSE;
+                    BEGIN
+                        IF TG_OP = 'INSERT' THEN
+                            SELECT COUNT(*) INTO v_delta FROM new_rows WHERE level >= 0;
+                            v_changed := v_delta <> 0;
+                        ELSIF TG_OP = 'DELETE' THEN
+                            SELECT -COUNT(*) INTO v_delta FROM old_rows WHERE level >= 0;
+                            v_changed := v_delta <> 0;
+                        ELSE
+                            -- تحديث أعداد الذرية أو updated_at لا يغيّر ترتيب القائمة فلا يرفع الجيل
+                            SELECT (SELECT COUNT(*) FROM new_rows WHERE level >= 0)
+                                 - (SELECT COUNT(*) FROM old_rows WHERE level >= 0) INTO v_delta;
+                            v_changed := v_delta <> 0
+                                OR EXISTS (SELECT code, sort_key FROM new_rows WHERE level >= 0
+                                           EXCEPT ALL SELECT code, sort_key FROM old_rows WHERE level >= 0)
+                                OR EXISTS (SELECT code, sort_key FROM old_rows WHERE level >= 0
+                                           EXCEPT ALL SELECT code, sort_key FROM new_rows WHERE level >= 0);
+                        END IF;
+                        IF v_changed THEN
+                            UPDATE family_list_state SET generation = generation + 1, members = members + v_delta;
+                        END IF;
+                        RETURN NULL;
+                    END;
+                    $$ LANGUAGE plpgsql;
+                ''')
+                cur.execute('''
+                    DROP TRIGGER IF EXISTS trig_family_list_insert ON family_search;
+                    CREATE TRIGGER trig_family_list_insert
+                        AFTER INSERT ON family_search
+                        REFERENCING NEW TABLE AS new_rows
+                        FOR EACH STATEMENT
+                        EXECUTE FUNCTION bump_family_list_generation();
+                    DROP TRIGGER IF EXISTS trig_family_list_update ON family_search;
+                    CREATE TRIGGER trig_family_list_update
+                        AFTER UPDATE ON family_search
+                        REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+                        FOR EACH STATEMENT
+                        EXECUTE FUNCTION bump_family_list_generation();
+                    DROP TRIGGER IF EXISTS trig_family_list_delete ON family_search;
+                    CREATE TRIGGER trig_family_list_delete
+                        AFTER DELETE ON family_search
+                        REFERENCING OLD TABLE AS old_rows
+                        FOR EACH STATEMENT
+                        EXECUTE FUNCTION bump_family_list_generation();
+                ''')
+
+                # نسخة لوحة تفاصيل كل عضو: صف واحد لكل كود يرفعه Trigger على مستوى العبارة عند تغيّر بيانات العضو
+                # أو بيانات من تعرض لوحته اسمه (الوالدان، الأزواج، الأبناء، والطرف الآخر في الأبناء).
+                # لا تُحذف صفوفها مع حذف العضو: كود أعيد استخدامه يكمل من نسخة أعلى فلا يطابق لوحة قديمة
+                cur.execute('''
+                    CREATE TABLE IF NOT EXISTS family_member_versions (
+                        code TEXT PRIMARY KEY,
+                        version BIGINT NOT NULL DEFAULT 0
+                    )
+                ''')
+                cur.execute('''
+                    CREATE OR REPLACE FUNCTION bump_family_member_versions() RETURNS trigger AS $$
+                    DECLARE
+                        v_rows JSONB := '[]';
+                        v_members TEXT[];
+                        v_codes TEXT[];
+                    BEGIN
+                        -- مرة لكل عبارة لا لكل صف، فيبقى مفعّلاً أثناء الاستيراد الجماعي (hottiyya.bulk_import)
+                        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                            SELECT v_rows || COALESCE(jsonb_agg(to_jsonb(r)), '[]') INTO v_rows FROM new_rows r;
+                        END IF;
+                        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                            SELECT v_rows || COALESCE(jsonb_agg(to_jsonb(r)), '[]') INTO v_rows FROM old_rows r;
+                        END IF;
+                        SELECT array_agg(DISTINCT j ->> TG_ARGV[0]) INTO v_members FROM jsonb_array_elements(v_rows) j;
+                        v_codes := v_members;
+
+                        -- الاسم والنسب يظهران في لوحات الأقارب؛ الروابط القديمة (old_rows) تشمل من انفصل عن العضو
+                        IF TG_ARGV[1] = 'relatives' THEN
+                            SELECT array_agg(DISTINCT c) INTO v_codes FROM (
+                                SELECT unnest(v_members) AS c
+                                UNION SELECT unnest(ARRAY[j ->> 'f_code', j ->> 'm_code', j ->> 'w_code', j ->> 'h_code'])
+                                      FROM jsonb_array_elements(v_rows) j
+                                UNION SELECT unnest(ARRAY[n.f_code, n.m_code, n.w_code, n.h_code])
+                                      FROM family_name n WHERE n.code = ANY(v_members)
+                                UNION SELECT n.code FROM family_name n
+                                      WHERE n.f_code = ANY(v_members) OR n.m_code = ANY(v_members)
+                                         OR n.w_code = ANY(v_members) OR n.h_code = ANY(v_members)
+                                UNION SELECT n.m_code FROM family_name n WHERE n.f_code = ANY(v_members)
+                                UNION SELECT n.f_code FROM family_name n WHERE n.m_code = ANY(v_members)
+                            ) t
+                            WHERE c IS NOT NULL;
+                        END IF;
+
+                        INSERT INTO family_member_versions (code, version)
+                        SELECT c, 1 FROM unnest(v_codes) AS c WHERE c IS NOT NULL ORDER BY c
+                        ON CONFLICT (code) DO UPDATE SET version = family_member_versions.version + 1;
+                        RETURN NULL;
+                    END;
+                    $$ LANGUAGE plpgsql;
+                ''')
+                member_version_sources = (
+                    ("family_name", "code", "relatives"),
+                    ("family_search", "code", "relatives"),
+                    ("family_info", "code_info", "self"),
+                    ("family_age_search", "code", "self"),
+                    ("family_picture", "code_pic", "self"),
+                )
+                for table, key, scope in member_version_sources:
+                    cur.execute(f'''
+                        DROP TRIGGER IF EXISTS trig_member_versions_insert ON {table};
+                        CREATE TRIGGER trig_member_versions_insert
+                            AFTER INSERT ON {table}
+                            REFERENCING NEW TABLE AS new_rows
+                            FOR EACH STATEMENT
+                            EXECUTE FUNCTION bump_family_member_versions('{key}', '{scope}');
+                        DROP TRIGGER IF EXISTS trig_member_versions_update ON {table};
+                        CREATE TRIGGER trig_member_versions_update
+                            AFTER UPDATE ON {table}
+                            REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+                            FOR EACH STATEMENT
+                            EXECUTE FUNCTION bump_family_member_versions('{key}', '{scope}');
+                        DROP TRIGGER IF EXISTS trig_member_versions_delete ON {table};
+                        CREATE TRIGGER trig_member_versions_delete
+                            AFTER DELETE ON {table}
+                            REFERENCING OLD TABLE AS old_rows
+                            FOR EACH STATEMENT
+                            EXECUTE FUNCTION bump_family_member_versions('{key}', '{scope}');
+                    ''')
+                # طابور تحديث أسماء النسب للأحفاد عند تغيّر اسم الجد أو أبويه (يُعالج في الخلفية بدون تكرار)
+                cur.execute('''
+                    CREATE TABLE IF NOT EXISTS family_search_refresh_queue (
+                        code TEXT PRIMARY KEY,
+                        queued_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+                    )
+                ''')
+                # وقت حجز العضو للمعالجة: لا يُحذف من الطابور إلا بعد نجاح تحديث فرعه
+                cur.execute("ALTER TABLE family_search_refresh_queue ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMPTZ;")
+                cur.execute('''
+                    CREATE OR REPLACE FUNCTION enqueue_family_search_cascade() RETURNS trigger AS $$
+                    BEGIN
+                        -- الاستيراد الجماعي يعطّل التحديث صفاً بصف ويعيد البناء مرة واحدة في النهاية
+                        IF current_setting('hottiyya.bulk_import', true) = 'on' THEN
+                            RETURN NEW;
+                        END IF;
+                        -- عضو محجوز قيد المعالجة وتغيّر مجدداً: إعادته للطابور بوقت جديد حتى يُعالج مرة أخرى
+                        INSERT INTO family_search_refresh_queue (code)
+                        VALUES (NEW.code)
+                        ON CONFLICT (code) DO UPDATE SET queued_at = NOW(), claimed_at = NULL
+                            WHERE family_search_refresh_queue.claimed_at IS NOT NULL;
+                        RETURN NEW;
+                    END;
+                    $$ LANGUAGE plpgsql;
+                ''')
+                cur.execute('''
+                    DROP TRIGGER IF EXISTS trig_enqueue_search_cascade ON family_name;
+                    CREATE TRIGGER trig_enqueue_search_cascade
+                        AFTER UPDATE OF name, f_code, m_code
+                        ON family_name
+                        FOR EACH ROW
+                        WHEN (OLD.name IS DISTINCT FROM NEW.name
+                              OR OLD.f_code IS DISTINCT FROM NEW.f_code
+                              OR OLD.m_code IS DISTINCT FROM NEW.m_code)
+                        EXECUTE FUNCTION enqueue_family_search_cascade();
+                ''')
+
+                # عدادات الأكواد لكل بادئة (حجز الكود التالي بعملية ذرية واحدة بدل مسح الفرع كاملاً)
+                cur.execute('''
+                    CREATE TABLE IF NOT EXISTS family_code_counters (
+                        prefix TEXT PRIMARY KEY,
+                        last_value INT NOT NULL DEFAULT 0
+                    )
+                ''')
+
+                # تعبئة العدادات من الأكواد الموجودة (آمنة للتكرار مع كل تشغيل)
+                cur.execute(r'''
+                    INSERT INTO family_code_counters (prefix, last_value)
+                    SELECT substring(code from '^(.*-)\d+$'), MAX(substring(code from '(\d+)$')::int)
+                    FROM family_name
+                    WHERE code ~ '^.*-\d+$'
+                    GROUP BY 1
+                    ON CONFLICT (prefix) DO UPDATE
+                        SET last_value = GREATEST(family_code_counters.last_value, EXCLUDED.last_value);
+                ''')
+
+                # رفع العداد تلقائياً عند إدخال كود يدوياً حتى لا يُقترح مرة أخرى
+                cur.execute(r'''
+                    CREATE OR REPLACE FUNCTION bump_family_code_counter() RETURNS trigger AS $$
+                    DECLARE
+                        v_prefix TEXT;
+                    BEGIN
+                        -- الاستيراد الجماعي يرفع العدادات بعبارة واحدة في النهاية
+                        IF current_setting('hottiyya.bulk_import', true) = 'on' THEN
+                            RETURN NEW;
+                        END IF;
+                        v_prefix := substring(NEW.code from '^(.*-)\d+$');
+                        IF v_prefix IS NOT NULL THEN
+                            INSERT INTO family_code_counters (prefix, last_value)
+                            VALUES (v_prefix, substring(NEW.code from '(\d+)$')::int)
+                            ON CONFLICT (prefix) DO UPDATE
+                                SET last_value = GREATEST(family_code_counters.last_value, EXCLUDED.last_value);
+                        END IF;
+                        RETURN NEW;
+                    END;
+                    $$ LANGUAGE plpgsql;
+                ''')
+                cur.execute('''
+                    DROP TRIGGER IF EXISTS trig_bump_code_counter ON family_name;
+                    CREATE TRIGGER trig_bump_code_counter
+                        AFTER INSERT OR UPDATE OF code
+                        ON family_name
+                        FOR EACH ROW
+                        EXECUTE FUNCTION bump_family_code_counter();
+                ''')
+                # أزواج الأعضاء المكررين المحتملين لمراجعة الإدارة (code_a < code_b لمنع تكرار الزوج معكوساً)
+                cur.execute('''
+                    CREATE TABLE IF NOT EXISTS family_duplicate_candidates (
+                        code_a TEXT NOT NULL,
+                        code_b TEXT NOT NULL,
+                        score REAL NOT NULL,
+                        reasons TEXT,
+                        status TEXT NOT NULL DEFAULT 'pending',
+                        detected_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                        PRIMARY KEY (code_a, code_b),
+                        CHECK (code_a < code_b)
+                    )
+                ''')
+                cur.execute("CREATE INDEX IF NOT EXISTS idx_family_duplicates_code_b ON family_duplicate_candidates(code_b);")
+
+                # 📊 الإحصائيات السكانية للعائلة: عرض مادي مجمّع يُحدّث بـ CONCURRENTLY دون حجب القراءة
+                cur.execute(r'''
+                    CREATE MATERIALIZED VIEW IF NOT EXISTS family_demographics AS
+                    SELECT
+                        COALESCE(n.level, 0) AS level,
+                        COALESCE(NULLIF(i.gender, ''),
+                            CASE
+                                WHEN n.relation IN ('ابن', 'زوج', 'ابن زوج', 'ابن زوجة') THEN 'ذكر'
+                                WHEN n.relation IN ('ابنة', 'زوجة', 'ابنة زوج', 'ابنة زوجة') THEN 'أنثى'
+                            END,
+                            'غير محدد') AS gender,
+                        (a.d_o_d IS NULL AND COALESCE(i.status, '') NOT IN ('متوفي', 'متوفية')) AS is_alive,
+                        CASE
+                            WHEN a.d_o_b IS NULL THEN 'غير معروف'
+                            WHEN date_part('year', age(COALESCE(a.d_o_d, CURRENT_DATE), a.d_o_b)) < 18 THEN '0-17'
+                            WHEN date_part('year', age(COALESCE(a.d_o_d, CURRENT_DATE), a.d_o_b)) < 40 THEN '18-39'
+                            WHEN date_part('year', age(COALESCE(a.d_o_d, CURRENT_DATE), a.d_o_b)) < 60 THEN '40-59'
+                            ELSE '60+'
+                        END AS age_band,
+                        COALESCE(NULLIF(btrim(i.p_o_b), ''), 'غير محدد') AS p_o_b,
+                        COUNT(*)::INT AS members
+                    FROM family_name n
+                    LEFT JOIN family_info i ON n.code = i.code_info
+                    LEFT JOIN family_age_search a ON n.code = a.code
+                    GROUP BY 1, 2, 3, 4, 5
+                ''')
+                # الفهرس الفريد شرط لتحديث العرض بشكل متزامن (REFRESH ... CONCURRENTLY)
+                cur.execute("""
+                    CREATE UNIQUE INDEX IF NOT EXISTS idx_family_demographics_key
+                    ON family_demographics (level, gender, is_alive, age_band, p_o_b);
+                """)
+
                 print("✅ تم تهيئة نظام شجرة العائلة المحلي بنجاح.")
             else:
                 print("🚀 بيئة إنتاج: تم تخطي تهيئة جداول الشجرة لحماية البيانات الشخصية.")
 
+            # =======================================================
+            # 🔁 تتبع التغييرات للتصدير التزايدي (Delta): وقت آخر تعديل لكل صف + شواهد الصفوف المحذوفة
+            # =======================================================
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS sync_tombstones (
+                    table_name TEXT NOT NULL,
+                    row_key TEXT NOT NULL,
+                    deleted_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                    PRIMARY KEY (table_name, row_key)
+                )
+            """)
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_sync_tombstones_deleted ON sync_tombstones(deleted_at);")
+            cur.execute('''
+                CREATE OR REPLACE FUNCTION touch_sync_updated_at() RETURNS trigger AS $$
+                BEGIN
+                    NEW.updated_at := NOW();
+                    RETURN NEW;
+                END;
+                $$ LANGUAGE plpgsql;
+            ''')
+            # الحذف يترك شاهداً بمفتاح الصف، وإعادة الإدخال بنفس المفتاح تزيل الشاهد
+            cur.execute('''
+                CREATE OR REPLACE FUNCTION track_sync_tombstone() RETURNS trigger AS $$
+                BEGIN
+                    IF TG_OP = 'DELETE' THEN
+                        INSERT INTO sync_tombstones (table_name, row_key)
+                        VALUES (TG_TABLE_NAME, to_jsonb(OLD) ->> TG_ARGV[0])
+                        ON CONFLICT (table_name, row_key) DO UPDATE SET deleted_at = NOW();
+                        RETURN OLD;
+                    END IF;
+                    DELETE FROM sync_tombstones
+                    WHERE table_name = TG_TABLE_NAME AND row_key = to_jsonb(NEW) ->> TG_ARGV[0];
+                    RETURN NEW;
+                END;
+                $$ LANGUAGE plpgsql;
+            ''')
+            for table, key in SYNC_TABLES:
+                # جداول العائلة غير موجودة في الإنتاج؛ نتتبع الموجود فقط
+                cur.execute("SELECT to_regclass(%s)", (f"public.{table}",))
+                if cur.fetchone()[0] is None:
+                    continue
+                # family_search تحدّث updated_at بنفسها (الـ Trigger وأعداد الذرية)
+                if table != "family_search":
+                    cur.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW();")
+                    cur.execute(f"""
+                        DROP TRIGGER IF EXISTS trig_sync_touch ON {table};
+                        CREATE TRIGGER trig_sync_touch
+                            BEFORE UPDATE ON {table}
+                            FOR EACH ROW
+                            EXECUTE FUNCTION touch_sync_updated_at();
+                    """)
+                cur.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_updated_at ON {table}(updated_at);")
+                cur.execute(f"""
+                    DROP TRIGGER IF EXISTS trig_sync_tombstone ON {table};
+                    CREATE TRIGGER trig_sync_tombstone
+                        AFTER INSERT OR DELETE ON {table}
+                        FOR EACH ROW
+                        EXECUTE FUNCTION track_sync_tombstone('{key}');
+                """)
+
             print("✅ تم تحديث كافة المكونات العامة بنجاح!")
            
         except Exception as e:
@@ -4,6 +4,7 @@ from core.templates import templates
 from security.session import SessionService
 from services.analytics_service import AnalyticsService
 from services.auth_service import AuthService
+from services.duplicate_service import DuplicateService
 import html
 
 router = APIRouter(prefix="/admin", tags=["admin"])
@@ -370,4 +371,52 @@ async def view_login_logs(request: Request, page: int = 1):
     context.update({"login_history": login_history, "current_page": page, "total_pages": total_pages})
     response = templates.TemplateResponse("admin/login_logs.html", context)
     SessionService.set_cache_headers(response)
-    return response
\ No newline at end of file
+    return response
+
+
+# --- مراجعة الأعضاء المكررين المحتملين في الشجرة ---
+
+@router.get("/duplicates")
+def view_duplicates(request: Request):
+    cxt = SessionService.get_page_context(request)
+    if not cxt["user"] or not cxt["is_admin"]:
+        return RedirectResponse("/auth/login?error=unauthorized", status_code=303)
+
+    context = {**cxt}
+    context.update({
+        "candidates": DuplicateService.list_candidates(),
+        "success_message": request.session.pop("success_message", None),
+        "error_message": request.session.pop("error_message", None)
+    })
+    response = templates.TemplateResponse("admin/duplicates.html", context)
+    SessionService.set_cache_headers(response)
+    return response
+
+
+@router.post("/duplicates/scan")
+def scan_duplicates(request: Request, csrf_token: str = Form(...)):
+    cxt = SessionService.get_page_context(request)
+    if not cxt["is_admin"]:
+        raise HTTPException(status_code=403, detail="غير مصرح لك بالوصول")
+    SessionService.verify_csrf_token(request, csrf_token)
+
+    try:
+        found = DuplicateService.scan()
+        request.session["success_message"] = f"اكتمل الفحص: {found} زوج مكرر محتمل."
+    except Exception as e:
+        request.session["error_message"] = f"فشل فحص التكرار: {e}"
+    return RedirectResponse("/admin/duplicates", status_code=303)
+
+
+@router.post("/duplicates/dismiss")
+def dismiss_duplicate(request: Request, code_a: str = Form(...), code_b: str = Form(...), csrf_token: str = Form(...)):
+    cxt = SessionService.get_page_context(request)
+    if not cxt["is_admin"]:
+        raise HTTPException(status_code=403, detail="غير مصرح لك بالوصول")
+    SessionService.verify_csrf_token(request, csrf_token)
+
+    if DuplicateService.dismiss(code_a, code_b):
+        request.session["success_message"] = f"تم تعليم {code_a} و {code_b} كشخصين مختلفين."
+    else:
+        request.session["error_message"] = "الزوج غير موجود في قائمة المراجعة."
+    return RedirectResponse("/admin/duplicates", status_code=303)
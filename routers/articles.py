@@ -1,4 +1,4 @@
-from fastapi import APIRouter, Request, Form, UploadFile, File, HTTPException
+from fastapi import APIRouter, Request, Form, HTTPException
 from fastapi.responses import HTMLResponse, RedirectResponse
 import os
 import re
@@ -7,13 +7,12 @@ import nh3  # 🛡️ المكتبة الأقوى لتطهير الـ HTML وح
 from security.session import SessionService
 from services.analytics_service import AnalyticsService
 from services.article_service import ArticleService
+from services.upload_service import UploadService, UploadForm
 from core.templates import templates
 
 router = APIRouter(prefix="/articles", tags=["articles"])
 
 VALID_TITLE_REGEX = r"^[\u0600-\u06FFa-zA-Z0-9\s\.\,\!\؟\-\(\)\[\]\{\}]+$"
-ALLOWED_IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp', '.gif'}
-MAX_IMAGE_SIZE_BYTES = 5 * 1024 * 1024  # 5 ميجابايت كحد أقصى للغلاف
 
 # 🛡️ إعداد الوسوم والسمات المسموح بها داخل المقال الإخباري والمحرر
 ALLOWED_TAGS = {"p", "b", "i", "u", "h2", "h3", "span", "div", "ul", "ol", "li", "br", "font"}
@@ -82,20 +81,23 @@ async def add_article_form(request: Request):
     return response
 
 @router.post("/add")
-async def add_article(
-    request: Request, 
-    title: str = Form(...),
-    content: str = Form(...), 
-    image: UploadFile = File(None)
-):
+async def add_article(request: Request):
     cxt = SessionService.get_page_context(request, additional_perms=["add_article"])
     user = cxt["user"]
     if not user or not cxt.get("perms", {}).get("add_article", False):
         raise HTTPException(status_code=403, detail="لا تملك صلاحية النشر")
-        
-    form = await request.form()
-    SessionService.verify_csrf_token(request, form.get("csrf_token"))
-    
+
+    # الغلاف (إن وجد) يُفحص بالامتداد والمحتوى والحجم أثناء استقبال النموذج
+    form = await UploadService.receive_form(request, {"image": "image"})
+    try:
+        SessionService.verify_csrf_token(request, form.get("csrf_token"))
+        return await _create_article(request, cxt, user, form)
+    finally:
+        form.discard()
+
+async def _create_article(request: Request, cxt: dict, user: dict, form: UploadForm):
+    title = form.get("title", "")
+    content = form.get("content", "")
     title_stripped = title.strip()
     content_stripped = content.strip()
     
@@ -114,17 +116,10 @@ async def add_article(
     elif not content_stripped or len(content_stripped) < 10 or content_stripped == "اكتب محتوى مقالك هنا...":
         error = "محتوى المقال قصير جداً أو فارغ."
 
-    # الفحص الأمني للغلاف المرفوع إن وجد
-    if image and image.filename:
-        ext = os.path.splitext(image.filename).lower()
-        if ext not in ALLOWED_IMAGE_EXTENSIONS:
-            error = "امتداد الصورة غير مدعوم! المسموح: JPG, PNG, WEBP, GIF"
-        
-        # فحص الحجم
-        image.file.seek(0, os.SEEK_END)
-        if image.file.tell() > MAX_IMAGE_SIZE_BYTES:
-            error = "حجم صورة الغلاف كبير جداً! الحد الأقصى 5 ميجابايت."
-        image.file.seek(0)
+    # نتيجة الفحص الأمني للغلاف المرفوع إن وجد
+    image_upload = form.file("image")
+    if not error:
+        error = form.errors.get("image")
 
     if error:
         context = {**cxt}
@@ -140,7 +135,7 @@ async def add_article(
             title=title_stripped, 
             content=clean_html_content,          
             author_id=user["id"],
-            image_file=image if image and image.filename else None
+            image_path=image_upload["path"] if image_upload else None
         )
       
         AnalyticsService.log_action(user["id"], "إضافة مقال", f"تم نشر مقال جديد بعنوان: {title_stripped}")    
@@ -168,21 +163,22 @@ async def edit_article_form(request: Request, id: int):
     return response
     
 @router.post("/edit/{id:int}")
-async def update_article(
-    request: Request, 
-    id: int, 
-    title: str = Form(...), 
-    content: str = Form(...), 
-    image: UploadFile = File(None)
-):
+async def update_article(request: Request, id: int):
     cxt = SessionService.get_page_context(request, additional_perms=["edit_article"])
     user = cxt["user"]
     if not user or not cxt.get("perms", {}).get("edit_article", False):
         raise HTTPException(status_code=403, detail="لا تملك صلاحية التعديل")
 
-    form = await request.form()
-    SessionService.verify_csrf_token(request, form.get("csrf_token"))
+    form = await UploadService.receive_form(request, {"image": "image"})
+    try:
+        SessionService.verify_csrf_token(request, form.get("csrf_token"))
+        return await _update_article(request, cxt, user, id, form)
+    finally:
+        form.discard()
 
+async def _update_article(request: Request, cxt: dict, user: dict, id: int, form: UploadForm):
+    title = form.get("title", "")
+    content = form.get("content", "")
     title_stripped = title.strip()
     content_stripped = content.strip()
     
@@ -196,14 +192,9 @@ async def update_article(
     elif not content_stripped or len(content_stripped) < 10:
         error = "محتوى المقال قصير جداً."
 
-    if image and image.filename:
-        ext = os.path.splitext(image.filename).lower()
-        if ext not in ALLOWED_IMAGE_EXTENSIONS:
-            error = "امتداد الصورة غير مدعوم."
-        image.file.seek(0, os.SEEK_END)
-        if image.file.tell() > MAX_IMAGE_SIZE_BYTES:
-            error = "حجم صورة الغلاف كبير جداً (الحد الأقصى 5 ميجابايت)."
-        image.file.seek(0)
+    image_upload = form.file("image")
+    if not error:
+        error = form.errors.get("image")
 
     if error:
         article = ArticleService.get_article_by_id(id)
@@ -219,7 +210,7 @@ async def update_article(
         article_id=id, 
         title=title_stripped,
         content=clean_html_content, 
-        image_file=image if image and image.filename else None
+        image_path=image_upload["path"] if image_upload else None
     )
     
     AnalyticsService.log_action(user["id"], "تعديل مقال", f"قام {user['username']} بتعديل المقال رقم ({id})")
@@ -1,5 +1,11 @@
 import os
+import html
 import csv
+import json
+import zlib
+import gzip as gzip_module
+import codecs
+import itertools
 import subprocess
 from io import StringIO
 from datetime import datetime
@@ -14,6 +20,11 @@ from security.session import SessionService
 
 # استيراد خدمات العائلة لجلب البيانات من قاعدة البيانات
 from services.family_service import FamilyService
+from services.search_refresh_service import SearchRefreshService
+from services.family_import_service import FamilyImportService
+from services.gedcom_service import GedcomService
+from services.descendant_count_service import DescendantCountService
+from services.delta_sync_service import DeltaSyncService
 
 # تحميل متغيرات البيئة من ملف .env
 load_dotenv()
@@ -60,32 +71,18 @@ def get_database_url():
 # 🌳 دالات تصدير شجرة العائلة والنسخ النصي (تم نقلها وتوحيدها هنا)
 # =====================================================================
 
-@router.get("/export/family-tree/{code}")
-@router.get("/export/family-tree/") # مسار إضافي مرن لدعم التصدير الكامل
-async def export_family_tree(request: Request, code: str = None):
-    """توليد وتصدير شجرة العائلة أو فرع محدد كملف CSV منسق ومتوافق مع Excel."""
-    user, _ = SessionService.get_admin_context(request)
-    if not user:
-        raise HTTPException(status_code=403, detail="غير مصرح لك بالوصول")
-        
-    if not code:
-        data = FamilyService.get_all_family_members() 
-        filename = "full_family_tree.csv"
-    else:
-        data = FamilyService.get_full_family_tree_recursive(code)
-        filename = f"family_tree_{code}.csv"
-    
-    if not data:
-        return {"error": "لم يتم العثور على بيانات"}
-    
-    output = StringIO()
-    output.write('\ufeff') # إضافة علامة BOM لدعم اللغة العربية في Excel
-    
-    writer = csv.writer(output)
+CSV_CHUNK_ROWS = 500  # عدد الصفوف في كل دفعة تُرسل للمتصفح
+
+def iter_family_csv(rows, root_code: str = None):
+    """توليد ملف CSV على دفعات نصية صغيرة بدل بنائه كاملاً في الذاكرة."""
+    buffer = StringIO()
+    buffer.write('\ufeff') # إضافة علامة BOM لدعم اللغة العربية في Excel
+
+    writer = csv.writer(buffer)
     writer.writerow(["sep=,"]) # إجبار إكسيل على استخدام الفاصلة كمحدد للحقول
     writer.writerow(["الكود", "الاسم الرباعي", "اللقب", "الصلة", "الفئة"])
-    
-    for row in data:
+
+    for index, row in enumerate(rows, start=1):
         db_relation = row.get('relation', '')
         gender = row.get('gender', '')
 
@@ -94,7 +91,7 @@ async def export_family_tree(request: Request, code: str = None):
         else:
             relation_label = "ليست حوطاوية" if gender == "أنثى" else "ليس حوطاوي"
 
-        if code and row.get('code') == code:
+        if root_code and row.get('code') == root_code:
             relation_label = "حوطاوي (داخل الأسرة)" if gender != "أنثى" else "حوطاوية (داخل الأسرة)"
 
         writer.writerow([
@@ -104,11 +101,56 @@ async def export_family_tree(request: Request, code: str = None):
             relation_label, 
             row.get('category', '')
         ])
-    
-    output.seek(0)
-    
+
+        if index % CSV_CHUNK_ROWS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def gzip_stream(chunks):
+    """ضغط دفعات النص أثناء الإرسال (gzip) دون تجميع الملف في الذاكرة."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode("utf-8") if isinstance(chunk, str) else chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+@router.get("/export/family-tree/{code}")
+@router.get("/export/family-tree/") # مسار إضافي مرن لدعم التصدير الكامل
+def export_family_tree(request: Request, code: str = None, gzip: bool = False):
+    """تصدير شجرة العائلة أو فرع محدد كملف CSV متدفق ومتوافق مع Excel (مع ضغط gzip اختياري)."""
+    user, _ = SessionService.get_admin_context(request)
+    if not user:
+        raise HTTPException(status_code=403, detail="غير مصرح لك بالوصول")
+        
+    if not code:
+        rows = FamilyService.iter_all_family_members()
+        filename = "full_family_tree.csv"
+    else:
+        rows = iter(FamilyService.get_full_family_tree_recursive(code))
+        filename = f"family_tree_{code}.csv"
+
+    # فحص وجود بيانات بقراءة أول صف فقط ثم إعادته لبداية التدفق
+    first_row = next(rows, None)
+    if first_row is None:
+        return {"error": "لم يتم العثور على بيانات"}
+    chunks = iter_family_csv(itertools.chain([first_row], rows), code)
+
+    if gzip:
+        return StreamingResponse(
+            gzip_stream(chunks),
+            media_type="application/gzip",
+            headers={"Content-Disposition": f"attachment; filename={filename}.gz"}
+        )
+
     return StreamingResponse(
-        iter([output.getvalue()]),
+        chunks,
         media_type="text/csv; charset=utf-8-sig",
         headers={
             "Content-Disposition": f"attachment; filename={filename}",
@@ -117,30 +159,163 @@ async def export_family_tree(request: Request, code: str = None):
     )
 
 
+@router.get("/export/gedcom/{code}")
+@router.get("/export/gedcom/")
+def export_family_gedcom(request: Request, code: str = None, gzip: bool = False):
+    """تصدير العائلة كاملة أو فرع يبدأ من كود محدد بصيغة GEDCOM 5.5.1 (متدفق من مؤشر في القاعدة)."""
+    user, _ = SessionService.get_admin_context(request)
+    if not user:
+        raise HTTPException(status_code=403, detail="غير مصرح لك بالوصول")
+
+    code = code.strip().upper() if code and code.strip() else None
+    if code and not FamilyService.is_code_exists(code):
+        return {"error": "لم يتم العثور على بيانات"}
+
+    filename = f"family_tree_{code}.ged" if code else "full_family_tree.ged"
+    chunks = GedcomService.iter_export(code)
+
+    if gzip:
+        return StreamingResponse(
+            gzip_stream(chunks),
+            media_type="application/gzip",
+            headers={"Content-Disposition": f"attachment; filename={filename}.gz"}
+        )
+
+    return StreamingResponse(
+        chunks,
+        media_type="text/plain; charset=utf-8",
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    )
+
+
 @router.get("/export/table-backup-txt")
-async def export_table_backup(request: Request):
-    """توليد نسخة احتياطية نصية سريعة لجدول العائلة."""
+def export_table_backup(request: Request):
+    """تصدير نسخة احتياطية نصية متدفقة (أوامر INSERT) لجداول العائلة."""
     user, _ = SessionService.get_admin_context(request)
     if not user:
         raise HTTPException(status_code=403, detail="غير مصرح لك بالوصول")
-        
-    content = FamilyService.get_family_table_backup_text()
-    
-    if not content:
-        return Response(content="الجدول فارغ", media_type="text/plain")
 
-    return Response(
-        content=content,
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    return StreamingResponse(
+        FamilyService.iter_family_backup_sql(),
         media_type="text/plain; charset=utf-8",
         headers={
-            "Content-Disposition": "attachment; filename=family_name_backup.txt"
+            "Content-Disposition": f"attachment; filename=family_backup_{timestamp}.sql"
         }
     )
 
+@router.get("/export/delta")
+def export_delta(request: Request, since: str = None):
+    """تصدير الصفوف المعدلة والمحذوفة منذ علامة زمنية كملف JSON Lines مضغوط (بدون since: كل الصفوف)."""
+    user, _ = SessionService.get_admin_context(request)
+    if not user:
+        raise HTTPException(status_code=403, detail="غير مصرح لك بالوصول")
+
+    since_at = None
+    if since and since.strip():
+        try:
+            since_at = DeltaSyncService.parse_watermark(since)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="صيغة العلامة الزمنية غير صحيحة (ISO 8601)")
+
+    # الترويسة تُقرأ أولاً لإرسال العلامة الجديدة في رأس الاستجابة قبل بدء التدفق
+    chunks = DeltaSyncService.iter_export(since_at)
+    header = next(chunks)
+    watermark = json.loads(header)["watermark"]
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    return StreamingResponse(
+        gzip_stream(itertools.chain([header], chunks)),
+        media_type="application/gzip",
+        headers={
+            "Content-Disposition": f"attachment; filename=delta_{timestamp}.jsonl.gz",
+            "X-Delta-Watermark": watermark,
+        }
+    )
+
+
+MAX_DELTA_IMPORT_SIZE = 200 * 1024 * 1024  # 200 ميجابايت كحد أقصى لملف التغييرات المضغوط
+
+
+@router.post("/import-delta")
+def import_delta(
+    request: Request,
+    delta_file: UploadFile = File(...),
+    password: str = Form(...),
+    csrf_token: str = Form(...),
+):
+    """تطبيق ملف تغييرات (.jsonl.gz) مصدّر من نسخة أخرى في معاملة واحدة."""
+    cxt = SessionService.get_page_context(request)
+    if not cxt["is_admin"] or password != IMPORT_PASSWORD:
+        raise HTTPException(status_code=403, detail="كلمة المرور غير صحيحة أو ليس لديك صلاحية")
+    SessionService.verify_csrf_token(request, csrf_token)
+
+    message = None
+    delta_file.file.seek(0, os.SEEK_END)
+    file_size = delta_file.file.tell()
+    delta_file.file.seek(0)
+
+    if file_size > MAX_DELTA_IMPORT_SIZE:
+        message = "حجم ملف التغييرات كبير جداً! الحد الأقصى 200 ميجابايت."
+    else:
+        try:
+            # فك الضغط سطراً بسطر أثناء التطبيق دون تحميل الملف كاملاً في الذاكرة
+            compressed = delta_file.file.read(2) == b"\x1f\x8b"
+            delta_file.file.seek(0)
+            raw = gzip_module.GzipFile(fileobj=delta_file.file) if compressed else delta_file.file
+            report = DeltaSyncService.apply(codecs.getreader("utf-8")(raw))
+            message = (f"تم تطبيق التغييرات بنجاح: {report['upserted']} صف محدّث، {report['deleted']} صف محذوف. "
+                       f"العلامة الجديدة: {html.escape(str(report['watermark']))}")
+        except Exception as e:
+            message = f"فشل تطبيق التغييرات: {html.escape(str(e))}"
+
+    context = {**cxt}
+    context.update({"message": message})
+    response = templates.TemplateResponse("data/import_data.html", context)
+    SessionService.set_cache_headers(response)
+    return response
+
+
+@router.post("/rebuild-family-search")
+def rebuild_family_search(request: Request, csrf_token: str = Form(...)):
+    """إعادة بناء أسماء النسب في جدول البحث كاملاً بعبارة واحدة."""
+    cxt = SessionService.get_page_context(request)
+    if not cxt["is_admin"]:
+        raise HTTPException(status_code=403, detail="غير مصرح لك بالوصول")
+    SessionService.verify_csrf_token(request, csrf_token)
+
+    try:
+        changed = SearchRefreshService.rebuild_all()
+        request.session["success_message"] = f"تمت إعادة بناء فهرس البحث بنجاح ({changed} سجل محدّث)."
+    except Exception as e:
+        request.session["error_message"] = f"فشلت إعادة بناء فهرس البحث: {e}"
+    return RedirectResponse("/admin", status_code=303)
+
 # =====================================================================
 # 💾 استيراد وتصدير قاعدة البيانات (البنية التحتية الأساسية)
 # =====================================================================
 
+@router.post("/verify-descendant-counts")
+def verify_descendant_counts(request: Request, csrf_token: str = Form(...), fix: bool = Form(False)):
+    """إعادة حساب أعداد الذرية بمرور واحد ومقارنتها بالمحفوظ (مع التصحيح اختيارياً)."""
+    cxt = SessionService.get_page_context(request)
+    if not cxt["is_admin"]:
+        raise HTTPException(status_code=403, detail="غير مصرح لك بالوصول")
+    SessionService.verify_csrf_token(request, csrf_token)
+
+    try:
+        report = DescendantCountService.verify(fix=fix)
+        if not report["drifted"]:
+            request.session["success_message"] = "أعداد الذرية مطابقة لشجرة النسب بالكامل."
+        else:
+            sample = "، ".join(
+                f"{row['code']} ({row['stored_total']} ← {row['expected_total']})" for row in report["sample"][:5]
+            )
+            state = f"وتم تصحيح {report['fixed']}" if fix else "بدون تصحيح"
+            request.session["success_message"] = f"تم العثور على {report['drifted']} عضو بأعداد ذرية منحرفة {state}: {sample}"
+    except Exception as e:
+        request.session["error_message"] = f"فشل التحقق من أعداد الذرية: {e}"
+    return RedirectResponse("/admin", status_code=303)
+
 @router.get("/import-data", response_class=HTMLResponse)
 async def import_page(request: Request):
     cxt = SessionService.get_page_context(request)
@@ -218,6 +393,54 @@ async def import_data(
     return response
    
 
+MAX_MEMBERS_IMPORT_SIZE = 20 * 1024 * 1024  # 20 ميجابايت كحد أقصى لملف الأعضاء
+
+
+@router.post("/import-family")
+def import_family_members(
+    request: Request,
+    members_file: UploadFile = File(...),
+    csrf_token: str = Form(...),
+):
+    """استيراد جماعي لأعضاء العائلة من CSV أو Excel أو GEDCOM في معاملة واحدة."""
+    cxt = SessionService.get_page_context(request)
+    if not cxt["is_admin"]:
+        raise HTTPException(status_code=403, detail="غير مصرح لك بالوصول")
+    SessionService.verify_csrf_token(request, csrf_token)
+
+    message, import_errors = None, []
+    filename = (members_file.filename or "").lower()
+    members_file.file.seek(0, os.SEEK_END)
+    file_size = members_file.file.tell()
+    members_file.file.seek(0)
+
+    if not filename.endswith((".csv", ".xlsx", ".ged")):
+        message = "الملف لازم يكون بصيغة .csv أو .xlsx أو .ged"
+    elif file_size > MAX_MEMBERS_IMPORT_SIZE:
+        message = "حجم الملف كبير جداً! الحد الأقصى 20 ميجابايت."
+    else:
+        try:
+            if filename.endswith(".csv"):
+                report = FamilyImportService.import_rows(FamilyImportService.read_csv(members_file.file))
+            elif filename.endswith(".ged"):
+                report = GedcomService.import_gedcom(members_file.file)
+            else:
+                report = FamilyImportService.import_rows(FamilyImportService.read_xlsx(members_file.file))
+            import_errors = report["errors"]
+            if import_errors:
+                message = f"فشل الاستيراد: تم العثور على أخطاء في الملف ({report['total']} صف)."
+            else:
+                message = f"تم استيراد {report['total']} عضو بنجاح ({report['inserted']} جديد، {report['updated']} محدّث)."
+        except Exception as e:
+            message = f"خطأ: {html.escape(str(e))}"
+
+    context = {**cxt}
+    context.update({"message": message, "import_errors": import_errors})
+    response = templates.TemplateResponse("data/import_data.html", context)
+    SessionService.set_cache_headers(response)
+    return response
+
+
 @router.post("/export-data")
 async def export_data_post(request: Request, password: str = Form(...)):
     export_path = None 
@@ -5,18 +5,26 @@ import re
 from typing import Optional
 from datetime import date 
 import urllib.parse
+import markupsafe
 
 # المكتبات الخارجية (Third-party)
-from fastapi import APIRouter, Request, Form, UploadFile, File, HTTPException, Query
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi import APIRouter, Request, Form, HTTPException, Query, BackgroundTasks
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, Response, FileResponse
 from dotenv import load_dotenv
 
 # المكتبات المحلية (Local Imports)
 from core.templates import templates
+from core.fragment_cache import FragmentCache
 from security.session import SessionService
 from utils.time_utils import calculate_age_details
 from services.analytics_service import AnalyticsService
 from services.family_service import FamilyService
+from services.upload_service import UploadService, UploadForm
+from services.name_index_service import NameIndexService
+from services.kinship_service import KinshipService
+from services.tree_layout_service import TreeLayoutService
+from services.thumbnail_service import ThumbnailService
+from services.demographics_service import DemographicsService
 
 load_dotenv()
 IMPORT_PASSWORD = os.getenv("IMPORT_PASSWORD", "change_me_in_production")
@@ -24,9 +32,8 @@ IMPORT_PASSWORD = os.getenv("IMPORT_PASSWORD", "change_me_in_production")
 router = APIRouter(prefix="/family", tags=["family"])
 
 # 🔒 القيود الأمنية الصارمة للمملفات
-ALLOWED_IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp'}
+# الامتداد والمحتوى والحجم (5 ميجابايت) تُفحص أثناء الاستقبال (UploadService، نوع member_picture)
 ALLOWED_IMAGE_MIME_TYPES = {"image/jpeg", "image/png", "image/webp"}
-MAX_IMAGE_SIZE = 5 * 1024 * 1024  # 5 ميجابايت كحد أقصى للصورة الشخصية
 PARENT_CODE_PATTERN = r"^[A-Z]\d{1,3}-\d{3}-\d{3}$"  
 
 def validate_parent_code(code_value: Optional[str], code_name: str) -> Optional[str]:
@@ -34,6 +41,14 @@ def validate_parent_code(code_value: Optional[str], code_name: str) -> Optional[
         return f"صيغة كود {code_name} غير صحيحة (مثال: A0-000-001)"
     return None
 
+def validate_related_codes_exist(codes: dict) -> Optional[str]:
+    """التأكد من وجود الأكواد المرتبطة (الأب، الأم، الزوج، الزوجة) في الشجرة بطلب واحد لقاعدة البيانات"""
+    missing = set(FamilyService.find_missing_codes(codes.values()))
+    for label, value in codes.items():
+        if value and value in missing:
+            return f"كود {label} ({value}) غير موجود في الشجرة"
+    return None
+
 def clean_search_query(q: Optional[str]) -> str:
     """تنظيف نصوص البحث لمنع ثغرات التوجيه وكسر السطور HTTP Response Splitting"""
     if not q or q.strip() == "" or q == "None":
@@ -47,6 +62,7 @@ async def show_family(
     request: Request, 
     page: int = Query(1, ge=1), 
     q: str = Query(None),
+    after: Optional[str] = Query(None),
     success: Optional[str] = Query(None)
 ):
     cxt = SessionService.get_page_context(request, additional_perms=["view_tree", "add_member", "edit_member", "delete_member"])
@@ -62,7 +78,24 @@ async def show_family(
         success_message = "✅ تم إضافة العضو ورفع صورته إلى السحاب بنجاح."
 
     search_query = clean_search_query(q)
-    members, current_page, totals_pages, total_count = FamilyService.search_and_fetch_family(search_query, page)
+    # after: مؤشر معتم لرابط "التالي" يبدأ الصفحة مباشرة بعد آخر عضو معروض (بدون OFFSET)
+    members, current_page, totals_pages, total_count, next_cursor = FamilyService.search_and_fetch_family(search_query, page, after)
+
+    # 📊 ملخص الإحصائيات يظهر في الصفحة الأولى بدون بحث فقط
+    stats = None
+    if not search_query and page == 1:
+        try:
+            stats = DemographicsService.get_summary()
+        except Exception as e:
+            print(f"⚠️ تعذر جلب إحصائيات العائلة: {e}")
+
+    # 💡 عند عدم وجود نتائج مطابقة: اقتراحات تقريبية تتسامح مع أخطاء الهمزات والتاء المربوطة
+    suggestions = []
+    if search_query and total_count == 0:
+        try:
+            suggestions = NameIndexService.search(search_query, limit=8)
+        except Exception as e:
+            print(f"⚠️ تعذر جلب الاقتراحات التقريبية: {e}")
         
     PAGES_TO_SHOW = 7
     page_numbers = set()
@@ -86,15 +119,139 @@ async def show_family(
     context = {**cxt}
     context.update({
         "members": members, "current_page": current_page, 
-        "totals_pages": totals_pages, "page_numbers": page_numbers, 
-        "q": search_query, "success": success_message
+        "totals_pages": totals_pages, "page_numbers": page_numbers, "next_cursor": next_cursor,
+        "q": search_query, "success": success_message, "suggestions": suggestions,
+        "stats": stats
     })
     
     response = templates.TemplateResponse("family/family.html", context)
     SessionService.set_cache_headers(response)
     return response 
 
+# ====================== إحصائيات العائلة ======================
+@router.get("/stats", response_class=HTMLResponse)
+async def family_stats_page(request: Request):
+    cxt = SessionService.get_page_context(request, additional_perms=["view_tree"])
+    if not cxt or not cxt.get("user"):
+        return RedirectResponse("/auth/login")
+    if not cxt.get("perms", {}).get("view_tree", False):
+        raise HTTPException(status_code=403, detail="لا تملك صلاحية الاطلاع")
+
+    context = {**cxt}
+    context.update({"stats": DemographicsService.get_summary()})
+    response = templates.TemplateResponse("family/stats.html", context)
+    SessionService.set_cache_headers(response)
+    return response
+
+@router.get("/api/stats")
+async def family_stats_api(request: Request):
+    cxt = SessionService.get_page_context(request, additional_perms=["view_tree"])
+    if not cxt or not cxt.get("perms", {}).get("view_tree", False):
+        raise HTTPException(status_code=403, detail="لا تملك صلاحية الاطلاع")
+    return JSONResponse(content=DemographicsService.get_summary(), headers={"Cache-Control": "private, no-cache"})
+
+# ====================== البحث التقريبي (JSON) ======================
+@router.get("/search/suggest")
+async def suggest_members(request: Request, q: str = Query(""), limit: int = Query(10, ge=1, le=50)):
+    cxt = SessionService.get_page_context(request, additional_perms=["view_tree"])
+    if not cxt or not cxt.get("perms", {}).get("view_tree", False):
+        raise HTTPException(status_code=403, detail="لا تملك صلاحية الاطلاع")
+
+    search_query = clean_search_query(q)
+    if not search_query:
+        return {"results": []}
+    return {"results": NameIndexService.search(search_query, limit=limit)}
+
+# ====================== الشجرة التفاعلية (تحميل كسول) ======================
+@router.get("/tree/{code}", response_class=HTMLResponse)
+async def tree_page(request: Request, code: str):
+    cxt = SessionService.get_page_context(request, additional_perms=["view_tree"])
+    if not cxt or not cxt.get("user"):
+        return RedirectResponse("/auth/login")
+    if not cxt.get("perms", {}).get("view_tree", False):
+        raise HTTPException(status_code=403, detail="لا تملك صلاحية الاطلاع")
+
+    context = {**cxt}
+    context.update({"root_code": code.strip().upper()})
+    response = templates.TemplateResponse("family/tree.html", context)
+    SessionService.set_cache_headers(response)
+    return response
+
+@router.get("/api/tree/{code}")
+async def tree_node_api(request: Request, code: str, cursor: Optional[str] = Query(None), limit: int = Query(50, ge=1, le=200)):
+    cxt = SessionService.get_page_context(request, additional_perms=["view_tree"])
+    if not cxt or not cxt.get("perms", {}).get("view_tree", False):
+        raise HTTPException(status_code=403, detail="لا تملك صلاحية الاطلاع")
+
+    data = FamilyService.get_tree_node(code, clean_search_query(cursor) or None, limit)
+    if not data:
+        raise HTTPException(status_code=404, detail="العضو غير موجود")
+
+    etag = f'W/"{data.pop("etag")}"'
+    # بيانات خاصة بالعائلة: تخزين مؤقت في المتصفح فقط مع إعادة التحقق عبر ETag
+    cache_headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=cache_headers)
+    return JSONResponse(content=data, headers=cache_headers)
+
+@router.get("/api/tree-layout/{code}")
+def tree_layout_api(request: Request, code: str):
+    cxt = SessionService.get_page_context(request, additional_perms=["view_tree"])
+    if not cxt or not cxt.get("perms", {}).get("view_tree", False):
+        raise HTTPException(status_code=403, detail="لا تملك صلاحية الاطلاع")
+
+    # إحداثيات الفرع كاملاً محسوبة ومخزنة في الخادم؛ المتصفح يرسم فقط
+    layout = TreeLayoutService.get_layout(clean_search_query(code))
+    if not layout:
+        raise HTTPException(status_code=404, detail="العضو غير موجود")
+
+    etag = f'W/"layout-{layout["version"]}"'
+    cache_headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=cache_headers)
+    return JSONResponse(content=layout, headers=cache_headers)
+
+@router.get("/api/code-suggest")
+def code_suggest_api(request: Request, q: str = Query("", max_length=50), limit: int = Query(10, ge=1, le=25)):
+    cxt = SessionService.get_page_context(request, additional_perms=["view_tree"])
+    if not cxt or not cxt.get("perms", {}).get("view_tree", False):
+        raise HTTPException(status_code=403, detail="لا تملك صلاحية الاطلاع")
+
+    # اقتراحات من فهرس الأسماء في الذاكرة: بادئة الكود أو جزء من الاسم
+    suggestions = NameIndexService.autocomplete(clean_search_query(q), limit)
+    return JSONResponse(content={"results": suggestions}, headers={"Cache-Control": "private, max-age=30"})
+
+@router.get("/api/kinship")
+async def kinship_api(request: Request, a: str = Query(..., max_length=20), b: str = Query(..., max_length=20)):
+    cxt = SessionService.get_page_context(request, additional_perms=["view_tree"])
+    if not cxt or not cxt.get("perms", {}).get("view_tree", False):
+        raise HTTPException(status_code=403, detail="لا تملك صلاحية الاطلاع")
+
+    result = KinshipService.get_relationship(clean_search_query(a), clean_search_query(b))
+    if not result:
+        raise HTTPException(status_code=404, detail="أحد العضوين غير موجود")
+    return JSONResponse(content=result, headers={"Cache-Control": "private, no-cache"})
+
+# ====================== مصغرات صور الأعضاء ======================
+@router.get("/thumb/{drive_id}")
+def member_thumbnail(request: Request, drive_id: str, size: str = Query(ThumbnailService.DEFAULT_SIZE)):
+    cxt = SessionService.get_page_context(request, additional_perms=["view_tree"])
+    if not cxt or not cxt.get("perms", {}).get("view_tree", False):
+        raise HTTPException(status_code=403, detail="لا تملك صلاحية الاطلاع")
+    if not ThumbnailService.is_valid_id(drive_id):
+        raise HTTPException(status_code=404, detail="الصورة غير موجودة")
+
+    path = ThumbnailService.get_thumbnail_path(drive_id, size)
+    if not path:
+        # عند تعذر الجلب من درايف نعيد المتصفح لمصغرات درايف مؤقتاً دون تخزين الرد
+        return RedirectResponse(ThumbnailService.drive_fallback_url(drive_id, size), headers={"Cache-Control": "no-store"})
+
+    # معرف درايف يتغير مع كل صورة جديدة، لذا المحتوى ثابت لهذا الرابط
+    return FileResponse(path, media_type="image/jpeg", headers={"Cache-Control": "private, max-age=31536000, immutable"})
+
 # ====================== تفاصيل العضو ======================
+DETAILS_NAV_PLACEHOLDER = "__details_nav_qs__"
+
 @router.get("/details/{code}", response_class=HTMLResponse)
 async def name_details(request: Request, code: str, page: int = Query(1, ge=1), q: str = Query("")):
     cxt = SessionService.get_page_context(request, additional_perms=["view_tree", "edit_member"])
@@ -104,23 +261,49 @@ async def name_details(request: Request, code: str, page: int = Query(1, ge=1),
     if not cxt.get("perms", {}).get("view_tree", False):
         raise HTTPException(status_code=403, detail="لا تملك صلاحية الاطلاع")
    
-    details = FamilyService.get_member_details(code.strip().upper())
-    if not details:
+    code = code.strip().upper()
+    version = FamilyService.get_member_details_version(code)
+    if version is None:
         raise HTTPException(status_code=404, detail="العضو غير موجود")
-    
-    member_data = details["member"] 
-    age_details = calculate_age_details(member_data.get("d_o_b"), member_data.get("d_o_d"))
-    db_age = member_data.get("age_at_death")
-    if db_age is not None and str(db_age).isdigit():
-        age_details["age_at_death"] = int(db_age)
+
+    # 🧩 لوحة البيانات والعلاقات لا تعتمد على المستخدم: تُعرض مرة وتُخزن حتى يتغير العضو أو أقاربه
+    # (التاريخ جزء من المفتاح لأن العمر المعروض يتغير يومياً)
+    cache_key = ("details_panel", code, FragmentCache.generation(code), version, date.today().isoformat())
+    panel = FragmentCache.get(cache_key)
+    if panel is None:
+        details = FamilyService.get_member_details(code)
+        if not details:
+            raise HTTPException(status_code=404, detail="العضو غير موجود")
+
+        member_data = details["member"]
+        age_details = calculate_age_details(member_data.get("d_o_b"), member_data.get("d_o_d"))
+        db_age = member_data.get("age_at_death")
+        if db_age is not None and str(db_age).isdigit():
+            age_details["age_at_death"] = int(db_age)
+
+        panel_context = {
+            "member": member_data, "info": member_data, "full_name": details["full_name"],
+            "mother_full_name": details["mother_name"], "father_full_name": details.get("father_full_name", ""),
+            "children": details["children"], "picture_url": details["picture_url"], "age_details": age_details,
+            "gender": member_data.get("gender"), "wives": details.get("wives", []), "husbands": details.get("husbands", []),
+            "nav_qs": DETAILS_NAV_PLACEHOLDER,
+        }
+        panel = {
+            "html": templates.env.get_template("family/_details_panel.html").render(panel_context),
+            "member": {"code": member_data["code"]},
+            "full_name": details["full_name"],
+        }
+        FragmentCache.set(cache_key, panel)
+
+    # روابط التنقل داخل اللوحة تحمل صفحة وبحث الطلب الحالي
+    search_query = clean_search_query(q)
+    nav_qs = str(markupsafe.escape(urllib.parse.urlencode({"page": page, "q": search_query})))
 
     context = {**cxt}
     context.update({
-        "member": member_data, "info": member_data, "full_name": details["full_name"],
-        "mother_full_name": details["mother_name"], "father_full_name": details.get("father_full_name", ""),
-        "children": details["children"], "picture_url": details["picture_url"], "age_details": age_details,
-        "gender": member_data.get("gender"), "wives": details.get("wives", []), "husbands": details.get("husbands", []),
-        "current_page": page, "search_query": clean_search_query(q)
+        "member": panel["member"], "full_name": panel["full_name"],
+        "panel_html": markupsafe.Markup(panel["html"].replace(DETAILS_NAV_PLACEHOLDER, nav_qs)),
+        "current_page": page, "search_query": search_query
     })
     
     response = templates.TemplateResponse("family/details.html", context)
@@ -147,25 +330,25 @@ async def add_name_form(request: Request):
     return response
   
 @router.post("/add")
-async def add_name(
-    request: Request,
-    code: str = Form(...), name: str = Form(...),
-    f_code: Optional[str] = Form(None), m_code: Optional[str] = Form(None),
-    w_code: Optional[str] = Form(None), h_code: Optional[str] = Form(None),
-    relation: Optional[str] = Form(None), level: Optional[str] = Form(None), 
-    nick_name: Optional[str] = Form(None), gender: Optional[str] = Form(None),
-    d_o_b: Optional[str] = Form(None), d_o_d: Optional[str] = Form(None),
-    email: Optional[str] = Form(None), phone: Optional[str] = Form(None),
-    address: Optional[str] = Form(None), p_o_b: Optional[str] = Form(None),
-    status: Optional[str] = Form(None), picture: Optional[UploadFile] = File(None)
-):
+async def add_name(request: Request, background_tasks: BackgroundTasks):
     cxt = SessionService.get_page_context(request, additional_perms=["add_member"])
     user = cxt.get("user")
     if not user or not cxt.get("perms", {}).get("add_member", False):
         raise HTTPException(status_code=403, detail="لا تملك صلاحية الإضافة")
-    
-    form = await request.form()
-    SessionService.verify_csrf_token(request, form.get("csrf_token"))
+
+    form = await UploadService.receive_form(request, {"picture": "member_picture"})
+    try:
+        SessionService.verify_csrf_token(request, form.get("csrf_token"))
+        return await _save_new_member(request, background_tasks, cxt, user, form)
+    finally:
+        form.discard()
+
+async def _save_new_member(request: Request, background_tasks: BackgroundTasks, cxt: dict, user: dict, form: UploadForm):
+    code, name = form.get("code", ""), form.get("name", "")
+    f_code, m_code, w_code, h_code = (form.get(key) for key in ("f_code", "m_code", "w_code", "h_code"))
+    relation, level, nick_name, gender = (form.get(key) for key in ("relation", "level", "nick_name", "gender"))
+    d_o_b, d_o_d, email, phone = (form.get(key) for key in ("d_o_b", "d_o_d", "email", "phone"))
+    address, p_o_b, status, auto_code = (form.get(key) for key in ("address", "p_o_b", "status", "auto_code"))
 
     code = code.strip().upper() if code else ""
     name = html.escape(name.strip()) if name else ""
@@ -186,6 +369,8 @@ async def add_name(
 
     level_int = None 
     error = None
+    # الكود المقترح تلقائياً يُحجز رقمه عند الحفظ (نموذج آخر ربما أخذ نفس الاقتراح)
+    allocate_code = auto_code == "1"
 
     if not re.fullmatch(PARENT_CODE_PATTERN, code):
         error = "صيغة الكود الشخصي غير صحيحة!<br>الصيغة الصحيحة: <strong>A0-000-001</strong>"
@@ -232,21 +417,18 @@ async def add_name(
     if not error and h_code: error = validate_parent_code(h_code, "الزوج")
     if not error and w_code: error = validate_parent_code(w_code, "الزوجة")
 
-    if not error and FamilyService.is_code_exists(code):
+    if not error:
+        error = validate_related_codes_exist({"الأب": f_code, "الأم": m_code, "الزوج": h_code, "الزوجة": w_code})
+
+    if not error and not allocate_code and FamilyService.is_code_exists(code):
         error = "هذا الكود مستخدم من قبل! اختر كودًا آخر."
 
-    # 🔒 فحص الصورة والتحقق من الحجم والميّم
-    ext = None
-    if not error and picture and picture.filename:
-        ext = os.path.splitext(picture.filename)[1].lower()
-        if ext not in ALLOWED_IMAGE_EXTENSIONS or picture.content_type not in ALLOWED_IMAGE_MIME_TYPES:
-            error = "نوع الصورة غير مدعوم! استخدم: JPG، PNG، WebP فقط"
-        else:
-            picture.file.seek(0, os.SEEK_END)
-            file_size = picture.file.tell()
-            picture.file.seek(0)
-            if file_size > MAX_IMAGE_SIZE:
-                error = "حجم الصورة كبير جداً! الحد الأقصى المسموح هو 5 ميجابايت"
+    # 🔒 نتيجة فحص الصورة أثناء الاستقبال، ثم الميّم المعلن
+    picture = form.file("picture")
+    if not error:
+        error = form.errors.get("picture")
+    if not error and picture and picture["content_type"] not in ALLOWED_IMAGE_MIME_TYPES:
+        error = "نوع الصورة غير مدعوم! استخدم: JPG، PNG، WebP فقط"
 
     if not error:
         try:
@@ -254,11 +436,15 @@ async def add_name(
                 "code": code, "name": name, "f_code": f_code, "m_code": m_code,
                 "w_code": w_code, "h_code": h_code, "relation": relation, "level": level_int,
                 "nick_name": nick_name, "d_o_b": d_o_b, "d_o_d": d_o_d, "gender": gender, 
-                "email": email, "phone": phone, "address": address, "p_o_b": p_o_b, "status": status
+                "email": email, "phone": phone, "address": address, "p_o_b": p_o_b, "status": status,
+                "allocate_code": allocate_code
             }
 
-            # ⭐ [التعديل الجوهري]: تمرير الملف إلى خدمة الإضافة السحابية مباشرة
-            FamilyService.add_new_member(member_data, picture, ext)
+            # حفظ البيانات أولاً بمعاملة قصيرة، ثم رفع الصورة إلى درايف في الخلفية
+            code = FamilyService.add_new_member(member_data)
+            pending_picture = FamilyService.stage_member_picture(code, picture)
+            if pending_picture:
+                background_tasks.add_task(FamilyService.attach_member_picture, code, pending_picture)
             AnalyticsService.log_action(user['id'], "إضافة فرد", f"تم إضافة {html.unescape(name)}")
 
             empty_form_data = {key: "" for key in ["code", "name", "f_code", "m_code", "w_code", "h_code", 
@@ -266,7 +452,7 @@ async def add_name(
                                                 "d_o_d", "email", "phone", "address", "p_o_b", "status"]}
             
             context = {**cxt}
-            context.update({"error": None, "success": f"تم حفظ {html.unescape(name)} ورفع الصورة لسحابة Google Drive بنجاح!", "form_data": empty_form_data})
+            context.update({"error": None, "success": f"تم حفظ {html.unescape(name)} بنجاح بالكود {code}!" + (" جاري رفع الصورة في الخلفية." if pending_picture else ""), "form_data": empty_form_data})
             response = templates.TemplateResponse("family/add_name.html", context)
             SessionService.set_cache_headers(response)
             return response
@@ -292,7 +478,10 @@ async def add_name(
     return response
 
 @router.get("/get-next-code")
-async def suggest_code(prefix: Optional[str] = None, letter: Optional[str] = None): 
+async def suggest_code(request: Request, prefix: Optional[str] = None, letter: Optional[str] = None): 
+    cxt = SessionService.get_page_context(request, additional_perms=["add_member"])
+    if not cxt or not cxt.get("perms", {}).get("add_member", False):
+        raise HTTPException(status_code=403, detail="لا تملك صلاحية الإضافة")
     search_term = prefix or letter
     if not search_term:
         return {"next_code": ""}
@@ -321,27 +510,27 @@ async def edit_name_form(request: Request, code: str):
     return response
 
 @router.post("/edit/{code}")
-async def update_name(
-    request: Request, 
-    code: str, name: str = Form(...), 
-    f_code: str = Form(None), m_code: str = Form(None),
-    w_code: str = Form(None), h_code: str = Form(None),
-    relation: str = Form(None), level: str = Form(None), 
-    nick_name: str = Form(None), gender: str = Form(None),
-    d_o_b_str: Optional[str] = Form(None, alias="d_o_b"), 
-    d_o_d_str: Optional[str] = Form(None, alias="d_o_d"),
-    email: str = Form(None), phone: str = Form(None),
-    address: str = Form(None), p_o_b: str = Form(None),
-    status: str = Form(None), picture: UploadFile = File(None),
-    page: int = Form(1), q: str = Form("")
-):
+async def update_name(request: Request, background_tasks: BackgroundTasks, code: str):
     cxt = SessionService.get_page_context(request, additional_perms=["edit_member"])
     user = cxt["user"]
     if not cxt.get("perms", {}).get("edit_member", False):
         raise HTTPException(status_code=403, detail="لا تملك صلاحية التعديل")
 
-    form = await request.form()
-    SessionService.verify_csrf_token(request, form.get("csrf_token"))
+    form = await UploadService.receive_form(request, {"picture": "member_picture"})
+    try:
+        SessionService.verify_csrf_token(request, form.get("csrf_token"))
+        return await _save_member_edit(request, background_tasks, cxt, user, code, form)
+    finally:
+        form.discard()
+
+async def _save_member_edit(request: Request, background_tasks: BackgroundTasks, cxt: dict, user: dict, code: str, form: UploadForm):
+    name = form.get("name", "")
+    f_code, m_code, w_code, h_code = (form.get(key) for key in ("f_code", "m_code", "w_code", "h_code"))
+    relation, level, nick_name, gender = (form.get(key) for key in ("relation", "level", "nick_name", "gender"))
+    d_o_b_str, d_o_d_str, email, phone = (form.get(key) for key in ("d_o_b", "d_o_d", "email", "phone"))
+    address, p_o_b, status = (form.get(key) for key in ("address", "p_o_b", "status"))
+    page, q = form.get("page", "1"), form.get("q", "")
+    page = int(page) if page.isdigit() else 1
 
     error = None
     level_int = None 
@@ -403,20 +592,13 @@ async def update_name(
         elif m_code_error := validate_parent_code(m_code, "الأم"): error = m_code_error
         elif h_code_error := validate_parent_code(h_code, "الزوج"): error = h_code_error
         elif w_code_error := validate_parent_code(w_code, "الزوجة"): error = w_code_error
+        else: error = validate_related_codes_exist({"الأب": f_code, "الأم": m_code, "الزوج": h_code, "الزوجة": w_code})
  
-    ext = None
-    if not error and picture and picture.filename:
-        ext = os.path.splitext(picture.filename)[1].lower()
-        if ext not in ALLOWED_IMAGE_EXTENSIONS or picture.content_type not in ALLOWED_IMAGE_MIME_TYPES:
-            error = "نوع الصورة غير مدعوم! استخدم: JPG، PNG، WebP فقط"
-        else:
-            # ✅ الإصلاح: استخدام الـ file القياسي الأساسي لقراءة حجم الملف بدقة دون اعتراض من FastAPI
-            picture.file.seek(0, os.SEEK_END)
-            file_size = picture.file.tell()
-            picture.file.seek(0) # إعادة المؤشر للبداية للقراءة اللاحقة
-            
-            if file_size > MAX_IMAGE_SIZE:
-                error = "حجم الصورة كبير جداً! الحد الأقصى 5 ميجابايت"
+    picture = form.file("picture")
+    if not error:
+        error = form.errors.get("picture")
+    if not error and picture and picture["content_type"] not in ALLOWED_IMAGE_MIME_TYPES:
+        error = "نوع الصورة غير مدعوم! استخدم: JPG، PNG، WebP فقط"
 
     if not error:
         try:
@@ -427,8 +609,11 @@ async def update_name(
                 "email": email, "phone": phone, "address": address, "p_o_b": p_o_b, "status": status
             }
 
-            # ⭐ [التعديل الجوهري]: تمرير كائن الصورة السحابي لخدمة التعديل مباشرة
-            FamilyService.update_member_data(code, member_data, picture, ext)
+            # حفظ البيانات أولاً بمعاملة قصيرة، ثم استبدال الصورة في درايف في الخلفية
+            FamilyService.update_member_data(code, member_data)
+            pending_picture = FamilyService.stage_member_picture(code, picture)
+            if pending_picture:
+                background_tasks.add_task(FamilyService.attach_member_picture, code, pending_picture)
             AnalyticsService.log_action(user['id'], "تعديل فرد", f"تم تعديل بيانات العضو {name} ({code})")
 
             clean_q = clean_search_query(q)
@@ -1,8 +1,10 @@
 import re
+import asyncio
 from typing import Optional
-from fastapi import APIRouter, Request, Form, HTTPException, Query, File, UploadFile
+from fastapi import APIRouter, Request, HTTPException, Query
 from fastapi.responses import HTMLResponse, RedirectResponse
 from services.gallery_service import GalleryService, upload_to_cloudinary
+from services.upload_service import UploadService, UploadForm
 from core.templates import templates
 from security.session import SessionService
 from services.analytics_service import AnalyticsService
@@ -54,22 +56,23 @@ async def add_image_page(request: Request):
     return response
 
 @router.post("/add")
-async def add_new_image(
-    request: Request,
-    title: str = Form(...),
-    image: UploadFile = File(...),
-    category: str = Form(None),
-    csrf_token: str = Form(...)
-):
+async def add_new_image(request: Request):
     cxt = SessionService.get_page_context(request, additional_perms=["add_gallery"])
     user = cxt["user"]
     if not cxt.get("perms", {}).get("add_gallery", False):
         raise HTTPException(status_code=403, detail="لا تملك صلاحية الإضافة")
-    
-    form = await request.form()
-    SessionService.verify_csrf_token(request, form.get("csrf_token"))
 
-    title = title.strip()
+    # استقبال النموذج بعد التحقق من الصلاحية: الصورة تُفحص (الامتداد والمحتوى و5 ميجابايت) أثناء وصولها
+    form = await UploadService.receive_form(request, {"image": "image"})
+    try:
+        SessionService.verify_csrf_token(request, form.get("csrf_token"))
+        return await _save_image(request, cxt, user, form)
+    finally:
+        form.discard()
+
+async def _save_image(request: Request, cxt: dict, user: dict, form: UploadForm):
+    title = form.get("title", "").strip()
+    category = form.get("category") or None
     if not title or len(title) < 3:
         return templates.TemplateResponse("gallery/add.html", {**cxt, "error": "العنوان قصير جداً"})
       
@@ -77,16 +80,19 @@ async def add_new_image(
         raise HTTPException(status_code=400, detail="العنوان لا يجب أن يبدأ برمز أو رقم")
     
     # 🔒 فحص الامتداد ونوع الملف (مهم جداً لسد ثغرة رفع الملفات الخبيثة)
-    file_ext = f".{image.filename.split('.')[-1]}".lower() if "." in image.filename else ""
-    if file_ext not in ALLOWED_IMAGE_EXTENSIONS or image.content_type not in ALLOWED_MIME_TYPES:
+    if form.errors.get("image"):
+        return templates.TemplateResponse("gallery/add.html", {**cxt, "error": form.errors["image"]})
+    upload = form.file("image")
+    if not upload:
+        return templates.TemplateResponse("gallery/add.html", {**cxt, "error": "يرجى اختيار صورة للرفع"})
+    if upload["ext"] not in ALLOWED_IMAGE_EXTENSIONS or upload["content_type"] not in ALLOWED_MIME_TYPES:
         return templates.TemplateResponse("gallery/add.html", {**cxt, "error": "نوع الملف غير مدعوم! يسمح فقط بالصور المعتادة."})
 
     cloudinary_url = None
     image_id = None
     try:
-        await image.seek(0)
         # رفع الصورة للسحابة
-        cloudinary_url = upload_to_cloudinary(image.file)
+        cloudinary_url = await asyncio.to_thread(upload_to_cloudinary, upload["path"])
         
         if not cloudinary_url:
             return templates.TemplateResponse("gallery/add.html", {**cxt, "error": "فشل الاتصال بالسحابة، حاول مجدداً"})
@@ -1,4 +1,4 @@
-from fastapi import APIRouter, Request, Form, UploadFile, File, HTTPException, BackgroundTasks
+from fastapi import APIRouter, Request, Form, HTTPException
 from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse
 import re
 import html 
@@ -11,6 +11,8 @@ import httpx
 from security.session import SessionService
 from services.analytics_service import AnalyticsService
 from services.library_service import LibraryService
+from services.library_job_service import LibraryJobService
+from services.upload_service import UploadService, UploadForm
 from core.templates import templates
 
 router = APIRouter(prefix="/library", tags=["Library"])
@@ -18,7 +20,6 @@ router = APIRouter(prefix="/library", tags=["Library"])
 CATEGORIES = ["كتب دينية", "كتب علمية", "كتب طبية", "كتب هندسية", "كتب ثقافية", "مقرارات ومناهج سودانية", "روايات"]
 VALID_TITLE_REGEX = r"^[\u0600-\u06FFa-zA-Z0-9\s\.\,\!\؟\-\(\)\[\]\{\}]+$"
 ALLOWED_EXTENSIONS = {'.pdf', '.doc', '.docx', '.ppt', '.pptx'}
-MAX_FILE_SIZE_BYTES = 40 * 1024 * 1024  # 40 ميجابايت كحد أقصى للحماية
 
 @router.get("/", response_class=HTMLResponse)
 async def list_library(request: Request, category: str = "الكل", page: int = 1, q: str = None):
@@ -62,16 +63,7 @@ async def add_book_page(request: Request, from_page: str = "library"):
     return response
 
 @router.post("/add")
-async def add_book(
-    request: Request,
-    background_tasks: BackgroundTasks,
-    title: str = Form(...),
-    author: str = Form(None),
-    category: str = Form(...),
-    allow_download: Optional[str] = Form(None), # 💡 إصلاح ثغرة الـ Checkbox بالاستقبال النصي المرن
-    book_file: UploadFile = File(...),
-    cover_image: UploadFile = File(None)
-):
+async def add_book(request: Request):
     cxt = SessionService.get_page_context(request, additional_perms=["add_book"])
     user = cxt["user"]
     if not user:
@@ -80,27 +72,32 @@ async def add_book(
     if not cxt.get("perms", {}).get("add_book", False):
         raise HTTPException(status_code=403, detail="لا تملك صلاحية الإضافة")
 
-    form = await request.form()
-    SessionService.verify_csrf_token(request, form.get("csrf_token"))
-    
+    # الكتاب يُكتب مباشرة في مجلد الطابور أثناء استقباله، مع فحص الامتداد والمحتوى والحجم وحساب البصمة
+    form = await UploadService.receive_form(
+        request, {"book_file": "book", "cover_image": "image"},
+        destinations={"book_file": (LibraryJobService.JOBS_DIR, "staging__")},
+    )
+    try:
+        SessionService.verify_csrf_token(request, form.get("csrf_token"))
+        return await _save_book(request, cxt, user, form)
+    finally:
+        form.discard()
+
+async def _save_book(request: Request, cxt: dict, user: dict, form: UploadForm):
     # تحويل حالة الـ Checkbox إلى متغيّر منطقي حقيقي
-    is_download_allowed = True if allow_download == "on" else False
-    
-    title_stripped = title.strip()
-    author_stripped = author.strip() if author else "غير معروف"
-    
-    # 🚨 1. جدار الحماية للباكيند: فحص الامتداد والحجم قبل استهلاك الموارد
-    file_ext = os.path.splitext(book_file.filename).lower()
-    if file_ext not in ALLOWED_EXTENSIONS:
-        return await return_with_error(request, cxt, "صيغة الملف غير مدعومة! المسموح: PDF, Word, PowerPoint", title_stripped, author_stripped)
-        
-    # قراءة حجم الملف التقريبي لحماية الهارد ديسك
-    book_file.file.seek(0, os.SEEK_END)
-    file_size = book_file.file.tell()
-    book_file.file.seek(0)  # إعادة المؤشر للبداية لقراءته لاحقاً
+    is_download_allowed = True if form.get("allow_download") == "on" else False
+    category = form.get("category")
+
+    title_stripped = form.get("title", "").strip()
+    author_stripped = form.get("author", "").strip() or "غير معروف"
     
-    if file_size > MAX_FILE_SIZE_BYTES:
-        return await return_with_error(request, cxt, "حجم الملف كبير جداً! الحد الأقصى المسموح به هو 40 ميجابايت.", title_stripped, author_stripped)
+    # 🚨 1. جدار الحماية للباكيند: الامتداد والحجم والمحتوى فُحصت أثناء الاستقبال
+    book_upload = form.file("book_file")
+    if form.errors.get("book_file"):
+        return await return_with_error(request, cxt, form.errors["book_file"], title_stripped, author_stripped)
+    if not book_upload or book_upload["ext"] not in ALLOWED_EXTENSIONS:
+        return await return_with_error(request, cxt, "يرجى اختيار ملف الكتاب (PDF, Word, PowerPoint).", title_stripped, author_stripped)
+    file_ext = book_upload["ext"]
 
     # 🚨 2. فحص نمط العنوان ضد محاولات الحقن
     if not title_stripped:
@@ -111,13 +108,19 @@ async def add_book(
     if category not in CATEGORIES:
         return await return_with_error(request, cxt, "التصنيف المختار غير مدرج بالنظام.", title_stripped, author_stripped)
 
-    try:
-        # معالجة سريعة واستخراج البيانات الوصفية محلياً
-        local_file_path, auto_cover_url, actual_size_str = await LibraryService.process_and_get_metadata(book_file)
+    if not LibraryJobService.has_capacity():
+        return await return_with_error(request, cxt, "طابور معالجة الكتب ممتلئ حالياً، يرجى المحاولة بعد دقائق.", title_stripped, author_stripped)
+
+    if form.errors.get("cover_image"):
+        return await return_with_error(request, cxt, form.errors["cover_image"], title_stripped, author_stripped)
 
-        final_cover_url = auto_cover_url
-        if cover_image and cover_image.filename:
-            manual_cover = await LibraryService.upload_cover(cover_image)
+    try:
+        # الملف محفوظ فقط؛ الضغط واستخراج الغلاف والرفع السحابي تتم في طابور المعالجة
+        final_cover_url = LibraryService.default_cover_for(file_ext)
+        manual_cover = None
+        cover_upload = form.file("cover_image")
+        if cover_upload:
+            manual_cover = await LibraryService.upload_cover(cover_upload["path"])
             if manual_cover:
                 final_cover_url = manual_cover
 
@@ -130,16 +133,14 @@ async def add_book(
             file_url="pending", 
             cover_url=final_cover_url,
             uploader_id=user["id"],
-            file_size=actual_size_str 
+            file_size=f"{book_upload['size'] / (1024 * 1024):.2f} MB",
+            processing_status="queued",
+            content_sha256=book_upload["sha256"]
         )
 
-        # الترحيل الفوري للمهمة الثقيلة لتعمل في الخلفية
-        background_tasks.add_task(
-            LibraryService.background_upload, 
-            local_file_path,   
-            book_file.filename, 
-            book_id
-        )
+        # إدراج المهمة الثقيلة في الطابور والرد فوراً
+        LibraryJobService.submit(book_id, book_upload["path"], book_upload["filename"],
+                                 render_cover=file_ext == ".pdf" and not manual_cover)
 
         AnalyticsService.log_action(user["id"], "إضافة كتاب", f"بدأ {user['username']} رفع كتاب: {title_stripped}")
         return RedirectResponse("/library", status_code=303)
@@ -148,6 +149,13 @@ async def add_book(
         print(f"❌ Error during processing: {e}")
         return await return_with_error(request, cxt, "حدث خطأ غير متوقع في الخادم أثناء معالجة الملف.", title_stripped, author_stripped)
 
+@router.get("/api/status")
+async def books_status(ids: str = ""):
+    """حالة معالجة الكتب (queued / processing / ready / error) لتحديث الواجهة دورياً"""
+    book_ids = [int(x) for x in ids.split(",") if x.strip().isdigit()][:50]
+    statuses = LibraryJobService.get_statuses(book_ids)
+    return {"books": {str(book_id): info for book_id, info in statuses.items()}}
+
 async def return_with_error(request, cxt, error_msg, title, author):
     """دالة مساعدة لإرجاع رسالة الخطأ مع الحفاظ على المدخلات واضحة"""
     context = {**cxt}
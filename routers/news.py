@@ -1,6 +1,7 @@
-from fastapi import APIRouter, Request, Form, UploadFile, File, HTTPException, Query
+from fastapi import APIRouter, Request, HTTPException, Query
 from fastapi.responses import HTMLResponse, RedirectResponse
 from services.news_service import NewsService
+from services.upload_service import UploadService, UploadForm
 from services.analytics_service import AnalyticsService
 from security.session import SessionService
 from core.templates import templates
@@ -87,12 +88,7 @@ async def add_news_form(request: Request):
     return response
 
 @router.post("/add")
-async def add_news(
-    request: Request,
-    title: str = Form(...),
-    content: str = Form(...),
-    image: UploadFile = File(None)
-):
+async def add_news(request: Request):
     cxt = SessionService.get_page_context(request, additional_perms=["add_news"])
     user = cxt["user"]
     if not user:
@@ -100,12 +96,18 @@ async def add_news(
 
     if not cxt.get("perms", {}).get("add_news", False):
         raise HTTPException(status_code=403, detail="لا تملك صلاحية الإضافة")
-    
-    form = await request.form()
-    SessionService.verify_csrf_token(request, form.get("csrf_token"))
 
-    title_stripped = title.strip()
-    content_stripped = content.strip()
+    # الوسائط تُفحص بالمحتوى والحجم أثناء استقبال النموذج (5 ميجابايت للصور و40 للفيديو)
+    form = await UploadService.receive_form(request, {"image": "news_media"})
+    try:
+        SessionService.verify_csrf_token(request, form.get("csrf_token"))
+        return await _create_news(request, cxt, user, form)
+    finally:
+        form.discard()
+
+async def _create_news(request: Request, cxt: dict, user: dict, form: UploadForm):
+    title_stripped = form.get("title", "").strip()
+    content_stripped = form.get("content", "").strip()
     # 🛡️ الحماية من التزوير: الكاتب يؤخذ إجبارياً من الجلسة الموثقة وليس من مدخلات الفورم المخترقة
     author_verified = user["username"]
     
@@ -124,6 +126,10 @@ async def add_news(
     if not clean_text_check or clean_text_check == "اكتب تفاصيل الخبر هنا...":
         error = "محتوى الخبر فارغ أو غير صالح."
 
+    media_upload = form.file("image")
+    if not error:
+        error = form.errors.get("image")
+
     if error:
         context = {**cxt}
         context.update({
@@ -142,7 +148,7 @@ async def add_news(
             title=title_stripped,
             content=sanitized_content,
             author=author_verified,
-            media_file=image.file if image and image.filename else None
+            media_file=media_upload["path"] if media_upload else None
         )
 
         AnalyticsService.log_action(
@@ -178,15 +184,7 @@ async def edit_news_form(request: Request, id: int):
     return response
 
 @router.post("/edit/{id:int}")
-async def update_news(
-    request: Request,
-    id: int,
-    title: str = Form(...),
-    content: str = Form(...),
-    author: str = Form(...), # مسموح للإدارة تعديل اسم الكاتب الأصلي إن لزم الأمر
-    image: UploadFile = File(None),
-    page: int = Form(1)
-):
+async def update_news(request: Request, id: int):
     cxt = SessionService.get_page_context(request, additional_perms=["edit_news"])
     user = cxt["user"]
     if not user:
@@ -195,12 +193,20 @@ async def update_news(
     if not cxt.get("perms", {}).get("edit_news", False):
         raise HTTPException(status_code=403, detail="لا تملك صلاحية التعديل")
 
-    form = await request.form()
-    SessionService.verify_csrf_token(request, form.get("csrf_token"))
+    form = await UploadService.receive_form(request, {"image": "news_media"})
+    try:
+        SessionService.verify_csrf_token(request, form.get("csrf_token"))
+        return await _update_news(request, cxt, user, id, form)
+    finally:
+        form.discard()
 
-    title_stripped = title.strip()
-    content_stripped = content.strip()
-    author_stripped = author.strip()
+async def _update_news(request: Request, cxt: dict, user: dict, id: int, form: UploadForm):
+    title_stripped = form.get("title", "").strip()
+    content_stripped = form.get("content", "").strip()
+    # مسموح للإدارة تعديل اسم الكاتب الأصلي إن لزم الأمر
+    author_stripped = form.get("author", "").strip()
+    page = form.get("page", "1")
+    page = int(page) if page.isdigit() else 1
     
     error = None
 
@@ -218,6 +224,10 @@ async def update_news(
     if not clean_text_check:
         error = "محتوى الخبر لا يمكن أن يكون فارغاً."
 
+    media_upload = form.file("image")
+    if not error:
+        error = form.errors.get("image")
+
     if error:
         item = NewsService.get_news_by_id(id)
         if not item:
@@ -239,7 +249,7 @@ async def update_news(
             title=title_stripped,
             content=sanitized_content,
             author=author_stripped,
-            media_file=image.file if image and image.filename else None
+            media_file=media_upload["path"] if media_upload else None
         )
         
         if success:
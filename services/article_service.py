@@ -6,14 +6,13 @@ from psycopg2.extras import RealDictCursor
 class ArticleService:
    
     @staticmethod
-    async def upload_article_image(image_file, article_id):
+    async def upload_article_image(image_path, article_id):
         try:
-            file_content = await image_file.read()
-            
             # 💡 التعديل الجوهري: تشغيل دالة كلوديناري المتزامنة في Thread منفصل لكي لا تجمد السيرفر
+            # الصورة مستقبَلة مسبقاً على القرص فيقرؤها Cloudinary مباشرة دون تحميلها في الذاكرة
             upload_result = await asyncio.to_thread(
                 cloudinary.uploader.upload,
-                file_content,
+                image_path,
                 folder="hottiyya_articles",
                 public_id=f"article_{article_id}",
                 overwrite=True,
@@ -25,7 +24,7 @@ class ArticleService:
             return None
       
     @staticmethod
-    async def create_article(title, content, author_id, image_file=None):
+    async def create_article(title, content, author_id, image_path=None):
         with get_db_context() as conn:
             with conn.cursor() as cur:
                 cur.execute("""
@@ -34,8 +33,8 @@ class ArticleService:
                 """, (title, content, author_id))
                 article_id = cur.fetchone()[0]
                 
-                if image_file and image_file.filename:
-                    image_url = await ArticleService.upload_article_image(image_file, article_id)
+                if image_path:
+                    image_url = await ArticleService.upload_article_image(image_path, article_id)
                     if image_url:
                         cur.execute("UPDATE articles SET image_url = %s WHERE id = %s", (image_url, article_id))
                 
@@ -43,15 +42,15 @@ class ArticleService:
                 return article_id
 
     @staticmethod
-    async def update_article(article_id, title, content, image_file=None):
+    async def update_article(article_id, title, content, image_path=None):
         with get_db_context() as conn:
             with conn.cursor() as cur:
                 cur.execute("SELECT image_url FROM articles WHERE id = %s", (article_id,))
                 row = cur.fetchone()
                 image_url = row[0] if row else None
 
-                if image_file and image_file.filename:
-                    new_url = await ArticleService.upload_article_image(image_file, article_id)
+                if image_path:
+                    new_url = await ArticleService.upload_article_image(image_path, article_id)
                     if new_url:
                         image_url = new_url
 
@@ -0,0 +1,276 @@
+# delta_sync_service.py
+import json
+import base64
+from datetime import date, datetime, time, timezone
+from decimal import Decimal
+from typing import Dict, Any, Iterable, Iterator, List, Optional, Tuple
+from psycopg2 import extensions
+from psycopg2.extras import Json
+
+from postgresql import get_db_context, SYNC_TABLES
+from services.family_service import FamilyService
+
+
+class DeltaSyncService:
+    """
+    تصدير تزايدي (Delta) لما تغيّر منذ علامة زمنية (watermark) وتطبيقه على نسخة أخرى.
+    الصيغة: أسطر JSON مضغوطة بـ gzip —
+      1. ترويسة: {"format", "version", "since", "watermark"}
+      2. صف لكل سجل معدّل: {"t": الجدول, "op": "upsert", "row": {...}}
+      3. شاهد لكل سجل محذوف: {"t": الجدول, "op": "delete", "key": ...}
+      4. خاتمة: {"end": true, "rows": ..., "deleted": ...}
+    العلامة المعادة تُمرر كـ since في التصدير التالي، فتكون كلفة النسخ الدورية بحجم التغيير فقط.
+    """
+    FORMAT = "hottiyya-delta"
+    VERSION = 1
+    CHUNK_ROWS = 500
+    FAMILY_TABLES = {"family_name", "family_info", "family_age_search", "family_picture", "family_search"}
+
+    # =======================================================
+    # 1. أدوات مساعدة
+    # =======================================================
+    @staticmethod
+    def _json_default(value):
+        if isinstance(value, (datetime, date, time)):
+            return value.isoformat()
+        if isinstance(value, Decimal):
+            return float(value)
+        if isinstance(value, (bytes, memoryview)):
+            return base64.b64encode(bytes(value)).decode("ascii")
+        return str(value)
+
+    @classmethod
+    def _dump(cls, payload: Dict[str, Any]) -> str:
+        return json.dumps(payload, ensure_ascii=False, default=cls._json_default, separators=(",", ":")) + "\n"
+
+    @staticmethod
+    def format_watermark(value: datetime) -> str:
+        """العلامة بتوقيت UTC مع Z: لا تحتوي '+' الذي يصل مسافة إن لم يُرمّز في رابط since"""
+        return value.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+    @staticmethod
+    def parse_watermark(text: str) -> datetime:
+        """قراءة العلامة من رابط التصدير؛ تقبل Z والإزاحة التي تحولت فيها '+' إلى مسافة"""
+        value = text.strip().replace(" ", "+")
+        if value.endswith(("Z", "z")):
+            value = value[:-1] + "+00:00"
+        parsed = datetime.fromisoformat(value)
+        return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+    @staticmethod
+    def _table_columns(cur, table: str) -> List[str]:
+        # الأعمدة المحسوبة (GENERATED) لا تُصدّر ولا تقبل الإدخال
+        cur.execute("""
+            SELECT column_name FROM information_schema.columns
+            WHERE table_schema = 'public' AND table_name = %s AND is_generated = 'NEVER'
+            ORDER BY ordinal_position
+        """, (table,))
+        return [r[0] for r in cur.fetchall()]
+
+    @staticmethod
+    def _user_columns(cur, table: str) -> List[str]:
+        """أعمدة الجدول التي تشير إلى users(id)؛ جدول المستخدمين لا يُنسخ (كلمات المرور) فقد لا يوجد المعرف هنا"""
+        cur.execute("""
+            SELECT a.attname FROM pg_constraint c
+            JOIN pg_attribute a ON a.attrelid = c.conrelid AND a.attnum = ANY(c.conkey)
+            WHERE c.contype = 'f' AND c.conrelid = %s::regclass AND c.confrelid = 'public.users'::regclass
+        """, (f'public."{table}"',))
+        return [r[0] for r in cur.fetchall()]
+
+    # =======================================================
+    # 2. التصدير
+    # =======================================================
+    @classmethod
+    def iter_export(cls, since: Optional[datetime] = None) -> Iterator[str]:
+        """
+        مولّد التغييرات منذ since (أو كل الصفوف إن لم تُحدد) من لقطة واحدة متسقة (REPEATABLE READ).
+        أول عنصر هو الترويسة وفيها العلامة الجديدة.
+        """
+        with get_db_context() as conn:
+            conn.set_session(isolation_level=extensions.ISOLATION_LEVEL_REPEATABLE_READ, readonly=True)
+            with conn.cursor() as meta_cur:
+                # المعاملات الجارية قد تحفظ لاحقاً صفوفاً بـ updated_at أقدم من الآن (NOW = بداية المعاملة)،
+                # فالعلامة هي الأقدم بين الآن وبداية أي معاملة مفتوحة حتى لا يفوت التصدير القادم شيئاً
+                meta_cur.execute("""
+                    SELECT NOW(), (
+                        SELECT MIN(xact_start) FROM pg_stat_activity
+                        WHERE datname = current_database() AND pid <> pg_backend_pid() AND xact_start IS NOT NULL
+                    )
+                """)
+                snapshot_at, oldest_open = meta_cur.fetchone()
+                watermark = min(snapshot_at, oldest_open) if oldest_open else snapshot_at
+
+                tables: List[Tuple[str, str, List[str]]] = []
+                for table, key in SYNC_TABLES:
+                    columns = cls._table_columns(meta_cur, table)
+                    if columns and "updated_at" in columns:
+                        tables.append((table, key, columns))
+
+                yield cls._dump({
+                    "format": cls.FORMAT, "version": cls.VERSION,
+                    "since": since and cls.format_watermark(since), "watermark": cls.format_watermark(watermark),
+                    "tables": [t for t, _, _ in tables],
+                })
+
+                total_rows = 0
+                for table, key, columns in tables:
+                    column_list = ", ".join(f'"{c}"' for c in columns)
+                    with conn.cursor(name=f"delta_{table}") as cur:
+                        cur.itersize = FamilyService.EXPORT_FETCH_SIZE
+                        cur.execute(f"""
+                            SELECT {column_list} FROM "{table}"
+                            WHERE %(since)s::timestamptz IS NULL OR updated_at >= %(since)s
+                            ORDER BY "{key}"
+                        """, {"since": since})
+                        while True:
+                            rows = cur.fetchmany(cls.CHUNK_ROWS)
+                            if not rows:
+                                break
+                            total_rows += len(rows)
+                            yield "".join(cls._dump({"t": table, "op": "upsert", "row": dict(zip(columns, row))})
+                                          for row in rows)
+
+                # الشواهد بترتيب عكسي للجداول: الجداول الفرعية تُحذف قبل الأصلية
+                deleted = 0
+                if since is not None:
+                    meta_cur.execute("""
+                        SELECT table_name, row_key FROM sync_tombstones
+                        WHERE deleted_at >= %s AND table_name = ANY(%s)
+                        ORDER BY array_position(%s, table_name) DESC, row_key
+                    """, (since, [t for t, _, _ in tables], [t for t, _, _ in tables]))
+                    tombstones = meta_cur.fetchall()
+                    deleted = len(tombstones)
+                    for start in range(0, deleted, cls.CHUNK_ROWS):
+                        yield "".join(cls._dump({"t": t, "op": "delete", "key": k})
+                                      for t, k in tombstones[start:start + cls.CHUNK_ROWS])
+
+                yield cls._dump({"end": True, "rows": total_rows, "deleted": deleted})
+            conn.rollback()
+
+    # =======================================================
+    # 3. التطبيق على نسخة أخرى
+    # =======================================================
+    @staticmethod
+    def _clear_missing_users(cur, user_columns: List[str], rows: List[Dict[str, Any]]) -> None:
+        """تصفير معرفات المستخدمين غير الموجودين في هذه النسخة بدل فشل المفتاح الأجنبي (كـ ON DELETE SET NULL)"""
+        ids = {row[c] for row in rows for c in user_columns if row.get(c) is not None}
+        if not ids:
+            return
+        cur.execute("SELECT id FROM users WHERE id = ANY(%s)", (list(ids),))
+        existing = {r[0] for r in cur.fetchall()}
+        for row in rows:
+            for column in user_columns:
+                if row.get(column) is not None and row[column] not in existing:
+                    row[column] = None
+
+    @classmethod
+    def _flush_upserts(cls, cur, table: str, key: str, target_columns: List[str], rows: List[Dict[str, Any]], codec: str,
+                       user_columns: List[str]) -> None:
+        if user_columns:
+            cls._clear_missing_users(cur, user_columns, rows)
+        columns = [c for c in target_columns if c in rows[0]]
+        column_list = ", ".join(f'"{c}"' for c in columns)
+        placeholders = "(" + ", ".join(["%s"] * len(columns)) + ")"
+        updates = ", ".join(f'"{c}" = EXCLUDED."{c}"' for c in columns if c != key) or f'"{key}" = EXCLUDED."{key}"'
+        values = ",\n".join(
+            cur.mogrify(placeholders, [Json(row.get(c)) if isinstance(row.get(c), (dict, list)) else row.get(c)
+                                       for c in columns]).decode(codec)
+            for row in rows
+        )
+        cur.execute(f'INSERT INTO "{table}" ({column_list}) VALUES {values} ON CONFLICT ("{key}") DO UPDATE SET {updates}')
+
+    @classmethod
+    def apply(cls, lines: Iterable[str]) -> Dict[str, Any]:
+        """تطبيق ملف تغييرات بمعاملة واحدة؛ أي خطأ يلغي التطبيق كاملاً"""
+        keys = dict(SYNC_TABLES)
+        lines = iter(lines)
+        header = json.loads(next(lines, "") or "{}")
+        if header.get("format") != cls.FORMAT or header.get("version") != cls.VERSION:
+            raise ValueError("الملف ليس ملف تغييرات صالحاً لهذا الموقع")
+
+        upserted, deleted = 0, 0
+        touched_tables = set()
+        family_codes, removed_codes = set(), set()
+        finished = False
+
+        with get_db_context() as conn:
+            codec = extensions.encodings.get(conn.encoding, "utf-8")
+            with conn.cursor() as cur:
+                try:
+                    # الصفوف تأتي بقيمها النهائية (ومنها family_search)، فلا حاجة لـ Triggers صفاً بصف
+                    cur.execute("SET LOCAL hottiyya.bulk_import = 'on'")
+                    columns_cache: Dict[str, List[str]] = {}
+                    user_columns_cache: Dict[str, List[str]] = {}
+                    batch_table, batch = None, []
+                    pending_deletes: Dict[str, List[str]] = {}
+
+                    def flush():
+                        nonlocal batch
+                        if batch:
+                            cls._flush_upserts(cur, batch_table, keys[batch_table], columns_cache[batch_table], batch, codec,
+                                               user_columns_cache[batch_table])
+                            batch = []
+
+                    for line in lines:
+                        if not line.strip():
+                            continue
+                        change = json.loads(line)
+                        if change.get("end"):
+                            finished = True
+                            break
+                        table = change.get("t")
+                        if table not in keys:
+                            raise ValueError(f"جدول غير مدعوم في ملف التغييرات: {table}")
+                        if table not in columns_cache:
+                            columns_cache[table] = cls._table_columns(cur, table)
+                            user_columns_cache[table] = cls._user_columns(cur, table)
+
+                        if change["op"] == "upsert":
+                            if table != batch_table or len(batch) >= cls.CHUNK_ROWS:
+                                flush()
+                                batch_table = table
+                            batch.append(change["row"])
+                            upserted += 1
+                            if table == "family_name":
+                                family_codes.add(change["row"]["code"])
+                        elif change["op"] == "delete":
+                            pending_deletes.setdefault(table, []).append(change["key"])
+                            if table == "family_name":
+                                removed_codes.add(change["key"])
+                        touched_tables.add(table)
+                    flush()
+
+                    # الحذف بعد كل الإدخالات وبترتيب ورود الجداول في الملف (الفرعية أولاً)
+                    for table, row_keys in pending_deletes.items():
+                        cur.execute(f'DELETE FROM "{table}" WHERE "{keys[table]}"::text = ANY(%s)', (row_keys,))
+                        deleted += cur.rowcount
+
+                    if not finished:
+                        raise ValueError("ملف التغييرات ناقص (لا توجد خاتمة)")
+
+                    # مزامنة المتسلسلات بعد إدخال معرفات صريحة، ورفع عدادات الأكواد مرة واحدة
+                    for table in touched_tables:
+                        if keys[table] == "id":
+                            cur.execute(f"""
+                                SELECT setval(seq::regclass, GREATEST((SELECT MAX(id) FROM "{table}"), 1))
+                                FROM pg_get_serial_sequence(%s, 'id') AS seq WHERE seq IS NOT NULL
+                            """, (table,))
+                    if family_codes:
+                        cur.execute(r"""
+                            INSERT INTO family_code_counters (prefix, last_value)
+                            SELECT substring(code from '^(.*-)\d+$'), MAX(substring(code from '(\d+)$')::int)
+                            FROM unnest(%s::text[]) AS code
+                            WHERE code ~ '^.*-\d+$'
+                            GROUP BY 1
+                            ON CONFLICT (prefix) DO UPDATE
+                                SET last_value = GREATEST(family_code_counters.last_value, EXCLUDED.last_value)
+                        """, (list(family_codes),))
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+
+        if touched_tables & cls.FAMILY_TABLES:
+            FamilyService.notify_family_changed(list(family_codes - removed_codes), removed=list(removed_codes))
+        print(f"🔁 تم تطبيق التغييرات: {upserted} صف محدّث، {deleted} صف محذوف.")
+        return {"upserted": upserted, "deleted": deleted, "watermark": header.get("watermark")}
@@ -0,0 +1,121 @@
+# demographics_service.py
+import time
+import threading
+from datetime import date
+from typing import Dict, Any, Optional
+from psycopg2.extras import RealDictCursor
+
+from postgresql import get_db_context
+
+
+class DemographicsService:
+    """
+    إحصائيات العائلة (الأجيال، الجنس، الأحياء والمتوفين، الفئات العمرية، أماكن الميلاد).
+    تُقرأ من العرض المادي family_demographics الصغير بدل مسح family_name كاملاً مع كل زيارة،
+    ويُحدّث العرض بشكل متزامن (CONCURRENTLY) بعد عمليات الكتابة مع تجميع التحديثات المتتالية.
+    """
+    REFRESH_DELAY_SECONDS = 5   # تجميع عدة عمليات كتابة متتالية في تحديث واحد
+    # الملخص المخزن في الذاكرة يُبطل فقط في العملية التي حدّثت العرض؛ بقية الـ workers تعيد قراءته بعد هذه المدة
+    SUMMARY_TTL_SECONDS = 30
+    TOP_PLACES = 10
+    AGE_BANDS = ["0-17", "18-39", "40-59", "60+", "غير معروف"]
+
+    _lock = threading.Lock()
+    _timer: Optional[threading.Timer] = None
+    _summary: Optional[Dict[str, Any]] = None
+    _summary_at = 0.0
+    _refreshed_on: Optional[date] = None
+    _version = 0  # يزداد مع كل تحديث حتى لا يُخزن ملخص قُرئ قبل التحديث
+
+    # =======================================================
+    # 1. تحديث العرض المادي
+    # =======================================================
+    @classmethod
+    def refresh(cls) -> None:
+        try:
+            with get_db_context() as conn:
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY family_demographics")
+            with cls._lock:
+                cls._summary = None
+                cls._version += 1
+                cls._refreshed_on = date.today()
+        except Exception as e:
+            print(f"⚠️ تعذر تحديث إحصائيات العائلة: {e}")
+
+    @classmethod
+    def schedule_refresh(cls) -> None:
+        """جدولة تحديث مؤجل؛ أي كتابة جديدة خلال فترة الانتظار تُدمج في نفس التحديث"""
+        with cls._lock:
+            if cls._timer is not None:
+                return
+            timer = threading.Timer(cls.REFRESH_DELAY_SECONDS, cls._run_scheduled)
+            timer.daemon = True
+            cls._timer = timer
+        timer.start()
+
+    @classmethod
+    def _run_scheduled(cls) -> None:
+        with cls._lock:
+            cls._timer = None
+        cls.refresh()
+
+    # =======================================================
+    # 2. قراءة الملخص
+    # =======================================================
+    @classmethod
+    def get_summary(cls) -> Dict[str, Any]:
+        with cls._lock:
+            summary = cls._summary
+            if summary is not None and time.monotonic() - cls._summary_at > cls.SUMMARY_TTL_SECONDS:
+                summary = None
+            version = cls._version
+            stale_day = cls._refreshed_on != date.today()
+        if stale_day:
+            # الفئات العمرية تتغير مع الأيام: تحديث يومي في الخلفية
+            cls.schedule_refresh()
+        if summary is not None:
+            return summary
+
+        with get_db_context() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute("SELECT level, gender, is_alive, age_band, p_o_b, members FROM family_demographics")
+                rows = cur.fetchall()
+
+        by_level: Dict[int, Dict[str, int]] = {}
+        by_gender: Dict[str, int] = {}
+        by_age_band = {band: 0 for band in cls.AGE_BANDS}
+        by_place: Dict[str, int] = {}
+        total = living = 0
+        for row in rows:
+            count = row["members"]
+            total += count
+            if row["is_alive"]:
+                living += count
+            level = by_level.setdefault(row["level"], {"total": 0, "living": 0})
+            level["total"] += count
+            if row["is_alive"]:
+                level["living"] += count
+            by_gender[row["gender"]] = by_gender.get(row["gender"], 0) + count
+            by_age_band[row["age_band"]] = by_age_band.get(row["age_band"], 0) + count
+            by_place[row["p_o_b"]] = by_place.get(row["p_o_b"], 0) + count
+
+        summary = {
+            "total": total,
+            "living": living,
+            "deceased": total - living,
+            "generations": len([lvl for lvl in by_level if lvl > 0]),
+            "by_level": [{"level": lvl, **counts} for lvl, counts in sorted(by_level.items())],
+            "by_gender": by_gender,
+            "by_age_band": by_age_band,
+            "top_places": [
+                {"place": place, "members": count}
+                for place, count in sorted(by_place.items(), key=lambda item: -item[1])[:cls.TOP_PLACES]
+            ],
+        }
+        with cls._lock:
+            if cls._version == version:
+                cls._summary = summary
+                cls._summary_at = time.monotonic()
+        return summary
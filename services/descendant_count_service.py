@@ -0,0 +1,242 @@
+# descendant_count_service.py
+import sys
+from typing import Dict, Any, List
+
+from postgresql import get_db_context
+
+
+class DescendantCountService:
+    """
+    أعداد الذرية المحفوظة في family_search (الإجمالي، الأحياء، لكل جيل) حتى تُعرض بدون استعلام عودي.
+    - begin_change / finish_change: تُستدعيان داخل معاملة الكتابة في FamilyService قبل الحفظ وبعده،
+      فتُطبق على كل جد الفرق بين مساهمة فرع العضو قبل التعديل وبعده (الجيل = أقصر مسافة بين الجد والحفيد).
+    - verify: إعادة حساب كل الأعداد بمرور واحد على شجرة النسب ومقارنتها بالمحفوظ لكشف الانحراف وتصحيحه.
+    """
+    MAX_DEPTH = 64        # حد أمان يمنع الدوران اللانهائي لو وُجدت حلقة خاطئة في البيانات
+    DRIFT_SAMPLE = 20     # عدد الأعضاء المنحرفين المعروضين في التقرير
+
+    ALIVE_SQL = "(a.d_o_d IS NULL AND COALESCE(i.status, '') NOT IN ('متوفي', 'متوفية'))"
+    DECEASED = ("متوفي", "متوفية")
+
+    # =======================================================
+    # 1. التحديث التزايدي على مسار الأصول
+    # =======================================================
+    @classmethod
+    def signature(cls, cur, code: str):
+        """ما يؤثر في أعداد الأصول من بيانات العضو: الأب، الأم، وهل هو حي"""
+        cur.execute(f"""
+            SELECT n.f_code, n.m_code, {cls.ALIVE_SQL}
+            FROM family_name n
+            LEFT JOIN family_info i ON i.code_info = n.code
+            LEFT JOIN family_age_search a ON a.code = n.code
+            WHERE n.code = %s
+        """, (code,))
+        row = cur.fetchone()
+        return tuple(row) if row else None
+
+    @classmethod
+    def signature_of(cls, data: Dict[str, Any]):
+        """نفس البصمة محسوبة من بيانات النموذج قبل الحفظ"""
+        def clean(value):
+            return value if value not in ("", None) else None
+        alive = clean(data.get("d_o_d")) is None and (clean(data.get("status")) or "") not in cls.DECEASED
+        return clean(data.get("f_code")), clean(data.get("m_code")), alive
+
+    @classmethod
+    def _snapshot(cls, cur, table: str) -> None:
+        """
+        مساهمة عقد الفرع (descendant_change_nodes) في أعداد أصولها: لكل (جد، حفيد) صف واحد بأقصر مسافة
+        وهل الحفيد حي. الحفيد الذي يصل إلى الجد من طريقين (زواج الأقارب) يُحسب مرة واحدة.
+        """
+        cur.execute(f"""
+            CREATE TEMP TABLE {table} ON COMMIT DROP AS
+            WITH RECURSIVE up(code, ancestor, dist) AS (
+                SELECT x.code, p.code, 1 FROM descendant_change_nodes x
+                JOIN family_name n ON n.code = x.code
+                JOIN family_name p ON p.code IN (n.f_code, n.m_code)
+                UNION
+                SELECT u.code, p.code, u.dist + 1 FROM up u
+                JOIN family_name n ON n.code = u.ancestor
+                JOIN family_name p ON p.code IN (n.f_code, n.m_code)
+                WHERE u.dist < %(max_depth)s
+            )
+            SELECT u.ancestor, u.code, MIN(u.dist) AS dist, {cls.ALIVE_SQL} AS alive
+            FROM up u
+            LEFT JOIN family_info i ON i.code_info = u.code
+            LEFT JOIN family_age_search a ON a.code = u.code
+            WHERE u.ancestor <> u.code
+            GROUP BY u.ancestor, u.code, a.d_o_d, i.status
+        """, {"max_depth": cls.MAX_DEPTH})
+
+    @staticmethod
+    def _collect_nodes(cur, code: str) -> None:
+        """إضافة العضو وكل ذريته الحالية إلى عقد الفرع المتأثر (UNION يوقف الاستعلام عند الحلقات)"""
+        cur.execute("""
+            INSERT INTO descendant_change_nodes (code)
+            WITH RECURSIVE sub(code) AS (
+                SELECT %(code)s::text
+                UNION
+                SELECT n.code FROM family_name n
+                JOIN sub s ON s.code IN (n.f_code, n.m_code)
+            )
+            SELECT code FROM sub
+            EXCEPT SELECT code FROM descendant_change_nodes
+        """, {"code": code})
+
+    @classmethod
+    def begin_change(cls, cur, code: str) -> None:
+        """
+        تُستدعى قبل إضافة العضو أو حذفه أو تغيير أبيه/أمه/حالته: تحفظ مساهمة فرعه الحالية في أعداد أصوله.
+        تغيير روابط العضو لا يغيّر إلا أصول فرعه هو، فلا حاجة لإعادة حساب غيره.
+        """
+        cur.execute("DROP TABLE IF EXISTS descendant_change_nodes, descendant_change_old, descendant_change_new")
+        cur.execute("CREATE TEMP TABLE descendant_change_nodes (code text PRIMARY KEY) ON COMMIT DROP")
+        cls._collect_nodes(cur, code)
+        cls._snapshot(cur, "descendant_change_old")
+
+    @classmethod
+    def finish_change(cls, cur, code: str) -> None:
+        """
+        تُستدعى بعد الحفظ في نفس المعاملة: تحسب مساهمة الفرع الجديدة وتطبق الفرق فقط على كل جد.
+        الفرق محسوب لكل (جد، حفيد) وليس بطرح الفرع كاملاً، فالحفيد الذي بقي له طريق آخر إلى الجد
+        (عبر أمه مثلاً في زواج الأقارب) لا يُطرح، ويُنقل جيله إلى أقصر مسافة متبقية.
+        """
+        cls._collect_nodes(cur, code)
+        cls._snapshot(cur, "descendant_change_new")
+        cur.execute("""
+            WITH diff AS (
+                SELECT ancestor, dist,
+                       SUM(side) AS members,
+                       COALESCE(SUM(side) FILTER (WHERE alive), 0) AS living
+                FROM (
+                    SELECT ancestor, dist, alive, -1 AS side FROM descendant_change_old
+                    UNION ALL
+                    SELECT ancestor, dist, alive, 1 FROM descendant_change_new
+                ) parts
+                GROUP BY ancestor, dist
+                HAVING SUM(side) <> 0 OR COALESCE(SUM(side) FILTER (WHERE alive), 0) <> 0
+            ),
+            delta AS (
+                SELECT ancestor AS code,
+                       SUM(members)::int AS members,
+                       SUM(living)::int AS living,
+                       jsonb_object_agg(dist::text, members) FILTER (WHERE members <> 0) AS by_generation
+                FROM diff
+                GROUP BY ancestor
+            )
+            UPDATE family_search fs SET
+                descendants_total = fs.descendants_total + d.members,
+                descendants_living = fs.descendants_living + d.living,
+                descendants_by_generation = public.add_generation_counts(fs.descendants_by_generation, d.by_generation, 1),
+                updated_at = NOW()
+            FROM delta d
+            WHERE fs.code = d.code
+        """)
+        cur.execute("DROP TABLE descendant_change_nodes, descendant_change_old, descendant_change_new")
+
+    # =======================================================
+    # 2. التحقق وإعادة الحساب الكاملة
+    # =======================================================
+    @classmethod
+    def _build_expected(cls, cur) -> None:
+        """الأعداد الصحيحة لكل الأعضاء من إغلاق شجرة النسب (Closure) في مرور واحد"""
+        cur.execute(f"""
+            CREATE TEMP TABLE descendant_counts_expected ON COMMIT DROP AS
+            WITH RECURSIVE closure(ancestor, code, dist) AS (
+                SELECT p.code, n.code, 1 FROM family_name n
+                JOIN family_name p ON p.code IN (n.f_code, n.m_code)
+                UNION
+                SELECT c.ancestor, n.code, c.dist + 1 FROM closure c
+                JOIN family_name n ON c.code IN (n.f_code, n.m_code)
+                WHERE c.dist < %(max_depth)s
+            ),
+            nearest AS (
+                SELECT ancestor, code, MIN(dist) AS dist FROM closure
+                WHERE ancestor <> code
+                GROUP BY ancestor, code
+            ),
+            per_generation AS (
+                SELECT ne.ancestor, ne.dist, COUNT(*) AS members, COUNT(*) FILTER (WHERE {cls.ALIVE_SQL}) AS living
+                FROM nearest ne
+                LEFT JOIN family_info i ON i.code_info = ne.code
+                LEFT JOIN family_age_search a ON a.code = ne.code
+                GROUP BY ne.ancestor, ne.dist
+            )
+            SELECT ancestor AS code,
+                   SUM(members)::int AS total,
+                   SUM(living)::int AS living,
+                   jsonb_object_agg(dist::text, members) AS by_generation
+            FROM per_generation
+            GROUP BY ancestor
+        """, {"max_depth": cls.MAX_DEPTH})
+        cur.execute("CREATE INDEX ON descendant_counts_expected (code)")
+
+    DRIFT_CONDITION = """
+        (fs.descendants_total, fs.descendants_living, fs.descendants_by_generation)
+        IS DISTINCT FROM (COALESCE(e.total, 0), COALESCE(e.living, 0), COALESCE(e.by_generation, '{}'::jsonb))
+    """
+
+    @classmethod
+    def _fix_drift(cls, cur) -> int:
+        cur.execute(f"""
+            UPDATE family_search fs SET
+                descendants_total = COALESCE(e.total, 0),
+                descendants_living = COALESCE(e.living, 0),
+                descendants_by_generation = COALESCE(e.by_generation, '{{}}'::jsonb),
+                updated_at = NOW()
+            FROM family_search base
+            LEFT JOIN descendant_counts_expected e ON e.code = base.code
+            WHERE fs.code = base.code AND {cls.DRIFT_CONDITION}
+        """)
+        return cur.rowcount
+
+    @classmethod
+    def recompute(cls, cur) -> int:
+        """تصحيح كل الأعداد داخل معاملة قائمة (مثلاً بعد الاستيراد الجماعي) وإرجاع عدد الصفوف المصححة"""
+        cls._build_expected(cur)
+        return cls._fix_drift(cur)
+
+    @classmethod
+    def verify(cls, fix: bool = False) -> Dict[str, Any]:
+        """مقارنة الأعداد المحفوظة بإعادة حساب كاملة؛ fix=True يصحح الانحراف في نفس المعاملة"""
+        with get_db_context() as conn:
+            with conn.cursor() as cur:
+                try:
+                    cls._build_expected(cur)
+                    cur.execute(f"""
+                        SELECT COUNT(*) FROM family_search fs
+                        LEFT JOIN descendant_counts_expected e ON e.code = fs.code
+                        WHERE {cls.DRIFT_CONDITION}
+                    """)
+                    drifted = cur.fetchone()[0]
+                    cur.execute(f"""
+                        SELECT fs.code, fs.descendants_total, COALESCE(e.total, 0),
+                               fs.descendants_living, COALESCE(e.living, 0)
+                        FROM family_search fs
+                        LEFT JOIN descendant_counts_expected e ON e.code = fs.code
+                        WHERE {cls.DRIFT_CONDITION}
+                        ORDER BY fs.code
+                        LIMIT %s
+                    """, (cls.DRIFT_SAMPLE,))
+                    sample: List[Dict[str, Any]] = [
+                        {"code": r[0], "stored_total": r[1], "expected_total": r[2],
+                         "stored_living": r[3], "expected_living": r[4]}
+                        for r in cur.fetchall()
+                    ]
+                    fixed = 0
+                    if fix and drifted:
+                        fixed = cls._fix_drift(cur)
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+        return {"drifted": drifted, "fixed": fixed, "sample": sample}
+
+
+if __name__ == "__main__":
+    # python -m services.descendant_count_service [--fix]
+    report = DescendantCountService.verify(fix="--fix" in sys.argv[1:])
+    print(f"🔎 أعضاء بأعداد ذرية منحرفة: {report['drifted']} (تم تصحيح {report['fixed']})")
+    for row in report["sample"]:
+        print(f"  {row['code']}: المحفوظ {row['stored_total']}/{row['stored_living']} "
+              f"← الصحيح {row['expected_total']}/{row['expected_living']}")
@@ -0,0 +1,89 @@
+# drive_service.py
+import os
+import threading
+from datetime import datetime, timedelta
+
+import httplib2
+import google_auth_httplib2
+from google.oauth2.credentials import Credentials
+from google.auth.exceptions import RefreshError
+from google.auth.transport.requests import Request
+from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+
+
+class DriveService:
+    """
+    مصنع موحد وآمن للخيوط (Thread-safe) لعميل Google Drive.
+    - الصلاحيات تُقرأ من token.json مرة واحدة وتُحدّث استباقياً قبل انتهائها.
+    - وثيقة الـ Discovery مضمنة في المكتبة (static_discovery) فلا تُجلب من الشبكة مع كل طلب.
+    - لكل خيط عميل خاص يُعاد استخدامه لأن httplib2 غير آمن للمشاركة بين الخيوط.
+    """
+    SCOPES = ['https://www.googleapis.com/auth/drive.file']
+    TOKEN_FILE = 'token.json'
+    HTTP_TIMEOUT = 120
+    REFRESH_MARGIN = timedelta(minutes=5)  # تحديث التوكن قبل انتهائه بخمس دقائق
+
+    _creds_lock = threading.Lock()
+    _creds: Credentials = None
+    _generation = 0  # يزداد عند إعادة التهيئة حتى تعيد كل الخيوط بناء عملائها
+    _local = threading.local()
+
+    @classmethod
+    def get_credentials(cls) -> Credentials:
+        with cls._creds_lock:
+            if cls._creds is None:
+                if not os.path.exists(cls.TOKEN_FILE):
+                    raise FileNotFoundError(f"ملف الصلاحيات {cls.TOKEN_FILE} غير موجود!")
+                cls._creds = Credentials.from_authorized_user_file(cls.TOKEN_FILE, cls.SCOPES)
+
+            creds = cls._creds
+            # expiry في مكتبة google-auth بتوقيت UTC بدون منطقة زمنية
+            expiring = creds.expiry is None or creds.expiry - cls.REFRESH_MARGIN <= datetime.utcnow()
+            if (not creds.valid or expiring) and creds.refresh_token:
+                creds.refresh(Request())
+                with open(cls.TOKEN_FILE, 'w') as token:
+                    token.write(creds.to_json())
+            return creds
+
+    @classmethod
+    def get_service(cls, fresh: bool = False):
+        """إرجاع عميل Drive الخاص بالخيط الحالي (fresh=True لإعادة إنشاء الاتصال بعد أخطاء الشبكة)"""
+        creds = cls.get_credentials()
+        service = getattr(cls._local, "service", None)
+        if service is None or fresh or getattr(cls._local, "generation", None) != cls._generation:
+            http_transport = httplib2.Http(timeout=cls.HTTP_TIMEOUT)
+            http_transport.follow_redirects = False
+            authorized_http = google_auth_httplib2.AuthorizedHttp(creds, http=http_transport)
+            service = build('drive', 'v3', http=authorized_http, static_discovery=True, cache_discovery=False)
+            cls._local.service = service
+            cls._local.generation = cls._generation
+        return service
+
+    @classmethod
+    def reset(cls) -> None:
+        """إسقاط الصلاحيات المخزنة لإعادة قراءة token.json (مثلاً بعد تجديده يدوياً)"""
+        with cls._creds_lock:
+            cls._creds = None
+            cls._generation += 1
+
+    @staticmethod
+    def is_auth_error(error: Exception) -> bool:
+        """هل الخطأ من الصلاحيات (توكن مرفوض أو فشل تجديده) لا من الشبكة"""
+        if isinstance(error, RefreshError):
+            return True
+        return isinstance(error, HttpError) and getattr(error.resp, "status", None) == 401
+
+    @classmethod
+    def recover(cls, error: Exception) -> bool:
+        """
+        معالجة فشل طلب Drive داخل حلقات إعادة المحاولة:
+        خطأ صلاحيات -> reset() لإعادة قراءة token.json في كل الخيوط؛ غير ذلك -> اتصال جديد للخيط الحالي.
+        يعيد True إن كان الخطأ من الصلاحيات.
+        """
+        if cls.is_auth_error(error):
+            print(f"🔑 رُفضت صلاحيات Google Drive، ستُعاد قراءة {cls.TOKEN_FILE}: {error}")
+            cls.reset()
+            return True
+        cls.get_service(fresh=True)
+        return False
@@ -0,0 +1,228 @@
+# duplicate_service.py
+from collections import defaultdict
+from datetime import date
+from itertools import combinations
+from typing import List, Dict, Optional, Any, Tuple, Iterable
+from psycopg2.extras import RealDictCursor
+
+from utils.normalize import fold_arabic
+from postgresql import get_db_context
+from services.name_index_service import NameIndexService
+
+
+class DuplicateService:
+    """
+    كشف الأعضاء المكررين المحتملين (نفس الاسم الموحد، نفس الأب أو الأم، تواريخ ميلاد متقاربة).
+    بدل مقارنة كل عضو بكل عضو (O(n²)) يُوزع الأعضاء على "كتل" بمفاتيح تجميع:
+      - الأب + أول حرفين من الاسم الموحد، الأم + أول حرفين، أو سلسلة النسب الكاملة الموحدة.
+    ثم تُقارن الأزواج داخل كل كتلة فقط بدرجة تقريبية، فيبقى المسح الكامل قريباً من الخطي.
+    النتائج تُحفظ في family_duplicate_candidates لمراجعة الإدارة.
+    """
+    MIN_SCORE = 0.7            # أقل درجة لاعتبار العضوين مكررين محتملين
+    MIN_NAME_SIMILARITY = 0.6  # تشابه الاسم الأدنى قبل احتساب باقي القرائن
+    MAX_BLOCK_SIZE = 200       # الكتل الأكبر (أسماء شائعة جداً بلا أب) تُتخطى لحماية زمن المسح
+    PREFIX_LEN = 2
+
+    MEMBER_QUERY = """
+        SELECT n.code, n.name, n.f_code, n.m_code, i.gender, a.d_o_b, fs.full_name
+        FROM family_name n
+        LEFT JOIN family_info i ON i.code_info = n.code
+        LEFT JOIN family_age_search a ON a.code = n.code
+        LEFT JOIN family_search fs ON fs.code = n.code
+    """
+
+    # =======================================================
+    # 1. مفاتيح التجميع والتقييم
+    # =======================================================
+    @staticmethod
+    def _folded(text: Optional[str]) -> str:
+        return "".join((fold_arabic(text or "") or "").split())
+
+    @classmethod
+    def blocking_keys(cls, row: Dict[str, Any]) -> List[Tuple[str, str]]:
+        name = cls._folded(row.get("name"))
+        if not name:
+            return []
+        prefix = name[:cls.PREFIX_LEN]
+        keys = []
+        if row.get("f_code"):
+            keys.append(("f", f"{row['f_code']}:{prefix}"))
+        if row.get("m_code"):
+            keys.append(("m", f"{row['m_code']}:{prefix}"))
+        # سلسلة النسب تجمع المكررين حتى لو رُبط كل منهما بنسخة مختلفة من الأب
+        lineage = (fold_arabic(row.get("full_name") or "") or "").split()
+        if len(lineage) >= 2:
+            keys.append(("l", " ".join(lineage)))
+        return keys
+
+    @classmethod
+    def score_pair(cls, a: Dict[str, Any], b: Dict[str, Any]) -> Optional[Tuple[float, List[str]]]:
+        """درجة التكرار بين عضوين من نفس الكتلة مع أسبابها، أو None إن كانا شخصين مختلفين بوضوح"""
+        if a.get("gender") and b.get("gender") and a["gender"] != b["gender"]:
+            return None
+
+        name_sim = NameIndexService.token_similarity(cls._folded(a.get("name")), cls._folded(b.get("name")))
+        if name_sim < cls.MIN_NAME_SIMILARITY:
+            return None
+        score = 0.5 * name_sim
+        reasons = ["نفس الاسم" if name_sim == 1.0 else "اسم متشابه"]
+
+        for column, weight, label in (("f_code", 0.2, "نفس الأب"), ("m_code", 0.15, "نفس الأم")):
+            if a.get(column) and b.get(column):
+                if a[column] == b[column]:
+                    score += weight
+                    reasons.append(label)
+                else:
+                    score -= weight
+
+        lineage_a = " ".join((fold_arabic(a.get("full_name") or "") or "").split())
+        lineage_b = " ".join((fold_arabic(b.get("full_name") or "") or "").split())
+        if lineage_a and lineage_a == lineage_b and len(lineage_a.split()) >= 2:
+            score += 0.15
+            reasons.append("نفس سلسلة النسب")
+
+        dob_a, dob_b = a.get("d_o_b"), b.get("d_o_b")
+        if isinstance(dob_a, date) and isinstance(dob_b, date):
+            gap = abs((dob_a - dob_b).days)
+            if gap > 730:
+                return None  # إخوة بنفس الاسم (مثلاً سُمّي على أخ متوفى)
+            if gap <= 31:
+                score += 0.15
+                reasons.append("تاريخ ميلاد متقارب")
+            elif gap <= 366:
+                score += 0.05
+
+        score = round(min(score, 1.0), 3)
+        if score < cls.MIN_SCORE:
+            return None
+        return score, reasons
+
+    @classmethod
+    def _find_pairs(cls, rows: Iterable[Dict[str, Any]], only_code: Optional[str] = None) -> Dict[Tuple[str, str], Tuple[float, str]]:
+        blocks: Dict[Tuple[str, str], List[Dict[str, Any]]] = defaultdict(list)
+        for row in rows:
+            for key in cls.blocking_keys(row):
+                blocks[key].append(row)
+
+        pairs: Dict[Tuple[str, str], Tuple[float, str]] = {}
+        skipped = 0
+        for members in blocks.values():
+            if len(members) < 2:
+                continue
+            if len(members) > cls.MAX_BLOCK_SIZE:
+                skipped += 1
+                continue
+            for a, b in combinations(members, 2):
+                if only_code and only_code not in (a["code"], b["code"]):
+                    continue
+                key = (a["code"], b["code"]) if a["code"] < b["code"] else (b["code"], a["code"])
+                if key[0] == key[1] or key in pairs:
+                    continue
+                result = cls.score_pair(a, b)
+                if result:
+                    pairs[key] = (result[0], "، ".join(result[1]))
+        if skipped:
+            print(f"⚠️ كشف التكرار: تم تخطي {skipped} كتلة كبيرة جداً (أكثر من {cls.MAX_BLOCK_SIZE} عضو).")
+        return pairs
+
+    @staticmethod
+    def _save_pairs(cur, pairs: Dict[Tuple[str, str], Tuple[float, str]]) -> None:
+        # الأزواج التي رفضتها الإدارة تبقى مرفوضة؛ تُحدّث درجتها فقط
+        cur.executemany("""
+            INSERT INTO family_duplicate_candidates (code_a, code_b, score, reasons)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT (code_a, code_b) DO UPDATE SET
+                score = EXCLUDED.score, reasons = EXCLUDED.reasons, detected_at = NOW()
+        """, [(a, b, score, reasons) for (a, b), (score, reasons) in pairs.items()])
+
+    # =======================================================
+    # 2. المسح الكامل والفحص التزايدي
+    # =======================================================
+    @classmethod
+    def scan(cls) -> int:
+        """مسح كل الأعضاء واستبدال قائمة المرشحين المعلقة بالنتيجة الجديدة"""
+        with get_db_context() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                try:
+                    cur.execute(cls.MEMBER_QUERY)
+                    pairs = cls._find_pairs(cur.fetchall())
+                    cur.execute("DELETE FROM family_duplicate_candidates WHERE status = 'pending'")
+                    cls._save_pairs(cur, pairs)
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+        print(f"🧬 كشف التكرار: {len(pairs)} زوج مرشح.")
+        return len(pairs)
+
+    @classmethod
+    def check_member(cls, code: str) -> int:
+        """فحص عضو جديد مقابل كتله فقط (نفس الأب أو الأم أو سلسلة النسب) عبر الفهارس الموجودة"""
+        clean_code = code.strip().upper()
+        with get_db_context() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                try:
+                    cur.execute(cls.MEMBER_QUERY + " WHERE n.code = %s", (clean_code,))
+                    member = cur.fetchone()
+                    if not member:
+                        return 0
+                    # كل فرع من الاتحاد يستخدم فهرسه (idx_family_name_f_code / m_code / idx_family_search_name)؛
+                    # الشرط OR على جدولين مختلفين بعد LEFT JOIN لا يستخدم أي فهرس ويمسح family_name كاملاً
+                    cur.execute(cls.MEMBER_QUERY + """
+                        WHERE n.code IN (
+                            SELECT code FROM family_name WHERE f_code = %(f_code)s
+                            UNION
+                            SELECT code FROM family_name WHERE m_code = %(m_code)s
+                            UNION
+                            SELECT code FROM family_search WHERE full_name = %(full_name)s
+                        )
+                          AND n.code <> %(code)s
+                    """, {"code": clean_code, "f_code": member["f_code"], "m_code": member["m_code"],
+                          "full_name": member["full_name"]})
+                    pairs = cls._find_pairs([member] + cur.fetchall(), only_code=clean_code)
+                    if pairs:
+                        cls._save_pairs(cur, pairs)
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+        return len(pairs)
+
+    # =======================================================
+    # 3. المراجعة
+    # =======================================================
+    @staticmethod
+    def list_candidates(limit: int = 200) -> List[Dict[str, Any]]:
+        with get_db_context() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute("""
+                    SELECT c.code_a, c.code_b, c.score, c.reasons, c.detected_at,
+                           sa.full_name AS name_a, sb.full_name AS name_b,
+                           aa.d_o_b AS d_o_b_a, ab.d_o_b AS d_o_b_b
+                    FROM family_duplicate_candidates c
+                    JOIN family_search sa ON sa.code = c.code_a
+                    JOIN family_search sb ON sb.code = c.code_b
+                    LEFT JOIN family_age_search aa ON aa.code = c.code_a
+                    LEFT JOIN family_age_search ab ON ab.code = c.code_b
+                    WHERE c.status = 'pending'
+                    ORDER BY c.score DESC, c.code_a, c.code_b
+                    LIMIT %s
+                """, (limit,))
+                return cur.fetchall()
+
+    @staticmethod
+    def dismiss(code_a: str, code_b: str) -> bool:
+        """تعليم الزوج كشخصين مختلفين حتى لا يظهر مرة أخرى في المسح القادم"""
+        first, second = sorted((code_a.strip().upper(), code_b.strip().upper()))
+        with get_db_context() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE family_duplicate_candidates SET status = 'dismissed'
+                    WHERE code_a = %s AND code_b = %s
+                """, (first, second))
+                conn.commit()
+                return cur.rowcount > 0
+
+    @staticmethod
+    def forget_member(cur, code: str) -> None:
+        cur.execute("DELETE FROM family_duplicate_candidates WHERE code_a = %s OR code_b = %s", (code, code))
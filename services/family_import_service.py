@@ -0,0 +1,413 @@
+# family_import_service.py
+import io
+import csv
+import codecs
+import html
+import re
+from datetime import date
+from typing import List, Dict, Optional, Any, Iterable, Iterator, Tuple
+
+from postgresql import get_db_context
+from services.family_service import FamilyService
+from services.descendant_count_service import DescendantCountService
+
+
+class _CsvRowStream(io.TextIOBase):
+    """ملف نصي للقراءة فقط يولّد أسطر CSV عند الطلب، ليمرَّر إلى COPY دون تحميل الملف كاملاً في الذاكرة"""
+
+    def __init__(self, rows: Iterable[List[Any]]):
+        self._rows = iter(rows)
+        self._buffer = ""
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> str:
+        while size < 0 or len(self._buffer) < size:
+            try:
+                row = next(self._rows)
+            except StopIteration:
+                break
+            out = io.StringIO()
+            csv.writer(out, lineterminator="\n").writerow(["" if v is None else v for v in row])
+            self._buffer += out.getvalue()
+        if size < 0:
+            chunk, self._buffer = self._buffer, ""
+        else:
+            chunk, self._buffer = self._buffer[:size], self._buffer[size:]
+        return chunk
+
+
+class FamilyImportService:
+    """
+    استيراد جماعي لأعضاء العائلة من ملفات CSV أو Excel:
+    1. تدفق الصفوف إلى جدول مرحلي مؤقت عبر COPY.
+    2. التحقق الجماعي بالـ SQL (تكرار الأكواد، مراجع الآباء والأزواج).
+    3. دمج الجداول الثلاثة في معاملة واحدة مع تعطيل الـ Triggers صفاً بصف.
+    4. إعادة بناء أسماء البحث للأعضاء المستوردين بعبارة واحدة في النهاية.
+    """
+    CODE_PATTERN = r"^[A-Z]\d{1,3}-\d{3}-\d{3}$"
+    COLUMNS = [
+        "code", "name", "f_code", "m_code", "w_code", "h_code", "relation", "level", "nick_name",
+        "gender", "d_o_b", "d_o_d", "email", "phone", "address", "p_o_b", "status",
+    ]
+    CODE_COLUMNS = ("code", "f_code", "m_code", "w_code", "h_code")
+    # مراجع داخل الملف نفسه (معرفات GEDCOM مثل @I12@) تُحل إلى أكواد بالـ SQL بعد التحميل
+    REF_COLUMNS = ("xref", "w_ref", "h_ref")
+    # حرف الأكواد المخصصة تلقائياً لأفراد GEDCOM الذين لا يحملون كوداً بصيغة الموقع في REFN
+    GENERATED_CODE_LETTER = "G"
+    # دعم عناوين الأعمدة بالعربية كما في ملف التصدير
+    HEADER_ALIASES = {
+        "الكود": "code", "الاسم": "name", "كود الأب": "f_code", "كود الأم": "m_code",
+        "كود الزوجة": "w_code", "كود الزوج": "h_code", "صلة القرابة": "relation", "الجيل": "level",
+        "اللقب": "nick_name", "الجنس": "gender", "تاريخ الميلاد": "d_o_b", "تاريخ الوفاة": "d_o_d",
+        "البريد": "email", "الهاتف": "phone", "العنوان": "address", "مكان الميلاد": "p_o_b", "الحالة": "status",
+    }
+    GENDERS = {"ذكر", "أنثى"}
+    STATUSES = {"حي", "حية", "متوفي", "متوفية"}
+    MAX_ERRORS = 50
+
+    # =======================================================
+    # 1. قراءة الملفات
+    # =======================================================
+    @classmethod
+    def _map_header(cls, header: List[Any]) -> List[Optional[str]]:
+        mapped = []
+        for title in header:
+            key = str(title or "").strip()
+            key = cls.HEADER_ALIASES.get(key, key.lower())
+            mapped.append(key if key in cls.COLUMNS else None)
+        if "code" not in mapped or "name" not in mapped:
+            raise ValueError("الملف يجب أن يحتوي على عمودي code و name على الأقل")
+        return mapped
+
+    @classmethod
+    def _rows_from_table(cls, table: Iterator[List[Any]]) -> Iterator[Dict[str, Any]]:
+        header = next(table, None)
+        if header is None:
+            return
+        columns = cls._map_header(list(header))
+        for values in table:
+            if not values or all(v is None or str(v).strip() == "" for v in values):
+                continue
+            yield {col: values[i] if i < len(values) else None for i, col in enumerate(columns) if col}
+
+    @classmethod
+    def read_csv(cls, binary_file) -> Iterator[Dict[str, Any]]:
+        # codecs بدل io.TextIOWrapper: ملف UploadFile هو SpooledTemporaryFile ولا يدعم readable() في Python 3.10
+        text = codecs.getreader("utf-8-sig")(binary_file)
+        return cls._rows_from_table(csv.reader(text))
+
+    @classmethod
+    def read_xlsx(cls, binary_file) -> Iterator[Dict[str, Any]]:
+        # استيراد متأخر: openpyxl مطلوب فقط لملفات Excel
+        from openpyxl import load_workbook
+
+        workbook = load_workbook(binary_file, read_only=True, data_only=True)
+        sheet = workbook.active
+        return cls._rows_from_table(list(row) for row in sheet.iter_rows(values_only=True))
+
+    # =======================================================
+    # 2. تنظيف الصفوف (تحقق الصيغ الذي لا يحتاج قاعدة البيانات)
+    # =======================================================
+    @staticmethod
+    def _clean_text(value: Any) -> Optional[str]:
+        if value is None:
+            return None
+        text = str(value).strip()
+        return text or None
+
+    @classmethod
+    def _clean_date(cls, value: Any) -> Tuple[Optional[str], bool]:
+        if isinstance(value, date):
+            return value.isoformat()[:10], True
+        text = cls._clean_text(value)
+        if not text:
+            return None, True
+        try:
+            return date.fromisoformat(text[:10]).isoformat(), True
+        except ValueError:
+            return None, False
+
+    @classmethod
+    def _normalize_row(cls, line: int, row: Dict[str, Any], errors: List[Dict[str, Any]]) -> List[Any]:
+        def fail(message: str) -> None:
+            if len(errors) < cls.MAX_ERRORS:
+                errors.append({"line": line, "code": cls._clean_text(row.get("code")), "error": message})
+
+        clean: Dict[str, Any] = {}
+        for column in cls.COLUMNS:
+            value = cls._clean_text(row.get(column))
+            if column in cls.CODE_COLUMNS and value:
+                value = value.upper()
+                if not re.fullmatch(cls.CODE_PATTERN, value):
+                    fail(f"صيغة {column} غير صحيحة: {value}")
+            clean[column] = value
+
+        if not clean["code"] and not row.get("xref"):
+            fail("الكود مطلوب")
+        if not clean["name"]:
+            fail("الاسم مطلوب")
+
+        if clean["level"] is not None:
+            try:
+                level = int(float(clean["level"]))
+                if level < 1:
+                    raise ValueError
+                clean["level"] = level
+            except ValueError:
+                fail("الجيل يجب أن يكون رقماً صحيحاً موجباً")
+                clean["level"] = None
+
+        today = date.today().isoformat()
+        for column in ("d_o_b", "d_o_d"):
+            clean[column], valid = cls._clean_date(row.get(column))
+            if not valid:
+                fail(f"تاريخ غير صالح في {column} (الصيغة المطلوبة YYYY-MM-DD)")
+            elif clean[column] and clean[column] > today:
+                fail(f"تاريخ {column} في المستقبل")
+        if clean["d_o_b"] and clean["d_o_d"] and clean["d_o_d"] < clean["d_o_b"]:
+            fail("تاريخ الوفاة قبل تاريخ الميلاد")
+
+        if clean["gender"] and clean["gender"] not in cls.GENDERS:
+            fail("الجنس يجب أن يكون ذكر أو أنثى")
+        if clean["status"] and clean["status"] not in cls.STATUSES:
+            fail("الحالة غير معروفة")
+        if clean["email"]:
+            clean["email"] = clean["email"].lower()
+
+        # نفس التهريب المطبق في نماذج الإضافة والتعديل
+        for column in ("name", "relation", "nick_name", "address", "p_o_b"):
+            if clean[column]:
+                clean[column] = html.escape(clean[column])
+
+        return [line] + [clean[c] for c in cls.COLUMNS] + [cls._clean_text(row.get(c)) for c in cls.REF_COLUMNS]
+
+    # =======================================================
+    # 3. الاستيراد
+    # =======================================================
+    @classmethod
+    def import_rows(cls, rows: Iterable[Dict[str, Any]],
+                    links: Optional[Iterable[Tuple[int, Optional[str], Optional[str], Optional[str]]]] = None) -> Dict[str, Any]:
+        """
+        استيراد صفوف (قاموس لكل عضو بأسماء أعمدة COLUMNS) بمعاملة واحدة.
+        links (اختياري، من GEDCOM): صفوف (الترتيب، الزوج، الزوجة، الابن) بمعرفات xref تُربط بالـ SQL بعد تحميل الأفراد.
+        يُعاد تقرير فيه عدد المضافين والمحدّثين أو قائمة الأخطاء دون أي تعديل على القاعدة.
+        """
+        errors: List[Dict[str, Any]] = []
+        staged = (cls._normalize_row(line, row, errors) for line, row in enumerate(rows, start=2))
+        columns_sql = ", ".join(cls.COLUMNS + list(cls.REF_COLUMNS))
+
+        with get_db_context() as conn:
+            with conn.cursor() as cur:
+                try:
+                    cur.execute(f"""
+                        CREATE TEMP TABLE family_import_staging (
+                            line INT,
+                            {", ".join(f"{c} TEXT" for c in cls.COLUMNS + list(cls.REF_COLUMNS))}
+                        ) ON COMMIT DROP
+                    """)
+                    cur.copy_expert(
+                        f"COPY family_import_staging (line, {columns_sql}) FROM STDIN WITH (FORMAT csv)",
+                        _CsvRowStream(staged),
+                    )
+                    if links is not None and not errors:
+                        cls._resolve_file_refs(cur, links)
+                    cur.execute("SELECT COUNT(*) FROM family_import_staging")
+                    total = cur.fetchone()[0]
+
+                    if not errors:
+                        errors.extend(cls._validate_staging(cur))
+                    if errors or total == 0:
+                        conn.rollback()
+                        return {"total": total, "inserted": 0, "updated": 0,
+                                "errors": errors or [{"line": None, "code": None, "error": "الملف لا يحتوي على صفوف"}]}
+
+                    inserted, updated = cls._merge_staging(cur)
+                    # الاستيراد قد يغيّر فروعاً كاملة: إعادة حساب أعداد الذرية بمرور واحد بدل دلتا لكل صف
+                    DescendantCountService.recompute(cur)
+                    cur.execute("SELECT code FROM family_import_staging")
+                    codes = [r[0] for r in cur.fetchall()]
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+
+        FamilyService.notify_family_changed(codes)
+        print(f"📥 تم استيراد {total} عضو ({inserted} جديد، {updated} محدّث).")
+        return {"total": total, "inserted": inserted, "updated": updated, "errors": []}
+
+    @classmethod
+    def _resolve_file_refs(cls, cur, links: Iterable[Tuple[int, Optional[str], Optional[str], Optional[str]]]) -> None:
+        """
+        ربط أفراد الملف ببعضهم بالـ SQL بدل تحميل الملف كاملاً في الذاكرة:
+        1. تخصيص كود (GENERATED_CODE_LETTER) لكل فرد بلا كود بصيغة الموقع، تالياً لأعلى كود موجود بهذا الحرف.
+        2. الأزواج الصريحون (_WIFE / _HUSB) ثم الآباء من سجلات الأسر (أول أسرة تذكر الابن)،
+           ثم الزوج الأساسي من أول أسرة تجمع الزوجين؛ القيم الموجودة في الصف لا تُستبدل.
+        """
+        cur.execute("CREATE INDEX ON family_import_staging (xref)")
+        cur.execute("""
+            CREATE TEMP TABLE family_import_links (seq INT, husb TEXT, wife TEXT, child TEXT) ON COMMIT DROP
+        """)
+        cur.copy_expert("COPY family_import_links (seq, husb, wife, child) FROM STDIN WITH (FORMAT csv)",
+                        _CsvRowStream(links))
+
+        # ترتيب الكود: (الرقم الأول * 1000 + الأوسط) * 999 + الأخير، والأكواد الجديدة تكمل بعد الأعلى
+        letter = cls.GENERATED_CODE_LETTER
+        cur.execute(r"""
+            WITH base AS (
+                SELECT COALESCE(MAX(
+                    (substring(code from 2 for position('-' in code) - 2)::int * 1000
+                     + substring(code from '-(\d{3})-')::int) * 999
+                    + substring(code from '(\d{3})$')::int
+                ), 0) AS n
+                FROM (SELECT code FROM family_name UNION ALL SELECT code FROM family_import_staging) c
+                WHERE code ~ %(pattern)s
+            ),
+            fresh AS (
+                SELECT line, (SELECT n FROM base) + row_number() OVER (ORDER BY line) AS o
+                FROM family_import_staging WHERE code IS NULL AND xref IS NOT NULL
+            )
+            UPDATE family_import_staging s
+            SET code = %(letter)s || ((fresh.o - 1) / 999 / 1000)::text
+                || '-' || lpad(((fresh.o - 1) / 999 %% 1000)::text, 3, '0')
+                || '-' || lpad(((fresh.o - 1) %% 999 + 1)::text, 3, '0')
+            FROM fresh WHERE s.line = fresh.line
+        """, {"letter": letter, "pattern": rf"^{letter}\d{{1,3}}-\d{{3}}-\d{{3}}$"})
+
+        cur.execute("""
+            UPDATE family_import_staging s SET
+                w_code = COALESCE(s.w_code, (SELECT x.code FROM family_import_staging x WHERE x.xref = s.w_ref LIMIT 1)),
+                h_code = COALESCE(s.h_code, (SELECT x.code FROM family_import_staging x WHERE x.xref = s.h_ref LIMIT 1))
+            WHERE s.w_ref IS NOT NULL OR s.h_ref IS NOT NULL
+        """)
+        cur.execute("""
+            UPDATE family_import_staging c
+            SET f_code = COALESCE(c.f_code, p.husb_code), m_code = COALESCE(c.m_code, p.wife_code)
+            FROM (
+                SELECT DISTINCT ON (l.child) l.child, h.code AS husb_code, w.code AS wife_code
+                FROM family_import_links l
+                LEFT JOIN family_import_staging h ON h.xref = l.husb
+                LEFT JOIN family_import_staging w ON w.xref = l.wife
+                WHERE l.child IS NOT NULL
+                ORDER BY l.child, l.seq
+            ) p
+            WHERE c.xref = p.child
+        """)
+        for own, other in (("husb", "wife"), ("wife", "husb")):
+            column = "w_code" if own == "husb" else "h_code"
+            cur.execute(f"""
+                UPDATE family_import_staging s SET {column} = COALESCE(s.{column}, f.spouse_code)
+                FROM (
+                    SELECT DISTINCT ON (l.{own}) l.{own} AS xref, x.code AS spouse_code
+                    FROM family_import_links l
+                    JOIN family_import_staging x ON x.xref = l.{other}
+                    WHERE l.child IS NULL AND l.{own} IS NOT NULL
+                    ORDER BY l.{own}, l.seq
+                ) f
+                WHERE s.xref = f.xref
+            """)
+
+    @classmethod
+    def _validate_staging(cls, cur) -> List[Dict[str, Any]]:
+        """التحقق الجماعي من العلاقات بين الصفوف ومع القاعدة باستعلام واحد"""
+        cur.execute("""
+            WITH dup AS (
+                SELECT line, code, 'الكود مكرر داخل الملف' AS error
+                FROM (SELECT line, code, COUNT(*) OVER (PARTITION BY code) AS n FROM family_import_staging) d
+                WHERE n > 1
+            ),
+            refs AS (
+                SELECT s.line, s.code, r.label || ' غير موجود: ' || r.ref AS error
+                FROM family_import_staging s
+                CROSS JOIN LATERAL (VALUES
+                    ('كود الأب', s.f_code), ('كود الأم', s.m_code),
+                    ('كود الزوجة', s.w_code), ('كود الزوج', s.h_code)
+                ) AS r(label, ref)
+                WHERE r.ref IS NOT NULL
+                  AND NOT EXISTS (SELECT 1 FROM family_import_staging x WHERE x.code = r.ref)
+                  AND NOT EXISTS (SELECT 1 FROM family_name n WHERE n.code = r.ref)
+            ),
+            self_refs AS (
+                SELECT line, code, 'العضو لا يمكن أن يكون أباً أو أماً لنفسه' AS error
+                FROM family_import_staging
+                WHERE code IN (f_code, m_code)
+            )
+            SELECT line, code, error FROM dup
+            UNION ALL SELECT line, code, error FROM refs
+            UNION ALL SELECT line, code, error FROM self_refs
+            ORDER BY line
+            LIMIT %s
+        """, (cls.MAX_ERRORS,))
+        return [{"line": r[0], "code": r[1], "error": r[2]} for r in cur.fetchall()]
+
+    @staticmethod
+    def _merge_staging(cur) -> Tuple[int, int]:
+        # تعطيل الـ Triggers صفاً بصف داخل هذه المعاملة فقط
+        cur.execute("SET LOCAL hottiyya.bulk_import = 'on'")
+
+        cur.execute("""
+            SELECT COUNT(*) FROM family_import_staging s
+            WHERE EXISTS (SELECT 1 FROM family_name n WHERE n.code = s.code)
+        """)
+        updated = cur.fetchone()[0]
+
+        # الأعضاء الموجودون سابقاً قد يكون لهم أحفاد خارج الملف: نضيفهم لطابور التحديث المتسلسل
+        cur.execute("""
+            INSERT INTO family_search_refresh_queue (code)
+            SELECT s.code FROM family_import_staging s
+            JOIN family_name n ON n.code = s.code
+            WHERE (n.name, n.f_code, n.m_code) IS DISTINCT FROM (s.name, s.f_code, s.m_code)
+            ON CONFLICT (code) DO UPDATE SET queued_at = NOW(), claimed_at = NULL
+                WHERE family_search_refresh_queue.claimed_at IS NOT NULL
+        """)
+
+        cur.execute("""
+            INSERT INTO family_name (code, name, f_code, m_code, w_code, h_code, relation, level, nick_name)
+            SELECT code, name, f_code, m_code, w_code, h_code, relation, level::int, nick_name
+            FROM family_import_staging
+            ON CONFLICT (code) DO UPDATE SET
+                name = EXCLUDED.name, f_code = EXCLUDED.f_code, m_code = EXCLUDED.m_code,
+                w_code = EXCLUDED.w_code, h_code = EXCLUDED.h_code, relation = EXCLUDED.relation,
+                level = EXCLUDED.level, nick_name = EXCLUDED.nick_name
+        """)
+        cur.execute("""
+            INSERT INTO family_info (code_info, gender, email, phone, address, p_o_b, status)
+            SELECT code, gender, email, phone, address, p_o_b, status
+            FROM family_import_staging
+            ON CONFLICT (code_info) DO UPDATE SET
+                gender = EXCLUDED.gender, email = EXCLUDED.email, phone = EXCLUDED.phone,
+                address = EXCLUDED.address, p_o_b = EXCLUDED.p_o_b, status = EXCLUDED.status
+        """)
+        cur.execute("""
+            INSERT INTO family_age_search (code, d_o_b, d_o_d)
+            SELECT code, d_o_b::date, d_o_d::date
+            FROM family_import_staging
+            ON CONFLICT (code) DO UPDATE SET d_o_b = EXCLUDED.d_o_b, d_o_d = EXCLUDED.d_o_d
+        """)
+
+        # رفع عدادات الأكواد مرة واحدة بدل Trigger لكل صف
+        cur.execute(r"""
+            INSERT INTO family_code_counters (prefix, last_value)
+            SELECT substring(code from '^(.*-)\d+$'), MAX(substring(code from '(\d+)$')::int)
+            FROM family_import_staging
+            GROUP BY 1
+            ON CONFLICT (prefix) DO UPDATE
+                SET last_value = GREATEST(family_code_counters.last_value, EXCLUDED.last_value)
+        """)
+
+        # إعادة بناء أسماء البحث للأعضاء المستوردين بعبارة واحدة (بعد إدخال كل الآباء)
+        cur.execute("""
+            INSERT INTO family_search (code, full_name, nick_name, level)
+            SELECT code, public.get_full_name(code, NULL, FALSE), nick_name, level::int
+            FROM family_import_staging
+            ON CONFLICT (code) DO UPDATE SET
+                full_name = EXCLUDED.full_name,
+                nick_name = EXCLUDED.nick_name,
+                level = EXCLUDED.level,
+                updated_at = NOW()
+        """)
+
+        cur.execute("SELECT COUNT(*) FROM family_import_staging")
+        total = cur.fetchone()[0]
+        return total - updated, updated
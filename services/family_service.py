@@ -3,22 +3,31 @@ import os
 import shutil 
 import re
 import socket
-import httplib2
+import time
+import tempfile
+import threading
+import uuid
 import io
+import hashlib
+import base64
+import json
 import logging  # 💡 تم إضافته لعمل الـ logger
 from datetime import date, datetime # 💡 تم إضافة datetime هنا
-from typing import List, Dict, Optional, Tuple, Any
+from typing import List, Dict, Optional, Tuple, Any, Iterator
+from psycopg2 import extensions
 from psycopg2.extras import RealDictCursor 
 import html
 
-from google.oauth2.credentials import Credentials
-from google.auth.transport.requests import Request
-import google_auth_httplib2
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseUpload
+from googleapiclient.http import MediaIoBaseUpload, MediaFileUpload
 
 from utils.normalize import normalize_arabic
 from postgresql import get_db_context
+from services.thumbnail_service import ThumbnailService
+from services.drive_service import DriveService
+from services.duplicate_service import DuplicateService
+from services.page_index_service import PageIndexService
+from services.descendant_count_service import DescendantCountService
+from core.family_events import FamilyEvents
 
 # إعداد لورجر محلي للدالة في حال لم يكن لديك لورجر عام ممرر
 logger = logging.getLogger(__name__)
@@ -31,39 +40,25 @@ socket.getaddrinfo = getaddrinfo_ipv4
 
 class FamilyService:
     PAGE_SIZE = 24
+    SEARCH_COUNT_CAP = 1000  # سقف عدّ نتائج البحث النصي (تقدير محدود بدل المسح الكامل)
     MAX_TREE_DEPTH = 10  # حد أقصى لمنع الانهيار في الدوال العودية
-    SCOPES = ['https://www.googleapis.com/auth/drive.file']
-    TOKEN_FILE = 'token.json'
+    BULK_REFRESH_THRESHOLD = 500  # فوق هذا العدد تُعاد بناء الفهارس في الذاكرة بدل التحديث الجزئي
     
     # 🔒 جلب معرف مجلد صور العائلة بأمان من ملف .env
     GOOGLE_DRIVE_FOLDER_ID = os.getenv("GOOGLE_DRIVE_FAMILY_PICS_ID")
 
+    # 🖼️ الصور المنتظرة للرفع إلى درايف بعد حفظ بيانات العضو (رفع على مرحلتين)
+    PENDING_PICS_DIR = os.getenv("FAMILY_PENDING_PICS_DIR", os.path.join(tempfile.gettempdir(), "hottiyya_pending_pics"))
+    PICTURE_UPLOAD_RETRIES = 5
+    PENDING_PIC_MAX_AGE = 24 * 3600  # الصور الأقدم من يوم تُحذف عند التشغيل بدل إعادة رفعها
+    PENDING_PIC_CLAIM_TIMEOUT = 3600  # ملف محجوز أقدم من ساعة: العملية التي حجزته ماتت
+    CLAIMED_SUFFIX = ".claimed"
+    PICTURE_MIME_TYPES = {".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".png": "image/png", ".webp": "image/webp"}
+
     @staticmethod
     def get_drive_service():
-        """بناء خدمة الاتصال بقوقل درايف لرفع صور الأعضاء"""
-        if not os.path.exists(FamilyService.TOKEN_FILE):
-            raise FileNotFoundError(f"ملف الصلاحيات {FamilyService.TOKEN_FILE} غير موجود!")
-
-        creds = Credentials.from_authorized_user_file(FamilyService.TOKEN_FILE, FamilyService.SCOPES)
-        
-        if creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-            with open(FamilyService.TOKEN_FILE, 'w') as token:
-                token.write(creds.to_json())
-        
-        http_transport = httplib2.Http(timeout=120)
-        http_transport.follow_redirects = False 
-        
-        authorized_http = google_auth_httplib2.AuthorizedHttp(creds, http=http_transport)
-        DRIVE_DISCOVERY_URL = 'https://www.googleapis.com/discovery/v1/apis/drive/v3/rest'
-        
-        return build(
-            'drive', 
-            'v3', 
-            http=authorized_http, 
-            discoveryServiceUrl=DRIVE_DISCOVERY_URL,
-            static_discovery=False
-        )
+        """عميل قوقل درايف المشترك لرفع صور الأعضاء (مخزن مؤقتاً لكل خيط)"""
+        return DriveService.get_service()
 
     @classmethod
     async def upload_member_picture(cls, file_data: bytes, filename: str, content_type: str) -> Optional[str]:
@@ -107,42 +102,137 @@ class FamilyService:
     # 1. البحث وجلب القوائم
     # ===============================================
     @staticmethod
-    def search_and_fetch_family(q: str, page: int) -> Tuple[List[Dict[str, Any]], int, int, int]:
+    def build_prefix_tsquery(normalized_text: str) -> Optional[str]:
+        """تحويل نص البحث إلى استعلام tsquery بادئي (كلمة:* & كلمة:*) آمن من رموز المعاملات"""
+        tokens = re.findall(r"\w+", normalized_text or "")
+        if not tokens:
+            return None
+        return " & ".join(f"{token}:*" for token in tokens)
+
+    @staticmethod
+    def encode_page_cursor(sort_key: str, code: str) -> str:
+        """مؤشر معتم (Opaque) لموضع عضو في القائمة المرتبة"""
+        raw = json.dumps([sort_key, code], ensure_ascii=False).encode("utf-8")
+        return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+    @staticmethod
+    def decode_page_cursor(cursor: Optional[str]) -> Optional[Tuple[str, str]]:
+        if not cursor:
+            return None
+        try:
+            raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+            sort_key, code = json.loads(raw.decode("utf-8"))
+            if isinstance(sort_key, str) and isinstance(code, str):
+                return sort_key, code
+        except (ValueError, TypeError):
+            pass
+        return None
+
+    @staticmethod
+    def fetch_family_page(page: int, cursor: Optional[str] = None) -> Tuple[List[Dict[str, Any]], int, int, int, Optional[str]]:
+        """
+        تصفح القائمة الكاملة بالترقيم بالمفاتيح (Keyset) على الفهرس (sort_key, code):
+        نقطة البداية تأتي من المؤشر إن وُجد (دون لمس فهرس مواقع الصفحات)، وإلا من الفهرس حسب رقم الصفحة.
+        """
+        after = FamilyService.decode_page_cursor(cursor)
+        if after is not None:
+            total_count, boundaries = PageIndexService.total(), None
+        else:
+            total_count, boundaries = PageIndexService.get(FamilyService.PAGE_SIZE)
+        totals_pages = math.ceil(total_count / FamilyService.PAGE_SIZE) if total_count > 0 else 1
+        current_page = max(1, min(page, totals_pages))
+
+        if after is None and current_page > 1:
+            after = boundaries[min(current_page, len(boundaries) + 1) - 2] if boundaries else None
+
+        with get_db_context() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                seek_condition = "AND (sort_key, code) > (%s, %s)" if after else ""
+                cur.execute(f"""
+                    SELECT code, public.get_full_name(code, 5, FALSE) AS full_name, nick_name, descendants_total, sort_key
+                    FROM family_search
+                    WHERE level >= 0 {seek_condition}
+                    ORDER BY sort_key, code
+                    LIMIT %s
+                """, (after or ()) + (FamilyService.PAGE_SIZE,))
+                members = cur.fetchall()
+
+        next_cursor = None
+        if members and current_page < totals_pages:
+            next_cursor = FamilyService.encode_page_cursor(members[-1]["sort_key"], members[-1]["code"])
+        for member in members:
+            member.pop("sort_key", None)
+        return members, current_page, totals_pages, total_count, next_cursor
+
+    @staticmethod
+    def search_and_fetch_family(q: str, page: int, cursor: Optional[str] = None) -> Tuple[List[Dict[str, Any]], int, int, int, Optional[str]]:
+        """البحث يُرتب بالصلة ويبقى بالإزاحة المحدودة بسقف العدّ؛ القائمة الكاملة بدون بحث تُصفح بالمفاتيح"""
+        phrase = q.strip()
+        if not phrase:
+            return FamilyService.fetch_family_page(page, cursor)
+
         with get_db_context() as conn:
             with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                phrase = q.strip()
                 normalized_input = normalize_arabic(phrase)
-                search_term_like = f"%{normalized_input}%"
-                
+                order_clause = "ORDER BY sort_key, code"
+                order_params: tuple = ()
+                count_cap = None
+
                 if re.fullmatch(r"^[A-Z]\d{1,3}-\d{3}-\d{3}$", phrase.upper()):
                     sql_condition = "code = %s"
                     count_params = (phrase.upper(),)
                 elif "-" in phrase and len(phrase.split()) == 1:
+                    # يستفيد من فهرس المقاطع الثلاثية على الكود
                     sql_condition = "code ILIKE %s"
                     count_params = (f"%{phrase}%",)
+                    count_cap = FamilyService.SEARCH_COUNT_CAP
+                elif normalized_input:
+                    # 🔍 مطابقة مفهرسة: نص كامل ببادئات الكلمات + مقاطع ثلاثية للأجزاء على search_text المخزن
+                    search_term_like = f"%{normalized_input}%"
+                    ts_query = FamilyService.build_prefix_tsquery(normalized_input)
+                    if ts_query:
+                        sql_condition = "(to_tsvector('arabic', search_text) @@ to_tsquery('arabic', %s) OR search_text ILIKE %s)"
+                        count_params = (ts_query, search_term_like)
+                        order_clause = """ORDER BY ts_rank(to_tsvector('arabic', search_text), to_tsquery('arabic', %s)) DESC,
+                                           similarity(search_text, %s) DESC, full_name ASC"""
+                        order_params = (ts_query, normalized_input)
+                    else:
+                        sql_condition = "search_text ILIKE %s"
+                        count_params = (search_term_like,)
+                        order_clause = "ORDER BY similarity(search_text, %s) DESC, full_name ASC"
+                        order_params = (normalized_input,)
+                    count_cap = FamilyService.SEARCH_COUNT_CAP
                 else:
-                    sql_condition = "(public.normalize_arabic(full_name) ILIKE %s OR public.normalize_arabic(nick_name) ILIKE %s)"
-                    count_params = (search_term_like, search_term_like)
+                    sql_condition = "TRUE"
+                    count_params = ()
 
                 sql_condition += " AND level >= 0"
 
-                cur.execute(f"SELECT COUNT(*) FROM family_search WHERE {sql_condition}", count_params)
+                # ✅ عدّ محدود السقف: لا نمسح كل النتائج المطابقة لعرض رقم لن يتصفحه أحد
+                if count_cap:
+                    cur.execute(f"""
+                        SELECT COUNT(*) FROM (
+                            SELECT 1 FROM family_search WHERE {sql_condition} LIMIT %s
+                        ) AS bounded
+                    """, count_params + (count_cap,))
+                else:
+                    cur.execute(f"SELECT COUNT(*) FROM family_search WHERE {sql_condition}", count_params)
                 total_count = cur.fetchone()['count']
-                
+
                 totals_pages = math.ceil(total_count / FamilyService.PAGE_SIZE) if total_count > 0 else 1
                 current_page = max(1, min(page, totals_pages))
                 offset = (current_page - 1) * FamilyService.PAGE_SIZE
-                
+
                 cur.execute(f"""
-                    SELECT code, public.get_full_name(code, 5, FALSE) AS full_name, nick_name
+                    SELECT code, public.get_full_name(code, 5, FALSE) AS full_name, nick_name, descendants_total
                     FROM family_search
                     WHERE {sql_condition}
-                    ORDER BY public.normalize_arabic(full_name) ASC
+                    {order_clause}
                     LIMIT %s OFFSET %s
-                """, count_params + (FamilyService.PAGE_SIZE, offset))
-                
+                """, count_params + order_params + (FamilyService.PAGE_SIZE, offset))
+
                 members = cur.fetchall()
-                return members, current_page, totals_pages, total_count
+                return members, current_page, totals_pages, total_count, None
 
     # ===============================================
     # 2. جلب التفاصيل الشاملة (تعديل جلب مسار الصورة)
@@ -152,11 +242,13 @@ class FamilyService:
         with get_db_context() as conn:
             with conn.cursor(cursor_factory=RealDictCursor) as cur:
                 query = """
-                SELECT n.*, i.*, a.d_o_b, a.d_o_d, a.age_at_death, p.pic_path AS picture_url
+                SELECT n.*, i.*, a.d_o_b, a.d_o_d, a.age_at_death, p.pic_path AS picture_url,
+                       s.descendants_total, s.descendants_living, s.descendants_by_generation
                 FROM family_name n
                 LEFT JOIN family_info i ON n.code = i.code_info
                 LEFT JOIN family_age_search a ON n.code = a.code
                 LEFT JOIN family_picture p ON n.code = p.code_pic
+                LEFT JOIN family_search s ON n.code = s.code
                 WHERE n.code = %s;
                 """
                 cur.execute(query, (code.strip().upper(),))
@@ -166,28 +258,20 @@ class FamilyService:
                 # ✅ التعديل الصحيح والمؤمن:
                 member_data = dict(row)
 
-                # تحويل الـ Google Drive ID إلى رابط عرض مباشر متاح للمتصفح
-                raw_pic_path = member_data.get("picture_url")
-                google_drive_url = None
-
-                if raw_pic_path:
-                    # تنظيف المعرف من أي مسارات كاملة إن وجدت
-                    drive_id = raw_pic_path.strip()
-                    if "id=" in drive_id:
-                        drive_id = drive_id.split("id=")[-1]
-                    elif "/" in drive_id:
-                        drive_id = drive_id.split("/")[-1]
-                    
-                    # صياغة الرابط المباشر عالي الأداء المخصص لوسم الـ img 
-                    google_drive_url = f"https://drive.google.com/thumbnail?id={drive_id}&sz=w500"
-                
+                # تحويل الـ Google Drive ID إلى رابط المصغرة المحلية (تُجلب من درايف مرة واحدة فقط)
+                picture_url = ThumbnailService.url_for(ThumbnailService.extract_drive_id(member_data.get("picture_url")))
+
                 # تحديثها داخل البيانات الأساسية أيضاً لضمان قراءتها من أي مكان بالقالب
-                member_data["picture_url"] = google_drive_url
+                member_data["picture_url"] = picture_url
                                 
                 for key in ["d_o_b", "d_o_d"]:
                     if isinstance(member_data.get(key), date):
                         member_data[key] = member_data[key].isoformat()
 
+                # أعداد الذرية لكل جيل مرتبة (الجيل 1 = الأبناء)
+                by_generation = member_data.get("descendants_by_generation") or {}
+                member_data["descendants_generations"] = sorted((int(gen), count) for gen, count in by_generation.items())
+
                 cur.execute("SELECT public.get_full_name(%s, NULL, TRUE) AS m_name", (member_data.get("m_code"),))
                 m_res = cur.fetchone()
                 mother_name = m_res["m_name"] if m_res else ""
@@ -247,10 +331,29 @@ class FamilyService:
                 return {
                     "member": member_data, "info": member_data, "full_name": display_name,
                     "mother_name": mother_name, "father_full_name": father_name, "children": children, 
-                    "wives": wives, "husbands": husbands, "picture_url": google_drive_url , 
+                    "wives": wives, "husbands": husbands, "picture_url": picture_url , 
                     "gender": gender, "nick_name": member_data.get("nick_name")
                 }
 
+    @staticmethod
+    def get_member_details_version(code: str) -> Optional[str]:
+        """
+        نسخة لوحة التفاصيل من family_member_versions: يرفعها Trigger جداول العائلة (الأسماء، البحث، البيانات
+        الشخصية، التواريخ، الصور) عند تغيّر العضو أو أحد من يظهر في لوحته (الوالدان، الأزواج، الأبناء).
+        النسخة من قاعدة البيانات لا من الذاكرة، فتُبطل اللوحة المخزنة في كل الـ workers لا في العامل الذي كتب فقط.
+        تُرجع None إذا لم يكن العضو موجوداً.
+        """
+        with get_db_context() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT COALESCE(v.version, 0)
+                    FROM family_name n
+                    LEFT JOIN family_member_versions v ON v.code = n.code
+                    WHERE n.code = %s
+                """, (code.strip().upper(),))
+                row = cur.fetchone()
+        return str(row[0]) if row else None
+
     # ===============================================
     # 3. جلب البيانات للتعديل (تعديل صياغة مسار الصورة المباشر)
     # ===============================================
@@ -277,20 +380,11 @@ class FamilyService:
                 cur.execute("SELECT pic_path FROM family_picture WHERE code_pic = %s", (code.strip().upper(),))
                 pic = cur.fetchone()
                 
-                # ✅ صياغة الرابط المباشر للـ Drive ليعمل بالمتصفح فوراً
-                google_drive_url = None
-                if pic and pic.get("pic_path"):
-                    raw_path = pic["pic_path"].strip()
-                    if "id=" in raw_path:
-                        drive_id = raw_path.split("id=")[-1]
-                    elif "/" in raw_path:
-                        drive_id = raw_path.split("/")[-1]
-                    else:
-                        drive_id = raw_path
-                    google_drive_url = f"https://drive.google.com/thumbnail?id={drive_id}&sz=w500"
+                # ✅ رابط المصغرة المحلية بدلاً من انتظار مصغرات درايف
+                picture_url = ThumbnailService.url_for(ThumbnailService.extract_drive_id(pic.get("pic_path") if pic else None))
                 
                 return {
-                    "member": member, "info": info, "picture_url": google_drive_url
+                    "member": member, "info": info, "picture_url": picture_url
                 }
     # ===============================================
     # 4. الحذف الآمن والمسح النهائي من Google Drive
@@ -310,12 +404,16 @@ class FamilyService:
                         drive_service.files().delete(fileId=drive_file_id).execute()
                     except Exception as e:
                         print(f"⚠️ تفادي خطأ أثناء حذف الصورة من Google Drive: {e}")
+                    ThumbnailService.invalidate(drive_file_id)
+
+                # حفظ مساهمة العضو وذريته في أعداد أصوله قبل فك الروابط
+                DescendantCountService.begin_change(cur, clean_code)
 
                 # تصفير العلاقات لعدم كسر تكامل البيانات الـ Foreign Keys
-                cur.execute("UPDATE family_name SET f_code = NULL WHERE f_code = %s", (clean_code,))
-                cur.execute("UPDATE family_name SET m_code = NULL WHERE m_code = %s", (clean_code,))
-                cur.execute("UPDATE family_name SET w_code = NULL WHERE w_code = %s", (clean_code,))
-                cur.execute("UPDATE family_name SET h_code = NULL WHERE h_code = %s", (clean_code,))
+                affected_codes = set()
+                for column in ("f_code", "m_code", "w_code", "h_code"):
+                    cur.execute(f"UPDATE family_name SET {column} = NULL WHERE {column} = %s RETURNING code", (clean_code,))
+                    affected_codes.update(r[0] for r in cur.fetchall())
                 
                 # مسح السجلات من الجداول الفرعية والأصلية
                 cur.execute("DELETE FROM family_picture WHERE code_pic = %s", (clean_code,))
@@ -323,48 +421,97 @@ class FamilyService:
                 cur.execute("DELETE FROM family_info WHERE code_info = %s", (clean_code,))
                 cur.execute("DELETE FROM family_search WHERE code = %s", (clean_code,))
                 cur.execute("DELETE FROM family_name WHERE code = %s", (clean_code,))
+                DuplicateService.forget_member(cur, clean_code)
+                DescendantCountService.finish_change(cur, clean_code)
                 
                 conn.commit()
 
+        FamilyService.notify_family_changed(affected_codes, removed=[clean_code])
+
     # ===============================================
     # 5. الأدوات المساعدة وحماية الأكواد التلقائية
     # ===============================================
     @staticmethod
     def get_next_code(prefix: str) -> str:
+        """
+        اقتراح الرقم التالي للبادئة للعرض في النموذج فقط (قراءة، لا يُحجز شيء).
+        نموذجان مفتوحان معاً يريان نفس الاقتراح، لذا الكود المقترح يُحجز فعلياً عند الحفظ عبر _allocate_code.
+        """
         prefix = prefix.upper().strip()
         search_prefix = prefix if prefix.endswith('-') else f"{prefix}-"
         with get_db_context() as conn:
-            with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                cur.execute("SELECT code FROM family_search WHERE code LIKE %s", (f"{search_prefix}%",))
-                rows = cur.fetchall()
-                if not rows: return f"{search_prefix}001"
-                
-                nums = []
-                for r in rows:
-                    try:
-                        parts = r['code'].split('-')
-                        if parts and parts[-1].isdigit():
-                            nums.append(int(parts[-1]))
-                    except: continue
-                
-                next_num = max(nums) + 1 if nums else 1
-                return f"{search_prefix}{str(next_num).zfill(3)}"
+            with conn.cursor() as cur:
+                cur.execute("SELECT last_value FROM family_code_counters WHERE prefix = %s", (search_prefix,))
+                row = cur.fetchone()
+
+                if not row:
+                    # بادئة بلا عداد بعد: الاقتراح من الأكواد الموجودة دون إنشاء صف عداد
+                    cur.execute(r"""
+                        SELECT COALESCE(MAX(substring(code from '(\d+)$')::int), 0)
+                        FROM family_name
+                        WHERE code LIKE %s AND code ~ '\d+$'
+                    """, (f"{search_prefix}%",))
+                    row = cur.fetchone()
+
+                return f"{search_prefix}{str(row[0] + 1).zfill(3)}"
             
+    @staticmethod
+    def code_prefix(code: str) -> str:
+        """بادئة الكود كما يحسبها trigger العدادات: كل ما قبل الرقم الأخير (A0-000-494 → A0-000-)"""
+        code = code.strip().upper()
+        match = re.match(r"^(.*-)\d*$", code)
+        return match.group(1) if match else f"{code}-"
+
+    @staticmethod
+    def _allocate_code(cur, prefix: str) -> str:
+        """
+        حجز الرقم التالي للبادئة داخل معاملة الإضافة (UPDATE ... RETURNING يقفل صف العداد حتى الـ commit،
+        فلا يحصل إدخالان متزامنان على نفس الكود). البادئة الجديدة تبدأ من أكبر كود موجود لها.
+        """
+        cur.execute("""
+            UPDATE family_code_counters SET last_value = last_value + 1
+            WHERE prefix = %s
+            RETURNING last_value
+        """, (prefix,))
+        row = cur.fetchone()
+        if not row:
+            cur.execute(r"""
+                INSERT INTO family_code_counters (prefix, last_value)
+                SELECT %(prefix)s, COALESCE(MAX(substring(code from '(\d+)$')::int), 0) + 1
+                FROM family_name
+                WHERE code LIKE %(pattern)s AND code ~ '\d+$'
+                ON CONFLICT (prefix) DO UPDATE SET last_value = family_code_counters.last_value + 1
+                RETURNING last_value
+            """, {"prefix": prefix, "pattern": f"{prefix}%"})
+            row = cur.fetchone()
+        return f"{prefix}{str(row[0]).zfill(3)}"
+
    # ===============================================
     # 6. إضافة عضو جديد مع رفع الصورة إلى Google Drive
     # ===============================================
     @staticmethod
-    def add_new_member(data: Dict[str, Any], picture_file: Optional[Any] = None, extension: Optional[str] = None) -> bool:
+    def add_new_member(data: Dict[str, Any]) -> str:
+        """
+        حفظ بيانات العضو فقط وإرجاع كوده النهائي؛ الصورة تُرفع لاحقاً في الخلفية عبر attach_member_picture.
+        allocate_code=True (الكود مقترح من get_next_code أو بادئة فقط): يُحجز الرقم التالي لبادئة الكود
+        داخل نفس المعاملة بدل الثقة بالاقتراح، فقد يختلف الكود المحفوظ عن المعروض.
+        """
         def clean_db_val(val):
             if val is None: return None
             if isinstance(val, str) and val.strip() == "": return None
             return val
 
-        clean_code = clean_db_val(data['code']).strip().upper()
+        clean_code = (clean_db_val(data.get('code')) or "").strip().upper()
 
         with get_db_context() as conn:
             with conn.cursor() as cur:
                 try:
+                    if data.get('allocate_code') or not clean_code:
+                        clean_code = FamilyService._allocate_code(cur, FamilyService.code_prefix(clean_code))
+
+                    # أبناء سبق تسجيلهم بكود العضو قبل إضافته يدخلون في فرعه
+                    DescendantCountService.begin_change(cur, clean_code)
+
                     # 1. إدخال البيانات الأساسية في جدول الأسماء
                     cur.execute("""
                         INSERT INTO family_name (code, name, f_code, m_code, w_code, h_code, relation, level, nick_name)
@@ -396,68 +543,31 @@ class FamilyService:
                         VALUES (%s, %s, %s)
                         ON CONFLICT (code) DO UPDATE SET d_o_b = EXCLUDED.d_o_b, d_o_d = EXCLUDED.d_o_d
                     """, (clean_code, clean_db_val(data.get('d_o_b')), clean_db_val(data.get('d_o_d'))))
-                   
-                    # 🚀 4. معالجة رفع الصورة إلى Google Drive 
-                    # تم تدعيم الشرط بـ (strip) للتأكد من أن اسم الملف ليس فراغات مخفية
-                    if picture_file and picture_file.filename and picture_file.filename.strip() != "" and extension:
-                        
-                        # قراءة الملف من الذاكرة مباشرة
-                        file_bytes = picture_file.file.read()
-                        
-                        # الحماية الحديدية: التأكد من أن الملف يحتوي على بيانات فعلاً (أكبر من 0 بايت)
-                        if file_bytes and len(file_bytes) > 0:
-                            
-                            # تصحيح تصفية الامتداد ليقبل الحروف والأرقام والنقطة فقط بشكل سليم
-                            safe_ext = re.sub(r'[^a-zA-Z0-9.]', '', extension)
-                            filename = f"{clean_code}{safe_ext}"
-                            content_type = picture_file.content_type or "image/jpeg"
-                            
-                            # جلب خدمة قوقل درايف النظيفة والمباشرة
-                            drive_service = FamilyService.get_drive_service() 
-                            
-                            # إعداد الميتا داتا وتجهيز الرفع السحابي
-                            file_metadata = {
-                                'name': filename, 
-                                'parents': [FamilyService.GOOGLE_DRIVE_FOLDER_ID]
-                            }
-                            media = MediaIoBaseUpload(io.BytesIO(file_bytes), mimetype=content_type, resumable=True)
-                            
-                            # تنفيذ عملية الرفع الفعلي واستخراج معرف الملف الـ ID
-                            drive_file = drive_service.files().create(
-                                body=file_metadata, 
-                                media_body=media, 
-                                fields='id'
-                            ).execute()
-                            
-                            drive_file_id = drive_file.get('id')
-                            
-                            # تعديل الصلاحيات لجعل الملف قابلاً للعرض العام
-                            if drive_file_id:
-                                try:
-                                    drive_service.permissions().create(
-                                        fileId=drive_file_id, 
-                                        body={'type': 'anyone', 'role': 'reader'}
-                                    ).execute()
-                                except Exception:
-                                    pass 
-                            
-                                # حفظ الـ Google Drive ID في جدول الصور الخاص بالقاعدة
-                                cur.execute("""
-                                    INSERT INTO family_picture (code_pic, pic_path)
-                                    VALUES (%s, %s)
-                                    ON CONFLICT (code_pic) DO UPDATE SET pic_path = EXCLUDED.pic_path
-                                """, (clean_code, drive_file_id))
 
+                    # 4. إضافة العضو الجديد إلى أعداد ذرية كل أصوله
+                    DescendantCountService.finish_change(cur, clean_code)
+                   
                     conn.commit()
-                    return True
                 except Exception as e:
                     conn.rollback()
                     raise e
+
+        FamilyService.notify_family_changed([clean_code])
+
+        # فحص تزايدي للعضو الجديد مقابل كتله فقط؛ فشله لا يلغي الإضافة
+        try:
+            found = DuplicateService.check_member(clean_code)
+            if found:
+                print(f"🧬 العضو {clean_code} له {found} تكرار محتمل بانتظار المراجعة.")
+        except Exception as e:
+            print(f"⚠️ تعذر فحص تكرار العضو {clean_code}: {e}")
+        return clean_code
 # ===============================================
     # 7. تعديل وتحديث البيانات على السحابة ديركت
     # ===============================================
     @staticmethod
-    def update_member_data(code: str, data: Dict[str, Any], picture_file: Optional[Any] = None, extension: Optional[str] = None) -> bool:
+    def update_member_data(code: str, data: Dict[str, Any]) -> bool:
+        """تحديث بيانات العضو فقط؛ استبدال الصورة يتم في الخلفية عبر attach_member_picture"""
         def clean_db_val(val):
             if val is None: return None
             if isinstance(val, str) and val.strip() == "": return None
@@ -468,6 +578,11 @@ class FamilyService:
         with get_db_context() as conn:
             with conn.cursor() as cur:
                 try:
+                    # تغيّر الأب أو الأم أو الحالة ينقل العضو وذريته بين أصول مختلفة: لقطة قبل الحفظ وتطبيق الفرق بعده
+                    lineage_changed = DescendantCountService.signature(cur, clean_code) != DescendantCountService.signature_of(data)
+                    if lineage_changed:
+                        DescendantCountService.begin_change(cur, clean_code)
+
                     cur.execute("""
                         UPDATE family_name 
                         SET name=%s, f_code=%s, m_code=%s, w_code=%s, h_code=%s, relation=%s, level=%s, nick_name=%s
@@ -492,50 +607,218 @@ class FamilyService:
                         VALUES (%s, %s, %s)
                         ON CONFLICT (code) DO UPDATE SET d_o_b = EXCLUDED.d_o_b, d_o_d = EXCLUDED.d_o_d
                     """, (clean_code, clean_db_val(data.get('d_o_b')), clean_db_val(data.get('d_o_d'))))
-                  
-                    # تحديث الصورة في درايف عند رفع صورة جديدة فعلية وغير فارغة
-                    if picture_file and picture_file.filename and picture_file.filename.strip() != "" and extension:
-                        
-                        file_bytes = picture_file.file.read()
-                        
-                        # 🔒 حماية المساحة: لا تنفذ التعديل السحابي إلا لو كان الملف يحتوي على بيانات
-                        if file_bytes and len(file_bytes) > 0:
-                            
-                            # حذف الصورة القديمة من درايف إن وجدت لتوفير المساحة أولاً بأول
-                            cur.execute("SELECT pic_path FROM family_picture WHERE code_pic = %s", (clean_code,))
-                            old_pic = cur.fetchone()
-                            if old_pic and old_pic[0]:
-                                try:
-                                    drive_service = FamilyService.get_drive_service()
-                                    drive_service.files().delete(fileId=old_pic[0]).execute()
-                                except: pass
-
-                            safe_ext = re.sub(r'[^a-zA-Z0-9.]', '', extension)
-                            filename = f"{clean_code}{safe_ext}"
-                            content_type = picture_file.content_type or "image/jpeg"
-                            
-                            drive_service = FamilyService.get_drive_service()
-                            file_metadata = {'name': filename, 'parents': [FamilyService.GOOGLE_DRIVE_FOLDER_ID]}
-                            media = MediaIoBaseUpload(io.BytesIO(file_bytes), mimetype=content_type, resumable=True)
-                            drive_file = drive_service.files().create(body=file_metadata, media_body=media, fields='id').execute()
-                            
-                            try:
-                                drive_service.permissions().create(fileId=drive_file.get('id'), body={'type': 'anyone', 'role': 'reader'}).execute()
-                            except: pass
-                            
-                            if drive_file.get('id'):
-                                cur.execute("""
-                                    INSERT INTO family_picture (code_pic, pic_path)
-                                    VALUES (%s, %s)
-                                    ON CONFLICT (code_pic) DO UPDATE SET pic_path = EXCLUDED.pic_path
-                                """, (clean_code, drive_file.get('id')))
 
+                    if lineage_changed:
+                        DescendantCountService.finish_change(cur, clean_code)
+                  
                     conn.commit()
-                    return True
                 except Exception as e:
                     conn.rollback()
                     raise e
-                
+
+        FamilyService.notify_family_changed([clean_code])
+        return True
+
+    # ===============================================
+    # 8. رفع صور الأعضاء على مرحلتين (خارج معاملة قاعدة البيانات)
+    # ===============================================
+    @classmethod
+    def stage_member_picture(cls, code: str, upload: Optional[Dict[str, Any]]) -> Optional[str]:
+        """نقل الصورة المستقبلة (UploadService.receive_form) إلى مجلد الانتظار وإرجاع مسارها لرفعها في الخلفية"""
+        if not upload:
+            return None
+        safe_ext = upload["ext"]
+        if safe_ext not in cls.PICTURE_MIME_TYPES:
+            return None
+
+        clean_code = code.strip().upper()
+        os.makedirs(cls.PENDING_PICS_DIR, exist_ok=True)
+        # وقت الحفظ (نانوثانية) في اسم الملف: يحدد الصورة الأحدث بين كل الـ workers لا داخل العملية فقط
+        pending_path = os.path.join(cls.PENDING_PICS_DIR, f"{clean_code}__{time.time_ns()}_{uuid.uuid4().hex}{safe_ext}")
+        # الملفات الفارغة رُفضت أثناء الاستقبال
+        shutil.move(upload["path"], pending_path)
+        return pending_path
+
+    @classmethod
+    def _upload_picture_to_drive(cls, source_path: str, filename: str, ext: str) -> str:
+        drive_service = cls.get_drive_service()
+        content_type = cls.PICTURE_MIME_TYPES.get(ext, "image/jpeg")
+        media = MediaFileUpload(source_path, mimetype=content_type, resumable=True)
+        drive_file = drive_service.files().create(
+            body={'name': filename, 'parents': [cls.GOOGLE_DRIVE_FOLDER_ID]},
+            media_body=media,
+            fields='id'
+        ).execute()
+        drive_file_id = drive_file.get('id')
+        if not drive_file_id:
+            raise RuntimeError("لم يُرجع Google Drive معرفاً للملف")
+        try:
+            drive_service.permissions().create(fileId=drive_file_id, body={'type': 'anyone', 'role': 'reader'}).execute()
+        except Exception:
+            pass
+        return drive_file_id
+
+    @classmethod
+    def _delete_drive_file(cls, drive_file_id: Optional[str]) -> None:
+        if not drive_file_id:
+            return
+        try:
+            cls.get_drive_service().files().delete(fileId=drive_file_id).execute()
+        except Exception as e:
+            print(f"⚠️ تفادي خطأ أثناء حذف الصورة من Google Drive: {e}")
+        ThumbnailService.invalidate(drive_file_id)
+
+    @staticmethod
+    def _staged_at(pending_path: str) -> int:
+        name = os.path.basename(pending_path).split("__", 1)[-1]
+        try:
+            return int(name.split("_", 1)[0])
+        except ValueError:
+            # ملفات بالصيغة القديمة (بدون وقت في الاسم)
+            return int(os.path.getmtime(pending_path) * 1_000_000_000)
+
+    @classmethod
+    def _claim_pending(cls, pending_path: str) -> Optional[str]:
+        """
+        حجز ملف الانتظار بإعادة تسميته (os.rename ذري): ينجح لعملية واحدة فقط من كل الـ workers،
+        فلا تُرفع نفس الصورة مرتين عند الاستكمال بعد التشغيل.
+        """
+        claimed = pending_path + cls.CLAIMED_SUFFIX
+        try:
+            os.rename(pending_path, claimed)
+        except FileNotFoundError:
+            return None
+        os.utime(claimed)  # وقت الحجز لمعرفة الحجوزات اليتيمة
+        return claimed
+
+    @classmethod
+    def _picture_row_is_newer(cls, code: str, staged_at: int) -> bool:
+        with get_db_context() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT staged_at FROM family_picture WHERE code_pic = %s", (code,))
+                row = cur.fetchone()
+                return bool(row and row[0] is not None and row[0] >= staged_at)
+
+    @classmethod
+    def attach_member_picture(cls, code: str, pending_path: str) -> None:
+        """
+        المرحلة الثانية (خلفية): رفع الصورة لدرايف مع إعادة المحاولة، ثم ربطها بالعضو بمعاملة قصيرة.
+        الربط مشروط بأن تكون الصورة أحدث (staged_at) من المربوطة حالياً، فلا تتغلب صورة أقدم
+        على أحدث حتى لو رفعتها عملية أخرى؛ والملف المرفوع الخاسر أو لعضو محذوف يُحذف من درايف.
+        """
+        clean_code = code.strip().upper()
+        try:
+            staged_at = cls._staged_at(pending_path)
+        except FileNotFoundError:
+            return
+        claimed_path = cls._claim_pending(pending_path)
+        if not claimed_path:
+            return  # حجزه worker آخر أو حُذف
+        ext = os.path.splitext(pending_path)[1]
+
+        try:
+            if cls._picture_row_is_newer(clean_code, staged_at):
+                return  # صورة أحدث رُبطت بالفعل: لا داعي للرفع
+
+            drive_file_id = None
+            for attempt in range(1, cls.PICTURE_UPLOAD_RETRIES + 1):
+                try:
+                    drive_file_id = cls._upload_picture_to_drive(claimed_path, f"{clean_code}{ext}", ext)
+                    break
+                except Exception as e:
+                    print(f"⚠️ فشل رفع صورة العضو {clean_code} (محاولة {attempt}/{cls.PICTURE_UPLOAD_RETRIES}): {e}")
+                    if attempt == cls.PICTURE_UPLOAD_RETRIES:
+                        # إعادة الملف لمجلد الانتظار ليُعاد رفعه عند التشغيل التالي
+                        os.rename(claimed_path, pending_path)
+                        claimed_path = None
+                        return
+                    time.sleep(min(2 ** attempt, 30))
+                    if DriveService.is_auth_error(e) or attempt % 2 == 0:
+                        DriveService.recover(e)
+
+            old_pic_id = None
+            with get_db_context() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT pic_path FROM family_picture WHERE code_pic = %s FOR UPDATE", (clean_code,))
+                    old_pic = cur.fetchone()
+                    cur.execute("""
+                        INSERT INTO family_picture (code_pic, pic_path, staged_at)
+                        SELECT %(code)s, %(pic)s, %(staged_at)s WHERE EXISTS (SELECT 1 FROM family_name WHERE code = %(code)s)
+                        ON CONFLICT (code_pic) DO UPDATE SET pic_path = EXCLUDED.pic_path, staged_at = EXCLUDED.staged_at
+                        WHERE family_picture.staged_at IS NULL OR family_picture.staged_at < EXCLUDED.staged_at
+                    """, {"code": clean_code, "pic": drive_file_id, "staged_at": staged_at})
+                    attached = cur.rowcount > 0
+                    conn.commit()
+            if attached and old_pic and old_pic[0] != drive_file_id:
+                old_pic_id = old_pic[0]
+
+            if attached:
+                # حذف الصورة القديمة بعد نجاح الربط فقط
+                cls._delete_drive_file(old_pic_id)
+                FamilyService.notify_family_changed([clean_code])
+            else:
+                cls._delete_drive_file(drive_file_id)
+        finally:
+            if claimed_path and os.path.exists(claimed_path):
+                os.remove(claimed_path)
+
+    @classmethod
+    def resume_pending_pictures(cls) -> int:
+        """
+        عند التشغيل: إعادة رفع الصور التي لم تكتمل، وحذف القديمة جداً.
+        تعمل في كل worker بأمان: كل ملف يُحجز بإعادة تسمية ذرية قبل رفعه فيرفعه worker واحد فقط.
+        """
+        if not os.path.isdir(cls.PENDING_PICS_DIR):
+            return 0
+        now = time.time()
+        newest: Dict[str, Tuple[int, str]] = {}
+        for name in os.listdir(cls.PENDING_PICS_DIR):
+            path = os.path.join(cls.PENDING_PICS_DIR, name)
+            if "__" not in name:
+                continue
+            try:
+                if name.endswith(cls.CLAIMED_SUFFIX):
+                    # حجز يتيم من عملية ماتت أثناء الرفع: إرجاعه للانتظار (rename ذري ينجح لـ worker واحد)
+                    if now - os.path.getmtime(path) < cls.PENDING_PIC_CLAIM_TIMEOUT:
+                        continue
+                    original = path[:-len(cls.CLAIMED_SUFFIX)]
+                    os.rename(path, original)
+                    path, name = original, os.path.basename(original)
+                staged_at = cls._staged_at(path)
+            except FileNotFoundError:
+                continue  # أخذه worker آخر
+
+            code = name.split("__", 1)[0]
+            previous = newest.get(code)
+            # نحتفظ بأحدث صورة لكل عضو فقط
+            try:
+                if now - staged_at / 1_000_000_000 > cls.PENDING_PIC_MAX_AGE or (previous and previous[0] >= staged_at):
+                    os.remove(path)
+                    continue
+                if previous:
+                    os.remove(previous[1])
+            except FileNotFoundError:
+                continue
+            newest[code] = (staged_at, path)
+
+        pending = [(code, path) for code, (_, path) in newest.items()]
+        if pending:
+            def worker():
+                for code, path in pending:
+                    try:
+                        cls.attach_member_picture(code, path)
+                    except Exception as e:
+                        print(f"⚠️ تعذر استكمال رفع صورة العضو {code}: {e}")
+            threading.Thread(target=worker, daemon=True).start()
+        return len(pending)
+
+    @staticmethod
+    def notify_family_changed(codes, removed=None) -> None:
+        """نشر تغيّر أعضاء على مشتركي FamilyEvents (الفهارس في الذاكرة والمهام المشتقة) لتحديثها جزئياً"""
+        codes = list(codes)
+        # التغييرات الجماعية (مثل الاستيراد) أرخص بإعادة البناء مرة واحدة من التحديث عضواً بعضو
+        FamilyEvents.publish(codes, list(removed or []), bulk=len(codes) > FamilyService.BULK_REFRESH_THRESHOLD)
+
     @staticmethod
     def is_code_exists(code: str) -> bool:
         if not code or code.strip() == "": return False
@@ -543,25 +826,179 @@ class FamilyService:
             with conn.cursor() as cur:
                 cur.execute("SELECT 1 FROM family_name WHERE code = %s", (code.strip().upper(),))
                 return cur.fetchone() is not None
-    
-    @staticmethod       
-    def get_family_table_backup_text() -> str:
+
+    @staticmethod
+    def find_missing_codes(codes) -> list:
+        """التحقق من وجود عدة أكواد (الأب، الأم، الزوج...) باستعلام واحد وإرجاع غير الموجود منها"""
+        wanted = sorted({c.strip().upper() for c in codes if c and c.strip()})
+        if not wanted:
+            return []
         with get_db_context() as conn:
             with conn.cursor() as cur:
+                cur.execute("SELECT code FROM family_name WHERE code = ANY(%s)", (wanted,))
+                found = {row[0] for row in cur.fetchall()}
+        return [c for c in wanted if c not in found]
+    
+    # 🗄️ الجداول المشمولة في النسخة الاحتياطية النصية مع مفتاح الترتيب لكل جدول
+    BACKUP_TABLES = (
+        ("family_name", "code"),
+        ("family_info", "code_info"),
+        ("family_age_search", "code"),
+        ("family_picture", "code_pic"),
+    )
+    BACKUP_BATCH_ROWS = 500
+
+    @staticmethod
+    def iter_family_backup_sql() -> Iterator[str]:
+        """
+        مولّد نسخة احتياطية بصيغة أوامر INSERT مُهرّبة بشكل صحيح لجداول العائلة،
+        يقرأ كل جدول بمؤشر على الخادم ويرسل دفعات صغيرة دون الاحتفاظ بالجدول في الذاكرة.
+        """
+        with get_db_context() as conn:
+            codec = extensions.encodings.get(conn.encoding, "utf-8")
+            with conn.cursor() as meta_cur:
+                yield f"-- Hottiyya family backup generated at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
+                yield "BEGIN;\n\n"
+
+                for table, order_key in FamilyService.BACKUP_TABLES:
+                    # الأعمدة المحسوبة (GENERATED) لا تقبل الإدخال فنستبعدها
+                    meta_cur.execute("""
+                        SELECT column_name FROM information_schema.columns
+                        WHERE table_schema = 'public' AND table_name = %s AND is_generated = 'NEVER'
+                        ORDER BY ordinal_position
+                    """, (table,))
+                    columns = [r[0] for r in meta_cur.fetchall()]
+                    if not columns:
+                        yield f"-- {table}: الجدول غير موجود\n\n"
+                        continue
+
+                    column_list = ", ".join(f'"{c}"' for c in columns)
+                    placeholders = "(" + ", ".join(["%s"] * len(columns)) + ")"
+
+                    with conn.cursor(name=f"backup_{table}") as cur:
+                        cur.itersize = FamilyService.EXPORT_FETCH_SIZE
+                        cur.execute(f'SELECT {column_list} FROM "{table}" ORDER BY "{order_key}" ASC')
+
+                        yield f"-- {table}\n"
+                        while True:
+                            rows = cur.fetchmany(FamilyService.BACKUP_BATCH_ROWS)
+                            if not rows:
+                                break
+                            values = ",\n".join(meta_cur.mogrify(placeholders, row).decode(codec) for row in rows)
+                            yield f'INSERT INTO "{table}" ({column_list}) VALUES\n{values}\nON CONFLICT DO NOTHING;\n'
+                        yield "\n"
+
+                yield "COMMIT;\n"
+
+    # ===============================================
+    # 7.1 التوسيع الكسول للشجرة (عقدة + أبناؤها المباشرون + الأزواج)
+    # ===============================================
+    TREE_CHILDREN_PAGE = 50
+
+    @staticmethod
+    def infer_gender(gender: Optional[str], relation: Optional[str]) -> Optional[str]:
+        if gender or not relation:
+            return gender
+        if relation in ("ابن", "زوج", "ابن زوج", "ابن زوجة"): return "ذكر"
+        if relation in ("ابنة", "زوجة", "ابنة زوج", "ابنة زوجة"): return "أنثى"
+        return None
+
+    @staticmethod
+    def get_tree_node(code: str, cursor: Optional[str] = None, limit: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        """جلب عقدة واحدة مع صفحة من أبنائها المباشرين وأزواجها، مع مؤشر (cursor) لتحميل بقية الأبناء"""
+        clean_code = code.strip().upper()
+        limit = max(1, min(limit or FamilyService.TREE_CHILDREN_PAGE, 200))
+        node_columns = """
+            n.code, n.name, s.full_name, n.nick_name, n.level, n.relation, i.gender, s.updated_at,
+            EXISTS (SELECT 1 FROM family_name c WHERE c.f_code = n.code OR c.m_code = n.code) AS has_children
+        """
+        node_joins = """
+            FROM family_name n
+            LEFT JOIN family_info i ON n.code = i.code_info
+            LEFT JOIN family_search s ON n.code = s.code
+        """
+
+        def to_payload(row):
+            return {
+                "code": row["code"], "name": row["name"], "full_name": row["full_name"],
+                "nick_name": row["nick_name"], "level": row["level"],
+                "gender": FamilyService.infer_gender(row["gender"], row["relation"]),
+                "has_children": row["has_children"]
+            }
+
+        with get_db_context() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(f"SELECT {node_columns} {node_joins} WHERE n.code = %s", (clean_code,))
+                node = cur.fetchone()
+                if not node: return None
+
+                # الأبناء مرتبين بالكود ومقسمين بمؤشر (keyset) بدل OFFSET
+                cur.execute(f"""
+                    SELECT {node_columns} {node_joins}
+                    WHERE (n.f_code = %s OR n.m_code = %s) AND n.code > %s
+                    ORDER BY n.code ASC
+                    LIMIT %s
+                """, (clean_code, clean_code, cursor or "", limit + 1))
+                children = cur.fetchall()
+                next_cursor = None
+                if len(children) > limit:
+                    children = children[:limit]
+                    next_cursor = children[-1]["code"]
+
+                # الأزواج: من الحقول المباشرة ومن الأبناء المشتركين ومن الإشارات العكسية
+                spouses = []
+                if not cursor:
+                    cur.execute(f"""
+                        SELECT {node_columns} {node_joins}
+                        WHERE n.code IN (
+                            SELECT w_code FROM family_name WHERE code = %(c)s
+                            UNION SELECT h_code FROM family_name WHERE code = %(c)s
+                            UNION SELECT m_code FROM family_name WHERE f_code = %(c)s
+                            UNION SELECT f_code FROM family_name WHERE m_code = %(c)s
+                            UNION SELECT code FROM family_name WHERE w_code = %(c)s OR h_code = %(c)s
+                        ) AND n.code <> %(c)s
+                        ORDER BY n.code ASC
+                    """, {"c": clean_code})
+                    spouses = cur.fetchall()
+
+        # 🏷️ بصمة الاستجابة من أوقات تحديث family_search لكل العقد المعروضة ومن has_children:
+        # إضافة حفيد لا تغير صف الابن نفسه لكنها تغير ظهور سهم التوسيع عنده
+        version_parts = [f"{clean_code}|{cursor or ''}|{limit}"]
+        for row in [node, *spouses, *children]:
+            version_parts.append(f"{row['code']}@{row['updated_at'].isoformat() if row['updated_at'] else ''}"
+                                 f"#{int(bool(row['has_children']))}")
+        etag = hashlib.sha1("|".join(version_parts).encode("utf-8")).hexdigest()
+
+        return {
+            "node": to_payload(node),
+            "spouses": [to_payload(r) for r in spouses],
+            "children": [to_payload(r) for r in children],
+            "next_cursor": next_cursor,
+            "etag": etag
+        }
+
+    # ===============================================
+    # 7.2 تصدير العائلة كاملة بمؤشر على الخادم (Server-side Cursor)
+    # ===============================================
+    EXPORT_FETCH_SIZE = 2000  # عدد الصفوف التي تُجلب من القاعدة في كل دفعة
+
+    @staticmethod
+    def iter_all_family_members() -> Iterator[Dict[str, Any]]:
+        """مولّد يمرر أعضاء العائلة صفاً صفاً من مؤشر مسمّى دون تحميل الجدول كاملاً في الذاكرة"""
+        with get_db_context() as conn:
+            with conn.cursor(name="family_members_export", cursor_factory=RealDictCursor) as cur:
+                cur.itersize = FamilyService.EXPORT_FETCH_SIZE
                 cur.execute("""
-                    SELECT code, name, nick_name, f_code, m_code, relation, level, w_code, h_code 
-                    FROM family_name ORDER BY code ASC
+                    SELECT n.code, s.full_name, n.nick_name, i.gender, n.relation, n.level
+                    FROM family_name n
+                    LEFT JOIN family_info i ON n.code = i.code_info
+                    LEFT JOIN family_search s ON n.code = s.code
+                    ORDER BY n.code ASC
                 """)
-                rows = cur.fetchall()
-                lines = []
-                for row in rows:
-                    formatted_values = []
-                    for val in row:
-                        if val is None: formatted_values.append("NULL")
-                        elif isinstance(val, int): formatted_values.append(str(val))
-                        else: formatted_values.append(f"'{val}'")
-                    lines.append("(" + ", ".join(formatted_values) + "),")
-                return "\n".join(lines)               
+                for row in cur:
+                    row["gender"] = FamilyService.infer_gender(row["gender"], row["relation"])
+                    row["category"] = f"الجيل {row['level']}" if row["level"] is not None else ""
+                    yield row
 
     # ===============================================
     # 8. شجرة العائلة العودية المؤمنة من الحلقات الدائرية (DoS Protected)
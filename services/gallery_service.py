@@ -14,14 +14,11 @@ cloudinary.config(
     secure = True
 )
 
-def upload_to_cloudinary(file_stream):
-    """دالة لرفع الصورة باستخدام تدفق البيانات مباشرة وبشكل آمن"""
+def upload_to_cloudinary(file_path):
+    """دالة لرفع الصورة من ملف مستقبَل على القرص (يقرؤه Cloudinary على دفعات دون تحميله في الذاكرة)"""
     try:
-        file_stream.seek(0)
-        file_content = file_stream.read()
-        
         result = cloudinary.uploader.upload(
-            file_content, 
+            file_path, 
             folder="hottiyya_gallery",
             resource_type="image" # إجبار السحابة على معاملتها كصورة لحمايتها
         )
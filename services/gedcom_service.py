@@ -0,0 +1,393 @@
+# gedcom_service.py
+import html
+import codecs
+import re
+from datetime import date
+from typing import List, Dict, Optional, Any, Iterator, Tuple
+
+from psycopg2.extras import RealDictCursor
+
+from postgresql import get_db_context
+from services.family_service import FamilyService
+from services.family_import_service import FamilyImportService
+
+
+class GedcomService:
+    """
+    تصدير واستيراد شجرة العائلة بصيغة GEDCOM 5.5.1 لنقلها بين برامج الأنساب.
+    - التصدير: استعلام واحد بمؤشر مسمّى (Server-side) يمرر سجلات الأفراد ثم الأسر بذاكرة ثابتة.
+    - الاستيراد: مرور أول يمرر الأفراد لمسار الاستيراد الجماعي (COPY + دمج في معاملة واحدة)،
+      ومرور ثانٍ يمرر روابط الأسر التي تُحل إلى أكواد بالـ SQL، فلا يُحمّل الملف كاملاً في الذاكرة.
+    معرف الفرد في الملف هو الكود بدون شرطات (@IA1001001@)، والكود الأصلي محفوظ في REFN.
+    الأفراد القادمون من برامج أخرى بلا REFN بصيغة الموقع يُخصص لهم كود تلقائي (G0-000-001 ...).
+    """
+    VERSION = "5.5.1"
+    SOURCE = "HOTTIYYA"
+    MAX_VALUE_LENGTH = 200   # أقصى طول للقيمة في السطر قبل تقسيمها بـ CONC
+    MONTHS = ["JAN", "FEB", "MAR", "APR", "MAY", "JUN", "JUL", "AUG", "SEP", "OCT", "NOV", "DEC"]
+    DECEASED = ("متوفي", "متوفية")
+    LINE_PATTERN = re.compile(r"^\s*(\d+)\s+(?:(@[^@]+@)\s+)?(\S+)(?:\s(.*))?$")
+
+    # =======================================================
+    # 1. أدوات الصيغة
+    # =======================================================
+    @staticmethod
+    def person_xref(code: str) -> str:
+        return f"@I{code.replace('-', '')}@"
+
+    @classmethod
+    def _lines(cls, level: int, tag: str, value: Any = None, xref: Optional[str] = None) -> List[str]:
+        """سطر GEDCOM واحد، مع تقسيم القيم الطويلة (CONC) ومتعددة الأسطر (CONT)"""
+        head = f"{level} {xref} {tag}" if xref else f"{level} {tag}"
+        if value is None or value == "":
+            return [head]
+        out: List[str] = []
+        for index, part in enumerate(str(value).replace("\r\n", "\n").split("\n")):
+            chunks = [part[i:i + cls.MAX_VALUE_LENGTH] for i in range(0, len(part), cls.MAX_VALUE_LENGTH)] or [""]
+            for chunk_index, chunk in enumerate(chunks):
+                if index == 0 and chunk_index == 0:
+                    out.append(f"{head} {chunk}")
+                else:
+                    sub_tag = "CONC" if chunk_index else "CONT"
+                    out.append(f"{level + 1} {sub_tag} {chunk}".rstrip())
+        return out
+
+    @classmethod
+    def format_date(cls, value: Any) -> Optional[str]:
+        if isinstance(value, str):
+            try:
+                value = date.fromisoformat(value[:10])
+            except ValueError:
+                return None
+        if not isinstance(value, date):
+            return None
+        return f"{value.day} {cls.MONTHS[value.month - 1]} {value.year}"
+
+    @classmethod
+    def parse_date(cls, value: Optional[str]) -> Optional[str]:
+        """تحويل تاريخ GEDCOM الكامل (12 JAN 1990) إلى ISO؛ التواريخ التقريبية أو الناقصة تُتجاهل"""
+        if not value:
+            return None
+        parts = value.strip().upper().split()
+        if len(parts) != 3 or parts[1] not in cls.MONTHS:
+            return None
+        try:
+            return date(int(parts[2]), cls.MONTHS.index(parts[1]) + 1, int(parts[0])).isoformat()
+        except ValueError:
+            return None
+
+    @staticmethod
+    def _text(value: Any) -> Optional[str]:
+        # النصوص محفوظة مهربة (html.escape) في القاعدة، والملف يحمل النص الأصلي
+        if value is None:
+            return None
+        text = html.unescape(str(value)).strip()
+        return text or None
+
+    # =======================================================
+    # 2. التصدير المتدفق
+    # =======================================================
+    EXPORT_QUERY = """
+        WITH RECURSIVE subtree(code) AS (
+            SELECT code FROM family_name WHERE code = %(root)s
+            UNION
+            SELECT n.code FROM family_name n JOIN subtree s ON s.code IN (n.f_code, n.m_code)
+        ),
+        scope_raw(code) AS (
+            SELECT code FROM family_name WHERE %(root)s IS NULL
+            UNION SELECT code FROM subtree
+            -- أزواج أفراد الفرع وأمهات/آباء أبنائهم حتى تكتمل سجلات الأسر
+            UNION SELECT unnest(ARRAY[n.w_code, n.h_code]) FROM family_name n JOIN subtree s ON s.code = n.code
+            UNION SELECT n.code FROM family_name n JOIN subtree s ON s.code IN (n.w_code, n.h_code)
+            UNION SELECT unnest(ARRAY[n.f_code, n.m_code]) FROM family_name n
+                  JOIN subtree s ON s.code = n.code WHERE n.code <> %(root)s
+        ),
+        scope AS (
+            SELECT n.code FROM family_name n JOIN scope_raw r ON r.code = n.code
+        ),
+        members AS (
+            SELECT n.code, n.name, n.relation, n.level, n.nick_name,
+                   i.gender, i.email, i.phone, i.address, i.p_o_b, i.status, a.d_o_b, a.d_o_d,
+                   CASE WHEN n.f_code IN (SELECT code FROM scope) THEN n.f_code END AS ph,
+                   CASE WHEN n.m_code IN (SELECT code FROM scope) THEN n.m_code END AS pm,
+                   CASE WHEN n.w_code IN (SELECT code FROM scope) THEN n.w_code END AS spouse_w,
+                   CASE WHEN n.h_code IN (SELECT code FROM scope) THEN n.h_code END AS spouse_h
+            FROM family_name n
+            JOIN scope s ON s.code = n.code
+            LEFT JOIN family_info i ON i.code_info = n.code
+            LEFT JOIN family_age_search a ON a.code = n.code
+        ),
+        couples AS (
+            SELECT ph AS husb, pm AS wife FROM members WHERE ph IS NOT NULL OR pm IS NOT NULL
+            UNION SELECT code, spouse_w FROM members WHERE spouse_w IS NOT NULL
+            UNION SELECT spouse_h, code FROM members WHERE spouse_h IS NOT NULL
+        ),
+        fam AS (
+            SELECT husb, wife,
+                   'F' || upper(substr(md5(coalesce(husb, '') || '+' || coalesce(wife, '')), 1, 12)) AS fam_key
+            FROM couples
+        ),
+        fams AS (
+            SELECT code, array_agg(DISTINCT fam_key) AS fam_keys FROM (
+                SELECT husb AS code, fam_key FROM fam WHERE husb IS NOT NULL
+                UNION ALL SELECT wife, fam_key FROM fam WHERE wife IS NOT NULL
+            ) p GROUP BY code
+        ),
+        children AS (
+            SELECT 'F' || upper(substr(md5(coalesce(ph, '') || '+' || coalesce(pm, '')), 1, 12)) AS fam_key,
+                   array_agg(code ORDER BY code) AS child_codes
+            FROM members WHERE ph IS NOT NULL OR pm IS NOT NULL
+            GROUP BY 1
+        )
+        SELECT 0 AS kind, m.code AS record_key, m.code, m.name, m.relation, m.level, m.nick_name,
+               m.gender, m.email, m.phone, m.address, m.p_o_b, m.status, m.d_o_b, m.d_o_d,
+               m.spouse_w, m.spouse_h,
+               CASE WHEN m.ph IS NOT NULL OR m.pm IS NOT NULL THEN
+                   'F' || upper(substr(md5(coalesce(m.ph, '') || '+' || coalesce(m.pm, '')), 1, 12))
+               END AS famc,
+               f.fam_keys, NULL::text AS husb, NULL::text AS wife, NULL::text[] AS child_codes
+        FROM members m
+        LEFT JOIN fams f ON f.code = m.code
+        UNION ALL
+        SELECT 1, fam.fam_key, NULL, NULL, NULL, NULL, NULL,
+               NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL,
+               NULL, NULL, NULL, NULL, fam.husb, fam.wife, c.child_codes
+        FROM fam
+        LEFT JOIN children c ON c.fam_key = fam.fam_key
+        ORDER BY kind, record_key
+    """
+
+    @classmethod
+    def _header(cls) -> List[str]:
+        return [
+            "0 HEAD",
+            f"1 SOUR {cls.SOURCE}",
+            "2 NAME Hottiyya Family Tree",
+            f"1 DATE {cls.format_date(date.today())}",
+            "1 SUBM @SUBM@",
+            "1 GEDC",
+            f"2 VERS {cls.VERSION}",
+            "2 FORM LINEAGE-LINKED",
+            "1 CHAR UTF-8",
+            "0 @SUBM@ SUBM",
+            f"1 NAME {cls.SOURCE}",
+        ]
+
+    @classmethod
+    def _person_record(cls, row: Dict[str, Any]) -> List[str]:
+        code = row["code"]
+        gender = FamilyService.infer_gender(row["gender"], row["relation"])
+        name = cls._text(row["name"]) or ""
+        out = cls._lines(0, "INDI", xref=cls.person_xref(code))
+        out += cls._lines(1, "NAME", name)
+        out += cls._lines(2, "GIVN", name)
+        if cls._text(row["nick_name"]):
+            out += cls._lines(2, "NICK", cls._text(row["nick_name"]))
+        if gender in ("ذكر", "أنثى"):
+            out += cls._lines(1, "SEX", "M" if gender == "ذكر" else "F")
+
+        birth_date = cls.format_date(row["d_o_b"])
+        place = cls._text(row["p_o_b"])
+        if birth_date or place:
+            out += cls._lines(1, "BIRT")
+            if birth_date:
+                out += cls._lines(2, "DATE", birth_date)
+            if place:
+                out += cls._lines(2, "PLAC", place)
+
+        death_date = cls.format_date(row["d_o_d"])
+        if death_date:
+            out += cls._lines(1, "DEAT")
+            out += cls._lines(2, "DATE", death_date)
+        elif row["status"] in cls.DECEASED:
+            out += cls._lines(1, "DEAT", "Y")
+
+        address, phone, email = cls._text(row["address"]), cls._text(row["phone"]), cls._text(row["email"])
+        if address or phone or email:
+            out += cls._lines(1, "RESI")
+            if address:
+                out += cls._lines(2, "ADDR", address)
+            if phone:
+                out += cls._lines(2, "PHON", phone)
+            if email:
+                out += cls._lines(2, "EMAIL", email)
+
+        out += cls._lines(1, "REFN", code)
+        # وسوم خاصة بالتطبيق (تبدأ بشرطة سفلية حسب المواصفة) لحفظ بيانات لا مقابل لها في GEDCOM
+        if row["level"] is not None:
+            out += cls._lines(1, "_LVL", row["level"])
+        if cls._text(row["relation"]):
+            out += cls._lines(1, "_REL", cls._text(row["relation"]))
+        if row["status"]:
+            out += cls._lines(1, "_STAT", row["status"])
+        if row["spouse_w"]:
+            out += cls._lines(1, "_WIFE", cls.person_xref(row["spouse_w"]))
+        if row["spouse_h"]:
+            out += cls._lines(1, "_HUSB", cls.person_xref(row["spouse_h"]))
+
+        if row["famc"]:
+            out += cls._lines(1, "FAMC", f"@{row['famc']}@")
+        for fam_key in row["fam_keys"] or []:
+            out += cls._lines(1, "FAMS", f"@{fam_key}@")
+        return out
+
+    @classmethod
+    def _family_record(cls, row: Dict[str, Any]) -> List[str]:
+        out = cls._lines(0, "FAM", xref=f"@{row['record_key']}@")
+        if row["husb"]:
+            out += cls._lines(1, "HUSB", cls.person_xref(row["husb"]))
+        if row["wife"]:
+            out += cls._lines(1, "WIFE", cls.person_xref(row["wife"]))
+        for child in row["child_codes"] or []:
+            out += cls._lines(1, "CHIL", cls.person_xref(child))
+        return out
+
+    @classmethod
+    def iter_export(cls, root_code: Optional[str] = None) -> Iterator[str]:
+        """توليد ملف GEDCOM على دفعات نصية للعائلة كاملة أو لفرع يبدأ من root_code"""
+        yield "\n".join(cls._header()) + "\n"
+        with get_db_context() as conn:
+            with conn.cursor(name="family_gedcom_export", cursor_factory=RealDictCursor) as cur:
+                cur.itersize = FamilyService.EXPORT_FETCH_SIZE
+                cur.execute(cls.EXPORT_QUERY, {"root": root_code})
+                while True:
+                    rows = cur.fetchmany(FamilyService.EXPORT_FETCH_SIZE)
+                    if not rows:
+                        break
+                    lines: List[str] = []
+                    for row in rows:
+                        lines += cls._person_record(row) if row["kind"] == 0 else cls._family_record(row)
+                    yield "\n".join(lines) + "\n"
+        yield "0 TRLR\n"
+
+    # =======================================================
+    # 3. الاستيراد
+    # =======================================================
+    @classmethod
+    def _iter_records(cls, text_stream) -> Iterator[Tuple[Optional[str], str, List[Tuple[int, str, str]]]]:
+        """تقسيم الملف إلى سجلات المستوى صفر: (المعرف، الوسم، [(المستوى، الوسم، القيمة)])"""
+        xref, tag, lines = None, None, []
+        for number, raw in enumerate(text_stream, start=1):
+            raw = raw.rstrip("\r\n")
+            if not raw.strip():
+                continue
+            match = cls.LINE_PATTERN.match(raw)
+            if not match:
+                raise ValueError(f"سطر GEDCOM غير صالح رقم {number}")
+            level, line_xref, line_tag, value = int(match.group(1)), match.group(2), match.group(3).upper(), match.group(4) or ""
+            if level == 0:
+                if tag is not None:
+                    yield xref, tag, lines
+                xref, tag, lines = line_xref, line_tag, []
+            elif line_tag in ("CONC", "CONT") and lines:
+                prev_level, prev_tag, prev_value = lines[-1]
+                lines[-1] = (prev_level, prev_tag, prev_value + ("\n" if line_tag == "CONT" else "") + value)
+            else:
+                lines.append((level, line_tag, value))
+        if tag is not None:
+            yield xref, tag, lines
+
+    @classmethod
+    def _parse_person(cls, lines: List[Tuple[int, str, str]]) -> Dict[str, Any]:
+        person: Dict[str, Any] = {}
+        parent_tag = None
+        deceased = False
+        for level, tag, value in lines:
+            value = value.strip()
+            if level == 1:
+                parent_tag = tag
+                if tag == "NAME" and "name" not in person:
+                    # "الاسم /اللقب/": الجزء بين الشرطتين اسم العائلة ولا يُخزن في حقل الاسم
+                    person["name"] = re.sub(r"/[^/]*/", "", value).strip() or None
+                elif tag == "SEX":
+                    person["gender"] = {"M": "ذكر", "F": "أنثى"}.get(value.upper())
+                elif tag == "DEAT":
+                    deceased = True
+                elif tag == "REFN":
+                    person["code"] = value.upper()
+                elif tag in ("EMAIL", "PHON", "ADDR"):
+                    person.setdefault({"EMAIL": "email", "PHON": "phone", "ADDR": "address"}[tag], value)
+                elif tag == "_LVL":
+                    person["level"] = value
+                elif tag == "_REL":
+                    person["relation"] = value
+                elif tag == "_STAT":
+                    person["status"] = value
+                elif tag in ("_WIFE", "_HUSB"):
+                    person["_w_ref" if tag == "_WIFE" else "_h_ref"] = value
+            elif level == 2:
+                if parent_tag == "NAME" and tag == "GIVN":
+                    person["name"] = value
+                elif parent_tag == "NAME" and tag == "NICK":
+                    person["nick_name"] = value
+                elif parent_tag == "BIRT" and tag == "DATE":
+                    person["d_o_b"] = cls.parse_date(value)
+                elif parent_tag == "BIRT" and tag == "PLAC":
+                    person["p_o_b"] = value
+                elif parent_tag == "DEAT" and tag == "DATE":
+                    person["d_o_d"] = cls.parse_date(value)
+                elif parent_tag == "RESI" and tag in ("EMAIL", "PHON", "ADDR"):
+                    person.setdefault({"EMAIL": "email", "PHON": "phone", "ADDR": "address"}[tag], value)
+
+        if "status" not in person and deceased:
+            person["status"] = "متوفية" if person.get("gender") == "أنثى" else "متوفي"
+        return person
+
+    @classmethod
+    def _read_records(cls, binary_file) -> Iterator[Tuple[Optional[str], str, List[Tuple[int, str, str]]]]:
+        """مرور واحد على الملف من بدايته مع التحقق من الترميز؛ سجل واحد فقط في الذاكرة في كل لحظة"""
+        binary_file.seek(0)
+        # codecs بدل io.TextIOWrapper: ملف UploadFile هو SpooledTemporaryFile ولا يدعم readable() في Python 3.10
+        text = codecs.getreader("utf-8-sig")(binary_file, errors="strict")
+        try:
+            for xref, tag, lines in cls._iter_records(text):
+                if tag == "HEAD":
+                    charset = next((v.strip().upper() for lvl, t, v in lines if lvl == 1 and t == "CHAR"), "UTF-8")
+                    if charset not in ("UTF-8", "UTF8", "UNICODE"):
+                        raise ValueError(f"ترميز الملف {charset} غير مدعوم، يرجى حفظه بترميز UTF-8")
+                yield xref, tag, lines
+        except UnicodeDecodeError:
+            raise ValueError("الملف ليس بترميز UTF-8")
+
+    @classmethod
+    def read_people(cls, binary_file) -> Iterator[Dict[str, Any]]:
+        """
+        المرور الأول: سجلات الأفراد كصفوف بأعمدة FamilyImportService.COLUMNS مع معرف الفرد (xref).
+        REFN بصيغة أكواد الموقع يصبح كود العضو؛ غيره (أو غيابه) يُترك ليُخصص له كود عند الاستيراد.
+        """
+        for xref, tag, lines in cls._read_records(binary_file):
+            if tag != "INDI" or not xref:
+                continue
+            person = cls._parse_person(lines)
+            if person.get("code") and not re.fullmatch(FamilyImportService.CODE_PATTERN, person["code"]):
+                person["code"] = None
+            person["xref"] = xref
+            person["w_ref"] = person.pop("_w_ref", None)
+            person["h_ref"] = person.pop("_h_ref", None)
+            yield person
+
+    @classmethod
+    def read_families(cls, binary_file) -> Iterator[Tuple[int, Optional[str], Optional[str], Optional[str]]]:
+        """
+        المرور الثاني: سجلات الأسر كروابط (الترتيب، الزوج، الزوجة، الابن) بمعرفات xref تُحل بالـ SQL.
+        صف بلا ابن يعني رابط زواج؛ ملفات هذا التطبيق تحمل الزوج الأساسي صراحة في _WIFE / _HUSB فلا تحتاجه.
+        """
+        own_format = False
+        seq = 0
+        for _, tag, lines in cls._read_records(binary_file):
+            if tag == "HEAD":
+                own_format = any(lvl == 1 and t == "SOUR" and v.strip() == cls.SOURCE for lvl, t, v in lines)
+            elif tag == "FAM":
+                seq += 1
+                husband = next((v.strip() for lvl, t, v in lines if lvl == 1 and t == "HUSB"), None)
+                wife = next((v.strip() for lvl, t, v in lines if lvl == 1 and t == "WIFE"), None)
+                for child in (v.strip() for lvl, t, v in lines if lvl == 1 and t == "CHIL"):
+                    yield seq, husband, wife, child
+                # في ملفات البرامج الأخرى: الزوج الأساسي هو أول أسرة تجمع الزوجين
+                if husband and wife and not own_format:
+                    yield seq, husband, wife, None
+
+    @classmethod
+    def import_gedcom(cls, binary_file) -> Dict[str, Any]:
+        """استيراد ملف GEDCOM (UTF-8) بمرورين متدفقين عبر مسار الاستيراد الجماعي"""
+        return FamilyImportService.import_rows(cls.read_people(binary_file), links=cls.read_families(binary_file))
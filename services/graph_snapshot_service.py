@@ -0,0 +1,375 @@
+# graph_snapshot_service.py
+import os
+import mmap
+import time
+import fcntl
+import struct
+import hashlib
+import tempfile
+import threading
+from collections import deque
+from typing import List, Dict, Optional, Any, Tuple
+from psycopg2.extras import RealDictCursor
+
+from postgresql import get_db_context
+
+
+class _MappedGraph:
+    """
+    قراءة لقطة شجرة النسب مباشرة من ملف مربوط بالذاكرة (mmap) بدون نسخ:
+    كل المصفوفات memoryview فوق صفحات الملف، فتشترك كل العمليات (workers) في نفس الذاكرة الفعلية.
+    الأعضاء مرقّمون بترتيب أكوادهم، والأكواد بعرض ثابت لإيجاد رقم العضو ببحث ثنائي.
+    جداول القفز (up[k][i] = الجد رقم 2^k) محفوظة في اللقطة، فالجد المشترك الأقرب بـ O(log عمق).
+    بصمة كل فرع (subtree_hash) تتغير فقط إن تغيّر شيء يؤثر في تخطيطه، فتبقى تخطيطات الفروع الأخرى صالحة بين اللقطات.
+    """
+    __slots__ = ("generation", "count", "levels", "_map", "_codes", "_parent", "_father", "_mother",
+                 "_wife", "_husband", "_depth", "_up", "_subtree", "_gender", "_child_offsets", "_children",
+                 "_name_offsets", "_names")
+
+    GENDERS = (None, "ذكر", "أنثى")
+
+    def __init__(self, mapped: mmap.mmap):
+        header = GraphSnapshotService.HEADER
+        magic, fmt_version, generation, count, edges, names_len, levels = header.unpack_from(mapped, 0)
+        if magic != GraphSnapshotService.MAGIC or fmt_version != GraphSnapshotService.FORMAT_VERSION:
+            raise ValueError("ملف لقطة الشجرة غير متوافق")
+        self._map = mapped
+        self.generation = generation
+        self.count = count
+        self.levels = levels
+
+        view = memoryview(mapped)
+        offset = header.size
+        width = GraphSnapshotService.CODE_WIDTH
+
+        def take(size: int, fmt: Optional[str]):
+            nonlocal offset
+            section = view[offset:offset + size]
+            offset = GraphSnapshotService.align(offset + size)
+            return section.cast(fmt) if fmt else section
+
+        self._codes = take(count * width, None)
+        self._parent = take(count * 4, "i")
+        self._father = take(count * 4, "i")
+        self._mother = take(count * 4, "i")
+        self._wife = take(count * 4, "i")
+        self._husband = take(count * 4, "i")
+        self._depth = take(count * 4, "i")
+        self._up = take(levels * count * 4, "i")
+        self._subtree = take(count * 8, "Q")
+        self._gender = take(count, "B")
+        self._child_offsets = take((count + 1) * 4, "I")
+        self._children = take(edges * 4, "i")
+        self._name_offsets = take((count + 1) * 4, "I")
+        self._names = take(names_len, None)
+
+    # -------- الأكواد والأرقام --------
+    def code(self, index: int) -> str:
+        width = GraphSnapshotService.CODE_WIDTH
+        return bytes(self._codes[index * width:(index + 1) * width]).rstrip(b"\0").decode("ascii")
+
+    def index_of(self, code: Optional[str]) -> int:
+        if not code:
+            return -1
+        width = GraphSnapshotService.CODE_WIDTH
+        target = code.encode("ascii", "ignore")[:width].ljust(width, b"\0")
+        low, high = 0, self.count
+        while low < high:
+            mid = (low + high) // 2
+            if bytes(self._codes[mid * width:(mid + 1) * width]) < target:
+                low = mid + 1
+            else:
+                high = mid
+        if low < self.count and self._codes[low * width:(low + 1) * width] == target:
+            return low
+        return -1
+
+    # -------- بيانات العضو --------
+    def name(self, index: int) -> str:
+        return bytes(self._names[self._name_offsets[index]:self._name_offsets[index + 1]]).decode("utf-8")
+
+    def gender(self, index: int) -> Optional[str]:
+        return self.GENDERS[self._gender[index]]
+
+    def parent(self, index: int) -> int:
+        return self._parent[index]
+
+    def depth(self, index: int) -> int:
+        return self._depth[index]
+
+    def children(self, index: int) -> memoryview:
+        return self._children[self._child_offsets[index]:self._child_offsets[index + 1]]
+
+    def subtree_hash(self, index: int) -> int:
+        return self._subtree[index]
+
+    def subtree_hashes(self) -> memoryview:
+        return self._subtree
+
+    def relatives(self, index: int) -> Dict[str, int]:
+        return {"f_code": self._father[index], "m_code": self._mother[index],
+                "w_code": self._wife[index], "h_code": self._husband[index]}
+
+    def ancestor_at(self, index: int, steps: int) -> int:
+        if index < 0 or steps > self._depth[index]:
+            return -1
+        up, count, k = self._up, self.count, 0
+        while steps:
+            if steps & 1:
+                index = up[k * count + index]
+            steps >>= 1
+            k += 1
+        return index
+
+    def lowest_common_ancestor(self, a: int, b: int) -> int:
+        """رفع الأعمق إلى عمق الآخر ثم القفز بأكبر قوى 2 التي لا تلتقي عندها الفرعان (Binary Lifting)"""
+        if self._depth[a] < self._depth[b]:
+            a, b = b, a
+        a = self.ancestor_at(a, self._depth[a] - self._depth[b])
+        if a == b:
+            return a
+        up, count = self._up, self.count
+        for k in range(self.levels - 1, -1, -1):
+            row = k * count
+            if up[row + a] != up[row + b]:
+                a, b = up[row + a], up[row + b]
+        a, b = self._parent[a], self._parent[b]
+        return a if a == b else -1
+
+
+class GraphSnapshotService:
+    """
+    لقطة ثنائية بإصدار لشجرة النسب يكتبها worker واحد وتربطها كل العمليات للقراءة فقط:
+    أكواد بعرض ثابت، مصفوفات الآباء والأزواج والعمق، الأبناء بصيغة CSR (إزاحات + قائمة متصلة)،
+    وجدول نصوص للأسماء. الكتابة في ملف مؤقت ثم os.replace لتبديل ذري، وكل عملية تلاحظ تغيّر الملف
+    (stat) فتربط اللقطة الجديدة بدون إعادة تشغيل.
+    """
+    MAGIC = b"HFGS"
+    FORMAT_VERSION = 3
+    CODE_WIDTH = 16
+    HEADER = struct.Struct("<4sIQIIII")  # magic, format, generation, count, edges, names_len, levels
+    ALIGN = 8
+    GENDER_CODES = {"ذكر": 1, "أنثى": 2}
+
+    PATH = os.getenv("FAMILY_GRAPH_SNAPSHOT", os.path.join(tempfile.gettempdir(), "hottiyya_family_graph.bin"))
+    CHECK_INTERVAL_SECONDS = 1.0   # أقصى مدة قبل أن يلاحظ worker لقطة أحدث
+    REBUILD_DELAY_SECONDS = 3      # تجميع الكتابات المتتالية في إعادة بناء واحدة
+
+    _lock = threading.Lock()
+    _graph: Optional[_MappedGraph] = None
+    _file_id: Optional[Tuple[int, int]] = None
+    _checked_at = 0.0
+    _timer: Optional[threading.Timer] = None
+
+    @classmethod
+    def align(cls, offset: int) -> int:
+        return (offset + cls.ALIGN - 1) // cls.ALIGN * cls.ALIGN
+
+    # =======================================================
+    # 1. بناء اللقطة وكتابتها ذرياً
+    # =======================================================
+    @classmethod
+    def _encode(cls, rows: List[Dict[str, Any]], generation: int) -> bytes:
+        rows = sorted((r for r in rows if r["code"] and len(r["code"].encode("ascii", "ignore")) <= cls.CODE_WIDTH),
+                      key=lambda r: r["code"])
+        index = {r["code"]: i for i, r in enumerate(rows)}
+        count = len(rows)
+
+        def idx(code):
+            return index.get(code, -1) if code else -1
+
+        father = [idx(r["f_code"]) for r in rows]
+        mother = [idx(r["m_code"]) for r in rows]
+        wife = [idx(r["w_code"]) for r in rows]
+        husband = [idx(r["h_code"]) for r in rows]
+        # شجرة النسب الأساسية كما في KinshipService: الأب أولاً ثم الأم
+        parent = [f if f >= 0 else m for f, m in zip(father, mother)]
+
+        # العمق بالمرور من الجذور؛ العقد العالقة في حلقة خاطئة تصبح جذوراً مستقلة
+        children: List[List[int]] = [[] for _ in range(count)]
+        for i, p in enumerate(parent):
+            if p >= 0 and p != i:
+                children[p].append(i)
+        depth = [-1] * count
+        queue = deque(i for i in range(count) if parent[i] < 0 or parent[i] == i)
+        for i in queue:
+            parent[i] = -1
+            depth[i] = 0
+        while queue:
+            node = queue.popleft()
+            for child in children[node]:
+                if depth[child] < 0:
+                    depth[child] = depth[node] + 1
+                    queue.append(child)
+        for i in range(count):
+            if depth[i] < 0:
+                if parent[i] >= 0:
+                    children[parent[i]].remove(i)
+                parent[i], depth[i] = -1, 0
+                stack = [i]
+                while stack:
+                    node = stack.pop()
+                    for child in children[node]:
+                        if depth[child] < 0:
+                            depth[child] = depth[node] + 1
+                            stack.append(child)
+
+        # جداول القفز: الجذر يشير إلى نفسه حتى لا يخرج القفز من المصفوفة
+        levels = max(1, max(depth, default=0).bit_length())
+        up = [[p if p >= 0 else i for i, p in enumerate(parent)]]
+        for _ in range(1, levels):
+            previous = up[-1]
+            up.append([previous[previous[i]] for i in range(count)])
+
+        # بصمة الفرع من الأعمق إلى الجذور: كود العضو وأزواجه الموجودون، ثم لكل ابن كوده وأبواه وبصمة فرعه
+        # (هذا كل ما يقرأه TreeLayoutService لحساب تخطيط الفرع؛ الأسماء لا تدخل في التخطيط)
+        codes = [r["code"] for r in rows]
+
+        def code_of(i: int) -> str:
+            return codes[i] if i >= 0 else ""
+
+        subtree = [0] * count
+        for i in sorted(range(count), key=depth.__getitem__, reverse=True):
+            digest = hashlib.blake2b(f"{codes[i]}|{code_of(wife[i])}|{code_of(husband[i])}".encode("ascii"),
+                                     digest_size=8)
+            for child in sorted(children[i]):
+                digest.update(f"|{codes[child]}:{code_of(father[child])}:{code_of(mother[child])}:".encode("ascii"))
+                digest.update(subtree[child].to_bytes(8, "little"))
+            subtree[i] = int.from_bytes(digest.digest(), "little")
+
+        child_offsets, flat_children = [0], []
+        for kids in children:
+            flat_children.extend(kids)
+            child_offsets.append(len(flat_children))
+        name_offsets, names = [0], bytearray()
+        for r in rows:
+            names += (r["name"] or "").encode("utf-8")
+            name_offsets.append(len(names))
+
+        out = bytearray(cls.HEADER.pack(cls.MAGIC, cls.FORMAT_VERSION, generation, count,
+                                        len(flat_children), len(names), levels))
+
+        def put(data: bytes):
+            out.extend(data)
+            out.extend(b"\0" * (cls.align(len(out)) - len(out)))
+
+        put(b"".join(r["code"].encode("ascii").ljust(cls.CODE_WIDTH, b"\0") for r in rows))
+        for column in (parent, father, mother, wife, husband, depth):
+            put(struct.pack(f"<{count}i", *column))
+        put(b"".join(struct.pack(f"<{count}i", *level) for level in up))
+        put(struct.pack(f"<{count}Q", *subtree))
+        put(bytes(cls.GENDER_CODES.get(r["gender"], 0) for r in rows))
+        put(struct.pack(f"<{count + 1}I", *child_offsets))
+        put(struct.pack(f"<{len(flat_children)}i", *flat_children))
+        put(struct.pack(f"<{count + 1}I", *name_offsets))
+        put(bytes(names))
+        return bytes(out)
+
+    @classmethod
+    def rebuild(cls) -> None:
+        """قراءة الشجرة من القاعدة وكتابة لقطة جديدة؛ قفل ملف يمنع عدة workers من الكتابة معاً"""
+        from services.kinship_service import KinshipService
+        directory = os.path.dirname(cls.PATH) or "."
+        os.makedirs(directory, exist_ok=True)
+        with open(cls.PATH + ".lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                # الإصدار = وقت القراءة؛ أي تعديل بعده يجعل اللقطة قديمة في نظر الـ worker الذي كتب
+                generation = time.time_ns()
+                rows = [dict(r, gender=KinshipService._infer_gender(r["gender"], r["relation"]))
+                        for r in cls._fetch_rows()]
+                data = cls._encode(rows, generation)
+                fd, tmp_path = tempfile.mkstemp(prefix=".graph-", dir=directory)
+                try:
+                    with os.fdopen(fd, "wb") as f:
+                        f.write(data)
+                        f.flush()
+                        os.fsync(f.fileno())
+                    os.replace(tmp_path, cls.PATH)
+                except Exception:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                    raise
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        with cls._lock:
+            cls._checked_at = 0.0
+        print(f"🗺️ تم كتابة لقطة الشجرة المشتركة: {len(rows)} عضو ({len(data) // 1024} ك.ب).")
+
+    @staticmethod
+    def _fetch_rows() -> List[Dict[str, Any]]:
+        with get_db_context() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute("""
+                    SELECT n.code, n.name, n.f_code, n.m_code, n.w_code, n.h_code, n.relation, i.gender
+                    FROM family_name n
+                    LEFT JOIN family_info i ON n.code = i.code_info
+                """)
+                return cur.fetchall()
+
+    @classmethod
+    def schedule_rebuild(cls) -> None:
+        """إعادة بناء مؤجلة بعد الكتابة؛ الكتابات خلال فترة الانتظار تُدمج في لقطة واحدة"""
+        with cls._lock:
+            if cls._timer is not None:
+                return
+            timer = threading.Timer(cls.REBUILD_DELAY_SECONDS, cls._run_scheduled)
+            timer.daemon = True
+            cls._timer = timer
+        timer.start()
+
+    @classmethod
+    def _run_scheduled(cls) -> None:
+        with cls._lock:
+            cls._timer = None
+        try:
+            cls.rebuild()
+        except Exception as e:
+            print(f"⚠️ تعذر تحديث لقطة الشجرة المشتركة: {e}")
+
+    # =======================================================
+    # 2. الربط بالذاكرة والتبديل بدون إعادة تشغيل
+    # =======================================================
+    @classmethod
+    def current(cls) -> Optional[_MappedGraph]:
+        """اللقطة الحالية؛ فحص stat مرة كل ثانية على الأكثر لربط أي لقطة أحدث كتبها worker آخر"""
+        now = time.monotonic()
+        with cls._lock:
+            if now - cls._checked_at < cls.CHECK_INTERVAL_SECONDS:
+                return cls._graph
+            cls._checked_at = now
+            try:
+                stat = os.stat(cls.PATH)
+            except FileNotFoundError:
+                return cls._graph
+            file_id = (stat.st_ino, stat.st_mtime_ns)
+            if file_id == cls._file_id:
+                return cls._graph
+            try:
+                with open(cls.PATH, "rb") as f:
+                    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                # اللقطة القديمة تبقى صالحة لمن يقرأ منها حالياً وتُحرر عند انتهاء آخر مرجع
+                cls._graph = _MappedGraph(mapped)
+                cls._file_id = file_id
+            except (OSError, ValueError, struct.error) as e:
+                print(f"⚠️ تعذر ربط لقطة الشجرة: {e}")
+            return cls._graph
+
+    @classmethod
+    def serving_graph(cls) -> Optional[_MappedGraph]:
+        """
+        آخر لقطة سليمة حتى لو سبقتها كتابة: إعادة البناء المجدولة تعمل في الخلفية ويُربط ناتجها خلال ثوانٍ،
+        فلا يُبنى شيء داخل الطلب. None فقط إن لم تُكتب أي لقطة بعد (وحينها يُجدول بناؤها).
+        """
+        graph = cls.current()
+        if graph is None:
+            cls.ensure_available()
+        return graph
+
+    @classmethod
+    def ensure_available(cls) -> Optional[_MappedGraph]:
+        """ربط اللقطة الموجودة أو جدولة بنائها (لأول مرة أو بعد تغيّر صيغة الملف) بدون حجب الطلب الحالي"""
+        graph = cls.current()
+        if graph is None:
+            cls.schedule_rebuild()
+        return graph
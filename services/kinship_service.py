@@ -0,0 +1,346 @@
+# kinship_service.py
+import threading
+from collections import deque
+from typing import List, Dict, Optional, Any, Iterable
+from psycopg2.extras import RealDictCursor
+
+from postgresql import get_db_context
+from services.graph_snapshot_service import GraphSnapshotService
+
+
+class KinshipService:
+    """
+    حاسبة صلة القرابة بين عضوين باستخدام جدول القفز الثنائي (Binary Lifting)
+    لإيجاد أقرب جد مشترك (LCA) في O(log n) دون استعلامات عودية في القاعدة.
+
+    الشجرة المعتمدة هي شجرة النسب: الأب أولاً، ثم الأم إذا لم يكن الأب مسجلاً.
+    """
+    LOG = 20  # يكفي لعمق 2^20 جيل
+
+    _lock = threading.RLock()
+    _built = False
+    _parent: Dict[str, Optional[str]] = {}
+    _children: Dict[str, set] = {}
+    _depth: Dict[str, int] = {}
+    _up: Dict[str, List[str]] = {}
+    _info: Dict[str, Dict[str, Any]] = {}
+
+    # =======================================================
+    # 1. البناء والتحديث التزايدي
+    # =======================================================
+    @staticmethod
+    def _primary_parent(f_code: Optional[str], m_code: Optional[str]) -> Optional[str]:
+        return f_code or m_code or None
+
+    @staticmethod
+    def _infer_gender(gender: Optional[str], relation: Optional[str]) -> Optional[str]:
+        if gender or not relation:
+            return gender
+        if relation in ("ابن", "زوج", "ابن زوج", "ابن زوجة"): return "ذكر"
+        if relation in ("ابنة", "زوجة", "ابنة زوج", "ابنة زوجة"): return "أنثى"
+        return None
+
+    @classmethod
+    def _fetch_rows(cls, codes: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        query = """
+            SELECT n.code, n.name, n.f_code, n.m_code, n.w_code, n.h_code, n.relation, i.gender
+            FROM family_name n
+            LEFT JOIN family_info i ON n.code = i.code_info
+        """
+        with get_db_context() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                if codes is None:
+                    cur.execute(query)
+                else:
+                    cur.execute(query + " WHERE n.code = ANY(%s)", (codes,))
+                return cur.fetchall()
+
+    @classmethod
+    def _set_node(cls, row: Dict[str, Any]) -> None:
+        code = row["code"]
+        cls._info[code] = {
+            "name": row["name"],
+            "gender": cls._infer_gender(row["gender"], row["relation"]),
+            "f_code": row["f_code"],
+            "m_code": row["m_code"],
+            "w_code": row["w_code"],
+            "h_code": row["h_code"],
+        }
+        cls._children.setdefault(code, set())
+
+    @classmethod
+    def _link(cls, code: str, parent: Optional[str]) -> None:
+        old_parent = cls._parent.get(code)
+        if old_parent and old_parent in cls._children:
+            cls._children[old_parent].discard(code)
+        # تجاهل الروابط إلى أعضاء غير موجودين أو التي تصنع حلقة دائرية
+        if parent and (parent not in cls._info or cls._is_ancestor(code, parent)):
+            parent = None
+        cls._parent[code] = parent
+        if parent:
+            cls._children.setdefault(parent, set()).add(code)
+
+    @classmethod
+    def _is_ancestor(cls, ancestor: str, node: str) -> bool:
+        """هل ancestor جد للعقدة node (أو هو نفسها) في البنية الحالية؟"""
+        current, steps = node, 0
+        while current and steps <= len(cls._parent):
+            if current == ancestor:
+                return True
+            current = cls._parent.get(current)
+            steps += 1
+        return False
+
+    @classmethod
+    def _recompute_subtree(cls, root: str) -> None:
+        """إعادة حساب العمق وجدول القفز لعقدة وكل فرعها (الأصول تُحسب قبل الفروع)"""
+        queue = deque([root])
+        while queue:
+            code = queue.popleft()
+            parent = cls._parent.get(code)
+            if parent:
+                cls._depth[code] = cls._depth[parent] + 1
+                up = [parent]
+                for k in range(1, cls.LOG):
+                    up.append(cls._up[up[k - 1]][k - 1])
+            else:
+                # الجذر يشير إلى نفسه في كل المستويات
+                cls._depth[code] = 0
+                up = [code] * cls.LOG
+            cls._up[code] = up
+            queue.extend(cls._children.get(code, ()))
+
+    @classmethod
+    def rebuild(cls) -> None:
+        with cls._lock:
+            rows = cls._fetch_rows()
+            cls._parent, cls._children, cls._depth, cls._up, cls._info = {}, {}, {}, {}, {}
+            for row in rows:
+                cls._set_node(row)
+            for row in rows:
+                cls._link(row["code"], cls._primary_parent(row["f_code"], row["m_code"]))
+            for code, parent in cls._parent.items():
+                if not parent:
+                    cls._recompute_subtree(code)
+            cls._built = True
+            print(f"🧬 تم بناء جدول القرابة (LCA): {len(cls._info)} عضو.")
+
+    @classmethod
+    def ensure_built(cls) -> None:
+        if cls._built:
+            return
+        with cls._lock:
+            if not cls._built:
+                cls.rebuild()
+
+    @classmethod
+    def release(cls) -> None:
+        """تحرير نسخة الـ worker الخاصة من الشجرة بعد ربط لقطة مشتركة؛ تُبنى مرة أخرى فقط إن اختفت اللقطة"""
+        if not cls._built:
+            return
+        with cls._lock:
+            if not cls._built:
+                return
+            cls._parent, cls._children, cls._depth, cls._up, cls._info = {}, {}, {}, {}, {}
+            cls._built = False
+            print("🧬 تم تحرير جدول القرابة من ذاكرة الـ worker: اللقطة المشتركة متاحة.")
+
+    @classmethod
+    def refresh_codes(cls, codes: Iterable[str]) -> None:
+        """تحديث تزايدي بعد تغيّر f_code/m_code: يُعاد حساب فرع العضو المتغير فقط"""
+        codes = [c for c in set(codes) if c]
+        if not codes or not cls._built:
+            return
+        rows = {r["code"]: r for r in cls._fetch_rows(codes)}
+        with cls._lock:
+            for code in codes:
+                row = rows.get(code)
+                if not row:
+                    cls._remove(code)
+                    continue
+                old = cls._info.get(code)
+                cls._set_node(row)
+                new_parent = cls._primary_parent(row["f_code"], row["m_code"])
+                if old is None or new_parent != cls._parent.get(code) or code not in cls._up:
+                    cls._link(code, new_parent)
+                    cls._recompute_subtree(code)
+
+    @classmethod
+    def remove_codes(cls, codes: Iterable[str]) -> None:
+        if not cls._built:
+            return
+        with cls._lock:
+            for code in codes:
+                cls._remove(code)
+
+    @classmethod
+    def _remove(cls, code: str) -> None:
+        if code not in cls._info:
+            return
+        parent = cls._parent.pop(code, None)
+        if parent and parent in cls._children:
+            cls._children[parent].discard(code)
+        orphans = cls._children.pop(code, set())
+        for key in (cls._depth, cls._up, cls._info):
+            key.pop(code, None)
+        # الأبناء يصبحون جذوراً مستقلة بعد حذف الأصل
+        for child in orphans:
+            cls._parent[child] = None
+            cls._recompute_subtree(child)
+
+    @classmethod
+    def on_family_changed(cls, codes: List[str], removed: List[str], bulk: bool) -> None:
+        """مشترك FamilyEvents: التغيير الجماعي يعيد بناء الجدول مرة واحدة، وغيره يحدّث الأعضاء المتغيرين فقط"""
+        if removed:
+            cls.remove_codes(removed)
+        if bulk and cls._built:
+            cls.rebuild()
+        else:
+            cls.refresh_codes(codes)
+
+    # =======================================================
+    # 2. أقرب جد مشترك
+    # =======================================================
+    @classmethod
+    def _ancestor_at(cls, code: str, steps: int) -> str:
+        k = 0
+        while steps:
+            if steps & 1:
+                code = cls._up[code][k]
+            steps >>= 1
+            k += 1
+        return code
+
+    @classmethod
+    def lowest_common_ancestor(cls, a: str, b: str) -> Optional[str]:
+        if cls._depth[a] < cls._depth[b]:
+            a, b = b, a
+        a = cls._ancestor_at(a, cls._depth[a] - cls._depth[b])
+        if a == b:
+            return a
+        for k in range(cls.LOG - 1, -1, -1):
+            if cls._up[a][k] != cls._up[b][k]:
+                a, b = cls._up[a][k], cls._up[b][k]
+        # إذا لم يلتقيا عند الجذر فهما من فرعين منفصلين
+        return cls._parent.get(a) if cls._parent.get(a) and cls._parent.get(a) == cls._parent.get(b) else None
+
+    # =======================================================
+    # 3. التسمية العربية لصلة القرابة
+    # =======================================================
+    @staticmethod
+    def _label(gender_of, parent_of, ancestor_at, a, b, dist_a: int, dist_b: int) -> str:
+        """
+        صلة العضو b بالنسبة للعضو a. الدوال الممررة تقرأ من مصدر الشجرة (القواميس في الذاكرة
+        أو اللقطة المشتركة)، فتُكتب قواعد التسمية مرة واحدة لكليهما.
+        """
+        def gendered(node, male: str, female: str) -> str:
+            return female if gender_of(node) == "أنثى" else male
+
+        if dist_a == 0 and dist_b == 0:
+            return "نفس الشخص"
+        if dist_a == 0:
+            if dist_b == 1: return gendered(b, "ابن", "ابنة")
+            if dist_b == 2: return gendered(b, "حفيد", "حفيدة")
+            return gendered(b, f"حفيد من الجيل {dist_b}", f"حفيدة من الجيل {dist_b}")
+        if dist_b == 0:
+            if dist_a == 1: return gendered(b, "أب", "أم")
+            if dist_a == 2: return gendered(b, "جد", "جدة")
+            return gendered(b, f"جد أعلى (قبل {dist_a} أجيال)", f"جدة عليا (قبل {dist_a} أجيال)")
+
+        # الفرع الذي ينحدر منه الطرف الثاني مباشرة تحت الجد المشترك
+        branch_b = ancestor_at(b, dist_b - 1)
+        a_parent = parent_of(a)
+
+        if dist_a == 1 and dist_b == 1:
+            return gendered(b, "أخ", "أخت")
+        if dist_a == 2 and dist_b == 1:
+            paternal = gender_of(a_parent) != "أنثى"
+            return gendered(b, "عم" if paternal else "خال", "عمة" if paternal else "خالة")
+        if dist_a == 1 and dist_b == 2:
+            sibling = gendered(branch_b, "أخ", "أخت")
+            return gendered(b, f"ابن {sibling}", f"ابنة {sibling}")
+        if dist_a == 2 and dist_b == 2:
+            paternal = gender_of(a_parent) != "أنثى"
+            if gender_of(branch_b) == "أنثى":
+                uncle = "عمة" if paternal else "خالة"
+            else:
+                uncle = "عم" if paternal else "خال"
+            return gendered(b, f"ابن {uncle}", f"ابنة {uncle}")
+        return f"قريب من الدرجة {dist_a + dist_b} (يلتقيان في الجد المشترك بعد {dist_a} و {dist_b} أجيال)"
+
+    @classmethod
+    def kinship_label(cls, a: str, b: str, dist_a: int, dist_b: int) -> str:
+        """صلة العضو b بالنسبة للعضو a"""
+        return cls._label(
+            lambda code: cls._info.get(code, {}).get("gender"),
+            cls._parent.get, cls._ancestor_at, a, b, dist_a, dist_b,
+        )
+
+    @classmethod
+    def _relationship_from_snapshot(cls, graph, a: str, b: str) -> Optional[Dict[str, Any]]:
+        """نفس النتيجة من اللقطة المشتركة (mmap) بدون نسخ البيانات إلى ذاكرة هذا الـ worker"""
+        ia, ib = graph.index_of(a), graph.index_of(b)
+        if ia < 0 or ib < 0:
+            return None
+        result = {
+            "a": {"code": a, "name": graph.name(ia)},
+            "b": {"code": b, "name": graph.name(ib)},
+            "common_ancestor": None,
+            "distance_a": None,
+            "distance_b": None,
+            "generational_distance": graph.depth(ia) - graph.depth(ib),
+            "label": "لا توجد صلة نسب مسجلة بينهما",
+        }
+        lca = graph.lowest_common_ancestor(ia, ib)
+        if lca < 0:
+            return result
+        dist_a = graph.depth(ia) - graph.depth(lca)
+        dist_b = graph.depth(ib) - graph.depth(lca)
+        result.update({
+            "common_ancestor": {"code": graph.code(lca), "name": graph.name(lca)},
+            "distance_a": dist_a,
+            "distance_b": dist_b,
+            "generational_distance": dist_a - dist_b,
+            "label": cls._label(
+                lambda i: graph.gender(i) if i >= 0 else None,
+                graph.parent, graph.ancestor_at, ia, ib, dist_a, dist_b,
+            ),
+        })
+        return result
+
+    @classmethod
+    def get_relationship(cls, code_a: str, code_b: str) -> Optional[Dict[str, Any]]:
+        a, b = code_a.strip().upper(), code_b.strip().upper()
+        # اللقطة المشتركة بين الـ workers هي المصدر (آخر لقطة سليمة أثناء إعادة البناء في الخلفية)،
+        # والقواميس في الذاكرة تُبنى فقط قبل كتابة أول لقطة وتُحرر بمجرد ربطها
+        graph = GraphSnapshotService.serving_graph()
+        if graph is not None:
+            cls.release()
+            return cls._relationship_from_snapshot(graph, a, b)
+
+        cls.ensure_built()
+        with cls._lock:
+            if a not in cls._info or b not in cls._info:
+                return None
+            lca = cls.lowest_common_ancestor(a, b)
+            result = {
+                "a": {"code": a, "name": cls._info[a]["name"]},
+                "b": {"code": b, "name": cls._info[b]["name"]},
+                "common_ancestor": None,
+                "distance_a": None,
+                "distance_b": None,
+                "generational_distance": cls._depth[a] - cls._depth[b],
+                "label": "لا توجد صلة نسب مسجلة بينهما",
+            }
+            if not lca:
+                return result
+            dist_a = cls._depth[a] - cls._depth[lca]
+            dist_b = cls._depth[b] - cls._depth[lca]
+            result.update({
+                "common_ancestor": {"code": lca, "name": cls._info[lca]["name"]},
+                "distance_a": dist_a,
+                "distance_b": dist_b,
+                "generational_distance": dist_a - dist_b,
+                "label": cls.kinship_label(a, b, dist_a, dist_b),
+            })
+            return result
@@ -0,0 +1,400 @@
+# library_job_service.py
+import os
+import re
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+import traceback
+from contextlib import contextmanager
+from typing import Optional, Dict, Any, List, Iterable
+
+import cloudinary.uploader
+from psycopg2.extras import RealDictCursor
+from postgresql import get_db_context
+from services.library_service import LibraryService
+from services.pdf_render_service import PdfRenderService
+
+
+def compress_pdf(path: str, compressed: str, timeout: int) -> str:
+    """
+    ضغط ملف PDF بـ Ghostscript (عملية خارجية مستقلة) إلى compressed وإرجاع مسار الملف النهائي.
+    الأصل لا يُحذف هنا؛ عند الفشل أو تجاوز المهلة يُعاد الأصل دون ضغط.
+    """
+    gs_command = ["gs", "-sDEVICE=pdfwrite", "-dCompatibilityLevel=1.4", "-dPDFSETTINGS=/ebook",
+                  "-dNOPAUSE", "-dQUIET", "-dBATCH", f"-sOutputFile={compressed}", path]
+    try:
+        # subprocess.run يقتل Ghostscript عند تجاوز المهلة فيتحرر العامل للمهمة التالية
+        subprocess.run(gs_command, timeout=timeout, check=False)
+    except subprocess.TimeoutExpired:
+        print(f"⚠️ تجاوز الضغط المهلة، سيُرفع الملف دون ضغط: {os.path.basename(path)}")
+    except FileNotFoundError:
+        print("⚠️ Ghostscript غير مثبت، سيُرفع الملف دون ضغط.")
+
+    if os.path.exists(compressed) and os.path.getsize(compressed) > 0:
+        return compressed
+    if os.path.exists(compressed):
+        os.remove(compressed)
+    return path
+
+
+class LibraryJobService:
+    """
+    طابور معالجة كتب المكتبة في الخلفية بحدود واضحة بدل معالجتها داخل طلب الرفع:
+    - يُحفظ الملف في JOBS_DIR ويُسجل الكتاب بحالة queued ويُرد على المستخدم فوراً.
+    - الطابور هو جدول library نفسه: العمال في كل الـ workers يحجزون المهام من القاعدة
+      (FOR UPDATE SKIP LOCKED) بحد عام (LIBRARY_JOB_CONCURRENCY) لعدد الكتب في حالة processing،
+      فلا يتضاعف الحمل على المعالج بعدد عمليات gunicorn.
+      Ghostscript عملية خارجية بمهلة، والغلاف وعدد الصفحات ومعاينات أول PREVIEW_PAGES صفحات
+      عبر PdfRenderService (دفعات صفحات موزعة على عمال الـ Process Pool).
+    - لكل مهمة مهلة (LIBRARY_JOB_TIMEOUT ثانية) وبعدها تُعلّم بالخطأ.
+    - العامل يجدد processing_heartbeat_at طوال المهمة (ومنها الرفع للتخزين السحابي)، فلا تُعاد للطابور
+      إلا مهمة توقف نبضها لأن عمليتها ماتت، مهما طال رفع ملف كبير.
+    - نواتج المعالجة (الملف المضغوط، الغلاف، المعاينات) في WORK_DIR/<رقم الكتاب>، والأصل يبقى في JOBS_DIR
+      حتى تنتهي المهمة فيمكن إعادة تشغيلها من البداية.
+    - الحالات: queued → processing → ready / error، وتستعلم عنها الواجهة دورياً.
+    """
+    WORKERS = max(1, int(os.getenv("LIBRARY_JOB_WORKERS", "2")))
+    CONCURRENCY = max(1, int(os.getenv("LIBRARY_JOB_CONCURRENCY", str(WORKERS))))
+    JOB_TIMEOUT = int(os.getenv("LIBRARY_JOB_TIMEOUT", "600"))
+    MAX_QUEUED = int(os.getenv("LIBRARY_JOB_QUEUE_MAX", "20"))
+    PREVIEW_PAGES = int(os.getenv("LIBRARY_PREVIEW_PAGES", "6"))
+    JOBS_DIR = os.getenv("LIBRARY_JOBS_DIR", os.path.join(tempfile.gettempdir(), "hottiyya_library_jobs"))
+    WORK_DIR = os.getenv("LIBRARY_WORK_DIR", os.path.join(tempfile.gettempdir(), "hottiyya_library_work"))
+    HEARTBEAT_SECONDS = 30
+    STALE_HEARTBEAT_SECONDS = HEARTBEAT_SECONDS * 4
+    ACTIVE_STATUSES = ("queued", "processing")
+    POLL_SECONDS = 5   # العامل الخامل يعيد محاولة الحجز بعدها (مهام أدرجها worker آخر)
+    CLAIM_LOCK = "hottiyya_library_jobs"
+
+    _wakeup = threading.Event()
+    _threads: List[threading.Thread] = []
+    _filenames: Dict[int, str] = {}   # الاسم الأصلي للملفات المدرجة من هذه العملية
+    _lock = threading.Lock()
+
+    # =======================================================
+    # 1. العمال
+    # =======================================================
+    @classmethod
+    def ensure_started(cls) -> None:
+        with cls._lock:
+            if cls._threads:
+                return
+            for index in range(cls.WORKERS):
+                thread = threading.Thread(target=cls._worker, name=f"library-job-{index}", daemon=True)
+                thread.start()
+                cls._threads.append(thread)
+
+    @classmethod
+    def _worker(cls) -> None:
+        while True:
+            try:
+                job = cls._claim_next()
+            except Exception:
+                traceback.print_exc()
+                job = None
+            if job is None:
+                cls._wakeup.wait(cls.POLL_SECONDS)
+                cls._wakeup.clear()
+                continue
+            try:
+                with cls._heartbeat(job[0]):
+                    cls._run(*job)
+            except Exception:
+                traceback.print_exc()
+
+    @classmethod
+    @contextmanager
+    def _heartbeat(cls, book_id: int):
+        """تجديد نبض المهمة كل HEARTBEAT_SECONDS حتى تنتهي (نجاحاً أو فشلاً)"""
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(cls.HEARTBEAT_SECONDS):
+                try:
+                    with get_db_context() as conn:
+                        with conn.cursor() as cur:
+                            cur.execute("""
+                                UPDATE library SET processing_heartbeat_at = NOW()
+                                WHERE id = %s AND processing_status = 'processing'
+                            """, (book_id,))
+                            conn.commit()
+                except Exception as e:
+                    print(f"⚠️ تعذر تجديد نبض معالجة الكتاب {book_id}: {e}")
+
+        thread = threading.Thread(target=beat, name=f"library-heartbeat-{book_id}", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+
+    # =======================================================
+    # 2. إدارة الحالة في قاعدة البيانات
+    # =======================================================
+    @classmethod
+    def _job_files(cls) -> Dict[int, str]:
+        """ملفات المهام الموجودة في JOBS_DIR حسب رقم الكتاب"""
+        files: Dict[int, str] = {}
+        if os.path.isdir(cls.JOBS_DIR):
+            for name in os.listdir(cls.JOBS_DIR):
+                book_id = name.split("__", 1)[0]
+                if book_id.isdigit() and not name.endswith((".jpg", ".tmp")):
+                    files[int(book_id)] = os.path.join(cls.JOBS_DIR, name)
+        return files
+
+    @classmethod
+    def _claim_next(cls) -> Optional[tuple]:
+        """
+        حجز أقدم كتاب في الطابور له ملف جاهز، ما دام عدد الكتب الجارية في كل الـ workers أقل من CONCURRENCY.
+        قفل المعاملة (advisory) يُسلسل العد والحجز بين العمليات فلا يتجاوز الحد بتزامن حجزين.
+        """
+        files = cls._job_files()
+        if not files:
+            return None
+        with get_db_context() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (cls.CLAIM_LOCK,))
+                # مهام توقف نبضها: عمليتها ماتت، فلا تحجز مكاناً من الحد العام وتعود للطابور
+                cur.execute("""
+                    UPDATE library SET processing_status = 'queued'
+                    WHERE processing_status = 'processing'
+                      AND COALESCE(processing_heartbeat_at, processing_started_at) < NOW() - make_interval(secs => %s)
+                """, (cls.STALE_HEARTBEAT_SECONDS,))
+                cur.execute("""
+                    UPDATE library SET processing_status = 'processing', processing_started_at = NOW(),
+                        processing_heartbeat_at = NOW()
+                    WHERE id = (
+                        SELECT id FROM library
+                        WHERE processing_status = 'queued' AND id = ANY(%(ids)s)
+                          AND (SELECT COUNT(*) FROM library WHERE processing_status = 'processing') < %(limit)s
+                        ORDER BY id
+                        LIMIT 1
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING id, cover_url
+                """, {"ids": list(files), "limit": cls.CONCURRENCY})
+                row = cur.fetchone()
+                conn.commit()
+        if not row:
+            return None
+        path = files[row["id"]]
+        with cls._lock:
+            filename = cls._filenames.pop(row["id"], None) or os.path.basename(path).split("__", 1)[1]
+        render_cover = path.lower().endswith(".pdf") and not row["cover_url"]
+        return row["id"], path, filename, render_cover
+
+    @staticmethod
+    def set_status(book_id: int, status: str, error: Optional[str] = None) -> None:
+        with get_db_context() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE library SET
+                        processing_status = %(status)s,
+                        processing_error = %(error)s,
+                        file_url = CASE WHEN %(status)s = 'error' THEN 'error' ELSE file_url END
+                    WHERE id = %(id)s
+                """, {"status": status, "error": (error or None) and error[:500], "id": book_id})
+                conn.commit()
+
+    @staticmethod
+    def get_statuses(book_ids: Iterable[int]) -> Dict[int, Dict[str, Any]]:
+        ids = list(book_ids)
+        if not ids:
+            return {}
+        with get_db_context() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute("""
+                    SELECT id, processing_status AS status, processing_error AS error
+                    FROM library WHERE id = ANY(%s)
+                """, (ids,))
+                return {row["id"]: {"status": row["status"], "error": row["error"]} for row in cur.fetchall()}
+
+    # =======================================================
+    # 3. الإدراج في الطابور
+    # =======================================================
+    @classmethod
+    def has_capacity(cls) -> bool:
+        """سعة الطابور العام (كل الـ workers) وليس طابور هذه العملية"""
+        with get_db_context() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT COUNT(*) FROM library WHERE processing_status = 'queued'")
+                return cur.fetchone()[0] < cls.MAX_QUEUED
+
+    @classmethod
+    def _job_path(cls, book_id: int, filename: str) -> str:
+        base, ext = os.path.splitext(filename)
+        clean = re.sub(r'[^\w-]', '_', base).strip('_')[:80] or "book"
+        return os.path.join(cls.JOBS_DIR, f"{book_id}__{clean}{ext.lower()}")
+
+    @classmethod
+    def submit(cls, book_id: int, staged_path: str, filename: str, render_cover: bool) -> bool:
+        """
+        ربط الملف المؤقت بالكتاب (المسجل بحالة queued) وإيقاظ العمال؛ أي عامل في أي worker قد يحجزه.
+        render_cover محفوظ ضمنياً في الكتاب: PDF بلا غلاف يدوي (cover_url فارغ).
+        """
+        cls.ensure_started()
+        path = cls._job_path(book_id, filename)
+        with cls._lock:
+            cls._filenames[book_id] = filename
+        os.replace(staged_path, path)
+        cls._wakeup.set()
+        return True
+
+    # =======================================================
+    # 4. تنفيذ المهمة
+    # =======================================================
+    @classmethod
+    def _work_dir(cls, book_id: int) -> str:
+        return os.path.join(cls.WORK_DIR, str(book_id))
+
+    @classmethod
+    def _run(cls, book_id: int, path: str, filename: str, render_cover: bool) -> None:
+        work_dir = cls._work_dir(book_id)
+        # مهمة أعيدت للطابور بعد موت عمليتها تبدأ من الأصل بمجلد عمل نظيف
+        shutil.rmtree(work_dir, ignore_errors=True)
+        os.makedirs(work_dir, exist_ok=True)
+        try:
+            cls._process(book_id, path, filename, render_cover, work_dir)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+            if os.path.exists(path):
+                os.remove(path)
+
+    @classmethod
+    def _process(cls, book_id: int, path: str, filename: str, render_cover: bool, work_dir: str) -> None:
+        print(f"📚 بدء معالجة الكتاب رقم {book_id}...")
+        started = time.monotonic()
+        final_path, cover_path, page_count = path, None, None
+        try:
+            if path.lower().endswith(".pdf"):
+                final_path = compress_pdf(path, os.path.join(work_dir, "compressed.pdf"), cls.JOB_TIMEOUT)
+                remaining = max(1, int(cls.JOB_TIMEOUT - (time.monotonic() - started)))
+                if render_cover:
+                    cover_path = os.path.join(work_dir, "cover.jpg")
+                    info = PdfRenderService.render_cover(final_path, cover_path, timeout=remaining)
+                else:
+                    info = PdfRenderService.inspect(final_path, timeout=remaining)
+                page_count = info.get("page_count")
+        except Exception as e:
+            cls._fail(book_id, str(e) or e.__class__.__name__)
+            return
+
+        if cover_path and os.path.exists(cover_path):
+            try:
+                cover_res = cloudinary.uploader.upload(cover_path, folder="hottiyya_library/covers")
+                cover_url = cover_res.get("secure_url")
+                if cover_url:
+                    with get_db_context() as conn:
+                        with conn.cursor() as cur:
+                            cur.execute("UPDATE library SET cover_url = %s WHERE id = %s", (cover_url, book_id))
+                            conn.commit()
+            except Exception as e:
+                print(f"⚠️ تعذر رفع غلاف الكتاب {book_id}: {e}")
+
+        if page_count:
+            remaining = max(1, int(cls.JOB_TIMEOUT - (time.monotonic() - started)))
+            cls._upload_previews(book_id, final_path, min(page_count, cls.PREVIEW_PAGES), remaining,
+                                 os.path.join(work_dir, "previews"))
+
+        file_size_mb = os.path.getsize(final_path) / (1024 * 1024)
+        with get_db_context() as conn:
+            with conn.cursor() as cur:
+                cur.execute("UPDATE library SET file_size = %s, page_count = COALESCE(%s, page_count) WHERE id = %s",
+                            (f"{file_size_mb:.2f} MB", page_count, book_id))
+                conn.commit()
+
+        # الرفع للتخزين السحابي يضبط الحالة النهائية (ready / error) ويحذف الملف المحلي
+        LibraryService.background_upload(final_path, filename, book_id)
+
+    @staticmethod
+    def _upload_previews(book_id: int, path: str, pages: int, timeout: int, out_dir: str) -> None:
+        """معاينات الصفحات الأولى (تُعرض في بطاقة الكتاب)؛ فشلها لا يُفشل الكتاب"""
+        if pages <= 0:
+            return
+        try:
+            urls = []
+            for image in PdfRenderService.render_pages(path, out_dir, range(pages), timeout=timeout):
+                res = cloudinary.uploader.upload(image, folder="hottiyya_library/previews")
+                if res.get("secure_url"):
+                    urls.append(res["secure_url"])
+            with get_db_context() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("UPDATE library SET preview_urls = %s WHERE id = %s", (urls, book_id))
+                    conn.commit()
+        except Exception as e:
+            print(f"⚠️ تعذر إنشاء معاينات الكتاب {book_id}: {e}")
+
+    @classmethod
+    def _fail(cls, book_id: int, error: str) -> None:
+        """الملف الأصلي ومجلد العمل يحذفهما _run بعد انتهاء المهمة"""
+        print(f"❌ فشلت معالجة الكتاب {book_id}: {error}")
+        cls.set_status(book_id, "error", error)
+
+    # =======================================================
+    # 5. الاستكمال بعد إعادة التشغيل
+    # =======================================================
+    @classmethod
+    def resume_pending_jobs(cls) -> int:
+        """
+        عند التشغيل: تنظيف الملفات المتروكة في JOBS_DIR وتشغيل العمال ليحجزوا ما بقي في الطابور،
+        وتعليم الكتب النشطة التي فقدت ملفاتها بالخطأ حتى لا تبقى "قيد المعالجة" للأبد.
+        يعمل في كل worker، فالكتاب بلا ملف لا يُعد مفقوداً إلا بعد مهلة: worker آخر ربما سجله للتو
+        ولم ينقل ملفه بعد.
+        """
+        if os.path.isdir(cls.JOBS_DIR):
+            for name in os.listdir(cls.JOBS_DIR):
+                path = os.path.join(cls.JOBS_DIR, name)
+                try:
+                    stale = time.time() - os.path.getmtime(path) > cls.JOB_TIMEOUT
+                    if name.endswith((".jpg", ".tmp")) and stale:
+                        os.remove(path)  # ملفات مؤقتة من معالجة انقطعت
+                    elif name.split("__", 1)[0] == "staging" and stale:
+                        os.remove(path)  # رفع انقطع قبل تسجيل الكتاب
+                except FileNotFoundError:
+                    pass  # حذفه worker آخر أو انتهت معالجته
+        files = cls._job_files()
+
+        with get_db_context() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute("""
+                    SELECT id FROM library
+                    WHERE processing_status = 'queued' AND NOT (id = ANY(%s))
+                      AND created_at < NOW() - make_interval(secs => %s)
+                """, (list(files), cls.JOB_TIMEOUT))
+                lost = [row["id"] for row in cur.fetchall()]
+                # ملفات كتب حُذفت أو انتهت معالجتها لم يعد لها داعٍ
+                cur.execute("""
+                    SELECT id FROM library WHERE id = ANY(%s) AND processing_status = ANY(%s)
+                """, (list(files), list(cls.ACTIVE_STATUSES)))
+                active = {row["id"] for row in cur.fetchall()}
+                if lost:
+                    cur.execute("""
+                        UPDATE library SET processing_status = 'error', file_url = 'error',
+                            processing_error = 'انقطعت المعالجة بإعادة تشغيل الخادم'
+                        WHERE id = ANY(%s) AND processing_status = 'queued'
+                    """, (lost,))
+                conn.commit()
+
+        # الملف يُنقل إلى JOBS_DIR بعد تسجيل الكتاب، فملف بلا كتاب نشط يخص كتاباً حُذف أو انتهت معالجته
+        for book_id in set(files) - active:
+            try:
+                os.remove(files.pop(book_id))
+            except FileNotFoundError:
+                pass
+
+        # مجلد العمل يُحذف قبل الأصل عند انتهاء المهمة، فمجلد بلا ملف أصلي بقي من معالجة انقطعت
+        if os.path.isdir(cls.WORK_DIR):
+            for name in os.listdir(cls.WORK_DIR):
+                path = os.path.join(cls.WORK_DIR, name)
+                try:
+                    stale = time.time() - os.path.getmtime(path) > cls.JOB_TIMEOUT
+                except FileNotFoundError:
+                    continue
+                if stale and not (name.isdigit() and int(name) in files):
+                    shutil.rmtree(path, ignore_errors=True)
+
+        cls.ensure_started()
+        cls._wakeup.set()
+        return len(files)
@@ -3,22 +3,15 @@ import os
 import re
 import time
 import json
-import fitz  # PyMuPDF
-import shutil
-import tempfile
-import asyncio
 import socket
+import asyncio
 import httplib2
 import traceback
 import cloudinary.uploader
-import google_auth_httplib2
-from fastapi import UploadFile
-from google.oauth2.credentials import Credentials
-from google.auth.transport.requests import Request
 from googleapiclient.http import MediaFileUpload
-from googleapiclient.discovery import build
 from psycopg2.extras import RealDictCursor
 from postgresql import get_db_context
+from services.drive_service import DriveService
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -31,87 +24,26 @@ def getaddrinfo_ipv4(host, port, family=0, type=0, proto=0, flags=0):
 socket.getaddrinfo = getaddrinfo_ipv4
 
 class LibraryService:
-    SCOPES = ['https://www.googleapis.com/auth/drive.file']
-    TOKEN_FILE = 'token.json'
     GOOGLE_DRIVE_FOLDER_ID = os.getenv("GOOGLE_DRIVE_FOLDER_ID")
    
     @staticmethod
-    def get_drive_service():
-        """بناء خدمة مع تعطيل إعادة التوجيه التلقائي واستخدام الملفات السرية في الإنتاج"""
-        # Render يضع ملفات الـ Secrets في المسار الجذري للمشروع افتراضياً
-        creds = Credentials.from_authorized_user_file(LibraryService.TOKEN_FILE, LibraryService.SCOPES)
-        
-        if creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-            with open(LibraryService.TOKEN_FILE, 'w') as token:
-                token.write(creds.to_json())
-        
-        # تحسين إعدادات الاتصال لتجنب أخطاء الشبكة في السحاب
-        http_transport = httplib2.Http(timeout=120)
-        http_transport.follow_redirects = False 
-        
-        authorized_http = google_auth_httplib2.AuthorizedHttp(creds, http=http_transport)
-        DRIVE_DISCOVERY_URL = 'https://www.googleapis.com/discovery/v1/apis/drive/v3/rest'
-        
-        return build(
-            'drive', 
-            'v3', 
-            http=authorized_http, 
-            discoveryServiceUrl=DRIVE_DISCOVERY_URL,
-            static_discovery=False
-        )
+    def get_drive_service(fresh: bool = False):
+        """عميل قوقل درايف المشترك (صلاحيات مخزنة مع تحديث استباقي واتصال يُعاد استخدامه)"""
+        return DriveService.get_service(fresh=fresh)
     
-    @staticmethod
-    async def process_and_get_metadata(file: UploadFile):
-        temp_input = None
-        ext = os.path.splitext(file.filename)[1].lower()
-        
-        try:
-            with tempfile.NamedTemporaryFile(delete=False, suffix=ext) as tmp:
-                shutil.copyfileobj(file.file, tmp)
-                temp_input = tmp.name
+    # أغلفة افتراضية لملفات Word/PowerPoint (ملفات PDF يُستخرج غلافها في طابور المعالجة)
+    DEFAULT_COVERS = {
+        '.doc': 'https://example.com/word_icon.png',
+        '.docx': 'https://example.com/word_icon.png',
+        '.ppt': 'https://example.com/ppt_icon.png',
+        '.pptx': 'https://example.com/ppt_icon.png'
+    }
 
-            final_local_path = temp_input
-            cover_url = None
-            
-            # إذا كان الملف PDF: نقوم بالضغط واستخراج الغلاف
-            if ext == ".pdf":
-                temp_output = temp_input.replace(".pdf", "_compressed.pdf")
-                gs_command = ["gs", "-sDEVICE=pdfwrite", "-dCompatibilityLevel=1.4", "-dPDFSETTINGS=/ebook", 
-                            "-dNOPAUSE", "-dQUIET", "-dBATCH", f"-sOutputFile={temp_output}", temp_input]
-                process = await asyncio.create_subprocess_exec(*gs_command)
-                await process.wait()
-
-                if os.path.exists(temp_output):
-                    final_local_path = temp_output
-                    if os.path.exists(temp_input): os.remove(temp_input)
-
-                # استخراج الغلاف
-                temp_cover = final_local_path.replace(".pdf", ".jpg")
-                doc = fitz.open(final_local_path)
-                pix = doc.load_page(0).get_pixmap(matrix=fitz.Matrix(1.5, 1.5))
-                pix.save(temp_cover)
-                doc.close()
-                cover_res = cloudinary.uploader.upload(temp_cover, folder="hottiyya_library/covers")
-                cover_url = cover_res.get("secure_url")
-                if os.path.exists(temp_cover): os.remove(temp_cover)
-            
-            else:
-                # للملفات الأخرى (Word/PPT): نضع رابط صورة افتراضية حسب النوع
-                icons = {
-                    '.doc': 'https://example.com/word_icon.png',
-                    '.docx': 'https://example.com/word_icon.png',
-                    '.ppt': 'https://example.com/ppt_icon.png',
-                    '.pptx': 'https://example.com/ppt_icon.png'
-                }
-                cover_url = icons.get(ext, 'https://example.com/default_book_icon.png')
-
-            file_size_mb = os.path.getsize(final_local_path) / (1024 * 1024)
-            return final_local_path, cover_url, f"{file_size_mb:.2f} MB"
-
-        except Exception as e:
-            if temp_input and os.path.exists(temp_input): os.remove(temp_input)
-            raise e
+    @staticmethod
+    def default_cover_for(ext: str):
+        if ext == ".pdf":
+            return None
+        return LibraryService.DEFAULT_COVERS.get(ext, 'https://example.com/default_book_icon.png')
 
     @staticmethod
     def background_upload(file_path: str, filename: str, book_id: int):
@@ -181,9 +113,13 @@ class LibraryService:
                             print(f"🔼 جاري رفع كتاب {book_id}: {int(status.progress() * 100)}%")
                     except (socket.timeout, httplib2.ServerNotFoundError, Exception) as e:
                         retries += 1
+                        # طلب الرفع مربوط بالصلاحيات القديمة: بعد reset يفشل الكتاب ويُعاد رفعه بصلاحيات جديدة
+                        if DriveService.is_auth_error(e):
+                            DriveService.recover(e)
+                            raise
                         if retries > max_retries: raise e
                         time.sleep(min(retries * 5, 30))
-                        if retries % 3 == 0: service = LibraryService.get_drive_service()
+                        if retries % 3 == 0: service = LibraryService.get_drive_service(fresh=True)
                 
                 if response and 'id' in response:
                     file_id = response.get('id')
@@ -195,18 +131,25 @@ class LibraryService:
                     final_url = f"https://drive.google.com/uc?export=download&id={file_id}"
 
             # 3. تحديث قاعدة البيانات عند النجاح
-            if final_url:
-                with get_db_context() as conn:
-                    with conn.cursor() as cur:
-                        cur.execute("UPDATE library SET file_url = %s WHERE id = %s", (final_url, book_id))
-                        conn.commit()
-                print(f"✅ تم اكتمال رفع الكتاب رقم {book_id} بنجاح.")
+            if not final_url:
+                raise RuntimeError("لم يُرجع التخزين السحابي رابطاً للملف")
+            with get_db_context() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        UPDATE library SET file_url = %s, processing_status = 'ready', processing_error = NULL
+                        WHERE id = %s
+                    """, (final_url, book_id))
+                    conn.commit()
+            print(f"✅ تم اكتمال رفع الكتاب رقم {book_id} بنجاح.")
                 
         except Exception as e:
             traceback.print_exc()
             with get_db_context() as conn:
                 with conn.cursor() as cur:
-                    cur.execute("UPDATE library SET file_url = %s WHERE id = %s", ('error', book_id))
+                    cur.execute("""
+                        UPDATE library SET file_url = 'error', processing_status = 'error', processing_error = %s
+                        WHERE id = %s
+                    """, (str(e)[:500], book_id))
                     conn.commit()
             print(f"❌ خطأ في الرفع الخلفي للكتاب {book_id}: {e}")
             
@@ -215,10 +158,9 @@ class LibraryService:
                 os.remove(file_path)
 
     @staticmethod
-    async def upload_cover(image_file):
-        """رفع صورة غلاف يدوية"""
-        content = await image_file.read()
-        res = cloudinary.uploader.upload(content, folder="hottiyya_library/covers")
+    async def upload_cover(image_path: str):
+        """رفع صورة غلاف يدوية (من ملف مستقبَل على القرص)"""
+        res = await asyncio.to_thread(cloudinary.uploader.upload, image_path, folder="hottiyya_library/covers")
         return res.get("secure_url")
     
     @staticmethod
@@ -230,17 +172,20 @@ class LibraryService:
                 return cur.fetchone()
 
     @staticmethod
-    async def add_book(title, author, category, file_url, cover_url, uploader_id, file_size, allow_download=True):
+    async def add_book(title, author, category, file_url, cover_url, uploader_id, file_size, allow_download=True,
+                       processing_status="ready", content_sha256=None):
         """إضافة السجل الأولي لقاعدة البيانات مع تصفير العدادات وحالة التحميل"""
         with get_db_context() as conn:
             with conn.cursor() as cur:
                 cur.execute("""
                     INSERT INTO library (
                         title, author, category, file_url, cover_url, 
-                        uploader_id, file_size, views_count, downloads_count, allow_download
+                        uploader_id, file_size, views_count, downloads_count, allow_download, processing_status,
+                        content_sha256
                     )
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, 0, 0, %s) RETURNING id
-                """, (title, author, category, file_url, cover_url, uploader_id, file_size, allow_download))
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, 0, 0, %s, %s, %s) RETURNING id
+                """, (title, author, category, file_url, cover_url, uploader_id, file_size, allow_download,
+                      processing_status, content_sha256))
                 book_id = cur.fetchone()[0]
                 conn.commit()
                 return book_id
@@ -267,7 +212,7 @@ class LibraryService:
         """حذف الكتاب نهائياً من القاعدة والسحاب (Cloudinary & Drive)"""
         with get_db_context() as conn:
             with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                cur.execute("SELECT title, file_url, cover_url FROM library WHERE id = %s", (book_id,))
+                cur.execute("SELECT title, file_url, cover_url, preview_urls FROM library WHERE id = %s", (book_id,))
                 book = cur.fetchone()
                 if not book: return None
 
@@ -312,6 +257,14 @@ class LibraryService:
                         print(f"✅ تم حذف الغلاف من Cloudinary: {cover_public_id}")
                     except Exception as e:
                         print(f"⚠️ خطأ أثناء حذف الغلاف: {e}")
+
+                # 4. حذف معاينات الصفحات
+                for preview_url in book.get('preview_urls') or []:
+                    try:
+                        preview_name = preview_url.split('/')[-1].split('.')[0]
+                        cloudinary.uploader.destroy(f"hottiyya_library/previews/{preview_name}")
+                    except Exception as e:
+                        print(f"⚠️ خطأ أثناء حذف معاينة: {e}")
                 
                 return book
 
@@ -375,15 +328,17 @@ class LibraryService:
         cleaned_count = 0
         db_files = set()
         db_covers = set()
+        db_previews = set()
 
         # 1. جلب البيانات من القاعدة
         with get_db_context() as conn:
             with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                cur.execute("SELECT file_url, cover_url FROM library")
+                cur.execute("SELECT file_url, cover_url, preview_urls FROM library")
                 rows = cur.fetchall()
                 for row in rows:
                     if row['file_url']: db_files.add(row['file_url'].strip())
                     if row['cover_url']: db_covers.add(row['cover_url'].strip())
+                    db_previews.update(url.strip() for url in row['preview_urls'] or [])
 
         # 2. تنظيف الكتب (PDF - النوع raw)
         try:
@@ -406,6 +361,17 @@ class LibraryService:
                     print(f"🗑️ تم حذف غلاف يتيم: {res['public_id']}")
         except Exception as e:
             print(f"⚠️ خطأ في تنظيف الأغلفة: {e}")
+
+        # 4. تنظيف معاينات الصفحات
+        try:
+            previews = cloudinary.api.resources(type="upload", resource_type="image", prefix="hottiyya_library/previews")
+            for res in previews.get('resources', []):
+                if res['secure_url'] not in db_previews:
+                    cloudinary.uploader.destroy(res['public_id'])
+                    cleaned_count += 1
+                    print(f"🗑️ تم حذف معاينة يتيمة: {res['public_id']}")
+        except Exception as e:
+            print(f"⚠️ خطأ في تنظيف المعاينات: {e}")
             
         return cleaned_count  
 
@@ -458,7 +424,8 @@ class LibraryService:
                     # أو التي تحمل حالة error (اختياري حسب رغبتك)
                     cur.execute("""
                         SELECT id FROM library 
-                        WHERE (file_url = 'pending' AND created_at < NOW() - INTERVAL '2 hours')
+                        WHERE (file_url = 'pending' AND created_at < NOW() - INTERVAL '2 hours'
+                               AND processing_status <> 'queued')
                            OR (file_url = 'error')
                     """)
                     stuck_books = cur.fetchall()
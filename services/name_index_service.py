@@ -0,0 +1,275 @@
+# name_index_service.py
+import re
+import heapq
+import bisect
+import threading
+from collections import defaultdict, Counter
+from typing import List, Dict, Optional, Set, Any, Iterable
+from psycopg2.extras import RealDictCursor
+
+from utils.normalize import fold_arabic
+from postgresql import get_db_context
+
+
+class NameIndexService:
+    """
+    فهرس مقلوب داخل الذاكرة مبني على المقاطع الثلاثية (n-grams) لأسماء العائلة وألقابها.
+    يسمح بالبحث المتسامح مع الأخطاء الإملائية (الهمزات، التاء المربوطة) وبأجزاء الاسم
+    مثل (اسم الأب ثم اسم الجد) مع ترتيب أفضل النتائج خلال أجزاء من الثانية.
+    """
+    NGRAM = 3
+    MIN_TOKEN_SIMILARITY = 0.45   # أقل تشابه مقبول بين كلمة البحث وكلمة من الاسم
+    MIN_SCORE = 0.5               # أقل درجة إجمالية لإظهار النتيجة
+    CANDIDATE_LIMIT = 300         # عدد المرشحين الذين يعاد تقييمهم بدقة
+    STOP_WORDS = {"بن", "بنت", "ابن"}
+    CODE_PREFIX_PATTERN = re.compile(r"^[A-Z]\d{0,3}(-\d{0,3}){0,2}$")
+
+    MEMBERS_SQL = """
+        SELECT n.code, n.name, fs.full_name, COALESCE(fs.nick_name, n.nick_name) AS nick_name, fs.level
+        FROM family_name n
+        LEFT JOIN family_search fs ON fs.code = n.code
+    """
+
+    _lock = threading.RLock()
+    _built = False
+    _docs: Dict[str, Dict[str, Any]] = {}
+    _postings: Dict[str, Set[str]] = defaultdict(set)
+    _codes: List[str] = []   # كل أكواد family_name مرتبة أبجدياً للبحث بالبادئة (bisect)
+    _labels: Dict[str, Dict[str, Any]] = {}   # الاسم المعروض لكل كود، بما فيهم غير المفهرسين بالاسم
+
+    # =======================================================
+    # 1. أدوات التقطيع والتشابه
+    # =======================================================
+    @classmethod
+    def tokenize(cls, text: Optional[str]) -> List[str]:
+        folded = fold_arabic(text or "")
+        return [t for t in re.findall(r"\w+", folded or "") if t not in cls.STOP_WORDS]
+
+    @classmethod
+    def token_grams(cls, token: str) -> Set[str]:
+        padded = f" {token} "
+        if len(padded) <= cls.NGRAM:
+            return {padded}
+        return {padded[i:i + cls.NGRAM] for i in range(len(padded) - cls.NGRAM + 1)}
+
+    @classmethod
+    def token_similarity(cls, query_token: str, doc_token: str) -> float:
+        if query_token == doc_token:
+            return 1.0
+        a, b = cls.token_grams(query_token), cls.token_grams(doc_token)
+        sim = 2 * len(a & b) / (len(a) + len(b))
+        # كتابة جزء من بداية الاسم (مثل: عبدال) تعامل كمطابقة شبه تامة
+        if len(query_token) >= 2 and doc_token.startswith(query_token):
+            sim = max(sim, 0.9)
+        return sim
+
+    # =======================================================
+    # 2. بناء الفهرس وتحديثه
+    # =======================================================
+    @classmethod
+    def _index_doc(cls, code: str, full_name: Optional[str], nick_name: Optional[str]) -> None:
+        tokens = cls.tokenize(full_name) + cls.tokenize(nick_name)
+        grams = set()
+        for token in tokens:
+            grams |= cls.token_grams(token)
+        cls._docs[code] = {"tokens": tokens, "grams": grams, "full_name": full_name, "nick_name": nick_name}
+        for gram in grams:
+            cls._postings[gram].add(code)
+
+    @classmethod
+    def _add_code(cls, code: str) -> None:
+        pos = bisect.bisect_left(cls._codes, code)
+        if pos == len(cls._codes) or cls._codes[pos] != code:
+            cls._codes.insert(pos, code)
+
+    @classmethod
+    def _drop_code(cls, code: str) -> None:
+        pos = bisect.bisect_left(cls._codes, code)
+        if pos < len(cls._codes) and cls._codes[pos] == code:
+            del cls._codes[pos]
+
+    @classmethod
+    def _unindex_doc(cls, code: str) -> None:
+        doc = cls._docs.pop(code, None)
+        if not doc:
+            return
+        for gram in doc["grams"]:
+            postings = cls._postings.get(gram)
+            if postings is not None:
+                postings.discard(code)
+                if not postings:
+                    del cls._postings[gram]
+
+    @staticmethod
+    def _is_searchable(row: Dict[str, Any]) -> bool:
+        """البحث بالاسم للأعضاء الظاهرين فقط (level >= 0)؛ الإكمال بالكود يشمل كل الأعضاء"""
+        return row["level"] is not None and row["level"] >= 0
+
+    @staticmethod
+    def _label(row: Dict[str, Any]) -> Dict[str, Any]:
+        return {"full_name": row["full_name"] or row["name"], "nick_name": row["nick_name"]}
+
+    @classmethod
+    def ensure_built(cls) -> None:
+        """بناء الفهرس مرة واحدة عند أول استخدام (تحميل كسول)"""
+        if cls._built:
+            return
+        with cls._lock:
+            if cls._built:
+                return
+            cls.rebuild()
+
+    @classmethod
+    def rebuild(cls) -> None:
+        with cls._lock:
+            cls._docs = {}
+            cls._postings = defaultdict(set)
+            cls._labels = {}
+            with get_db_context() as conn:
+                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    cur.execute(cls.MEMBERS_SQL)
+                    for row in cur.fetchall():
+                        cls._labels[row["code"]] = cls._label(row)
+                        if cls._is_searchable(row):
+                            cls._index_doc(row["code"], row["full_name"], row["nick_name"])
+            cls._codes = sorted(cls._labels)
+            cls._built = True
+            print(f"🔎 تم بناء فهرس الأسماء التقريبي: {len(cls._docs)} عضو.")
+
+    @classmethod
+    def refresh_codes(cls, codes: Iterable[str]) -> None:
+        """إعادة فهرسة أعضاء محددين بعد عمليات الإضافة أو التعديل"""
+        codes = [c for c in {c for c in codes if c}]
+        if not codes or not cls._built:
+            return
+        with get_db_context() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(cls.MEMBERS_SQL + " WHERE n.code = ANY(%s)", (codes,))
+                rows = {r["code"]: r for r in cur.fetchall()}
+        with cls._lock:
+            for code in codes:
+                cls._unindex_doc(code)
+                row = rows.get(code)
+                if not row:
+                    cls._drop_code(code)
+                    cls._labels.pop(code, None)
+                    continue
+                cls._labels[code] = cls._label(row)
+                cls._add_code(code)
+                if cls._is_searchable(row):
+                    cls._index_doc(code, row["full_name"], row["nick_name"])
+
+    @classmethod
+    def remove_codes(cls, codes: Iterable[str]) -> None:
+        with cls._lock:
+            for code in codes:
+                cls._unindex_doc(code)
+                cls._drop_code(code)
+                cls._labels.pop(code, None)
+
+    @classmethod
+    def on_family_changed(cls, codes: List[str], removed: List[str], bulk: bool) -> None:
+        """مشترك FamilyEvents: التغيير الجماعي يعيد بناء الفهرس مرة واحدة، وغيره يحدّث الأعضاء المتغيرين فقط"""
+        if removed:
+            cls.remove_codes(removed)
+        if bulk and cls._built:
+            cls.rebuild()
+        else:
+            cls.refresh_codes(codes)
+
+    # =======================================================
+    # 3. البحث التقريبي مع الترتيب
+    # =======================================================
+    @classmethod
+    def _score_doc(cls, query_tokens: List[str], doc_tokens: List[str]) -> float:
+        if not doc_tokens:
+            return 0.0
+        total = 0.0
+        last_pos = -1
+        in_order = True
+        for q_token in query_tokens:
+            best_sim, best_pos = 0.0, -1
+            best_after_sim, best_after_pos = 0.0, -1
+            for pos, d_token in enumerate(doc_tokens):
+                sim = cls.token_similarity(q_token, d_token)
+                if sim > best_sim:
+                    best_sim, best_pos = sim, pos
+                if pos > last_pos and sim > best_after_sim:
+                    best_after_sim, best_after_pos = sim, pos
+            # تفضيل المطابقة التي تحافظ على ترتيب كلمات البحث (الاسم ثم الأب ثم الجد)
+            if best_after_sim >= cls.MIN_TOKEN_SIMILARITY and best_after_sim >= best_sim - 0.1:
+                best_sim, best_pos = best_after_sim, best_after_pos
+            else:
+                in_order = False
+            if best_sim < cls.MIN_TOKEN_SIMILARITY:
+                return 0.0
+            total += best_sim
+            last_pos = best_pos
+        score = total / len(query_tokens)
+        if in_order and len(query_tokens) > 1:
+            score += 0.1
+        return score
+
+    @classmethod
+    def search(cls, query: str, limit: int = 10) -> List[Dict[str, Any]]:
+        query_tokens = cls.tokenize(query)
+        if not query_tokens:
+            return []
+        cls.ensure_built()
+
+        query_grams = set()
+        for token in query_tokens:
+            query_grams |= cls.token_grams(token)
+
+        with cls._lock:
+            hits = Counter()
+            for gram in query_grams:
+                for code in cls._postings.get(gram, ()):
+                    hits[code] += 1
+            candidates = heapq.nlargest(cls.CANDIDATE_LIMIT, hits.items(), key=lambda item: item[1])
+
+            scored = []
+            for code, _ in candidates:
+                doc = cls._docs.get(code)
+                if not doc:
+                    continue
+                score = cls._score_doc(query_tokens, doc["tokens"])
+                if score >= cls.MIN_SCORE:
+                    scored.append((score, code, doc))
+
+        top = heapq.nlargest(limit, scored, key=lambda item: (item[0], -len(item[2]["tokens"])))
+        return [
+            {"code": code, "full_name": doc["full_name"], "nick_name": doc["nick_name"], "score": round(score, 3)}
+            for score, code, doc in top
+        ]
+
+    # =======================================================
+    # 4. الإكمال التلقائي لأكواد الأعضاء (الأب، الأم، الزوج)
+    # =======================================================
+    @classmethod
+    def autocomplete(cls, query: str, limit: int = 10) -> List[Dict[str, Any]]:
+        """
+        إن كان النص بداية كود (مثل A1-0) تُرجع الأكواد المطابقة بالبادئة من المصفوفة المرتبة،
+        وإلا يُعامل كجزء من الاسم ويُمرر للبحث التقريبي. كلاهما من الذاكرة بدون قاعدة البيانات.
+        الأكواد تشمل كل أعضاء family_name (حتى level < 0) لأن الأب أو الزوج قد يكون منهم.
+        """
+        text = (query or "").strip()
+        if not text:
+            return []
+        prefix = text.upper()
+        if not cls.CODE_PREFIX_PATTERN.match(prefix):
+            return [{"code": r["code"], "full_name": r["full_name"], "nick_name": r["nick_name"]}
+                    for r in cls.search(text, limit)]
+
+        cls.ensure_built()
+        results = []
+        with cls._lock:
+            pos = bisect.bisect_left(cls._codes, prefix)
+            while pos < len(cls._codes) and len(results) < limit:
+                code = cls._codes[pos]
+                if not code.startswith(prefix):
+                    break
+                label = cls._labels.get(code, {})
+                results.append({"code": code, "full_name": label.get("full_name"), "nick_name": label.get("nick_name")})
+                pos += 1
+        return results
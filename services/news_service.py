@@ -6,7 +6,7 @@ from psycopg2.extras import RealDictCursor
 class NewsService:
     @staticmethod
     def upload_news_media(file, news_id):
-        """رفع صورة أو فيديو قصير إلى سحابة Cloudinary"""
+        """رفع صورة أو فيديو قصير إلى سحابة Cloudinary (file: مسار الملف المستقبَل على القرص)"""
         try:
             result = cloudinary.uploader.upload(
                 file,
@@ -0,0 +1,74 @@
+# page_index_service.py
+import threading
+from typing import List, Optional, Tuple
+
+from postgresql import get_db_context
+
+
+class PageIndexService:
+    """
+    فهرس مواقع صفحات القائمة الكاملة للعائلة: يحفظ مفتاح الترتيب (sort_key, code) لآخر عضو في كل صفحة.
+    بفضله يُترجم رقم الصفحة إلى نقطة بداية (Keyset) فتُجلب أي صفحة بنفس كلفة الصفحة الأولى بدل OFFSET.
+    يُبنى بمسح واحد للفهرس عند أول طلب بعد أي تعديل.
+    الإبطال في الذاكرة يصل للعامل الذي كتب فقط، لذلك يُقارن الفهرس بجيل القائمة في family_list_state
+    (صف واحد يرفعه Trigger عند الإضافة والحذف وتغيّر مفتاح الترتيب) فتلتقط بقية الـ workers التعديل.
+    """
+    _lock = threading.Lock()
+    _boundaries: Optional[List[Tuple[str, str]]] = None
+    _page_size: Optional[int] = None
+    _total = 0
+    _stamp: Optional[int] = None
+    _version = 0  # يزداد مع كل إبطال حتى لا يُحفظ فهرس قُرئ قبل التعديل
+
+    @classmethod
+    def invalidate(cls) -> None:
+        with cls._lock:
+            cls._boundaries = None
+            cls._version += 1
+
+    @staticmethod
+    def _db_state(cur) -> Tuple[int, int]:
+        """(جيل القائمة، عدد أعضائها) بقراءة صف واحد"""
+        cur.execute("SELECT generation, members FROM family_list_state")
+        row = cur.fetchone()
+        return (row[0], row[1]) if row else (0, 0)
+
+    @classmethod
+    def total(cls) -> int:
+        """عدد أعضاء القائمة فقط، لصفحات المؤشر (after=) التي لا تحتاج مواقع الصفحات"""
+        with get_db_context() as conn:
+            with conn.cursor() as cur:
+                return cls._db_state(cur)[1]
+
+    @classmethod
+    def get(cls, page_size: int) -> Tuple[int, List[Tuple[str, str]]]:
+        """إرجاع (عدد الأعضاء، مفاتيح نهايات الصفحات) حيث العنصر i هو آخر عضو في الصفحة i+1"""
+        with cls._lock:
+            cached = cls._boundaries if cls._page_size == page_size else None
+            cached_stamp, cached_total = cls._stamp, cls._total
+            version = cls._version
+
+        with get_db_context() as conn:
+            with conn.cursor() as cur:
+                stamp, total = cls._db_state(cur)
+                if cached is not None and stamp == cached_stamp:
+                    return cached_total, cached
+
+                # row_number على الفهرس الجزئي (sort_key, code) بدون حساب أي دالة لكل صف
+                cur.execute("""
+                    SELECT sort_key, code FROM (
+                        SELECT sort_key, code, row_number() OVER (ORDER BY sort_key, code) AS rn
+                        FROM family_search WHERE level >= 0
+                    ) ranked
+                    WHERE rn %% %s = 0
+                    ORDER BY rn
+                """, (page_size,))
+                boundaries = [(row[0], row[1]) for row in cur.fetchall()]
+
+        with cls._lock:
+            if cls._version == version:
+                cls._boundaries = boundaries
+                cls._page_size = page_size
+                cls._total = total
+                cls._stamp = stamp
+        return total, boundaries
@@ -0,0 +1,252 @@
+# pdf_render_service.py
+import os
+import time
+import signal
+import tempfile
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional, Dict, Any, List, Iterable
+
+# =======================================================
+# دوال العمال (تعمل داخل عمليات الـ Pool)
+# النتائج تُكتب على القرص مباشرة، ولا يعود للعملية الأم إلا مسارات وأرقام صغيرة
+# =======================================================
+_fitz = None
+
+
+def _init_worker(pids) -> None:
+    """
+    تحميل PyMuPDF مرة واحدة عند بدء العامل حتى تكون المهام التالية دافئة،
+    وتسجيل رقم العملية في مصفوفة الـ Pool المشتركة حتى تستطيع الخدمة إنهاءه عند تجاوز المهلة.
+    """
+    global _fitz
+    with pids.get_lock():
+        for slot in range(len(pids)):
+            if pids[slot] == 0:
+                pids[slot] = os.getpid()
+                break
+    import fitz  # PyMuPDF
+    fitz.TOOLS.mupdf_display_errors(False)
+    _fitz = fitz
+
+
+def _atomic_save(pix, target: str, quality: int) -> int:
+    tmp_path = f"{target}.tmp"
+    pix.save(tmp_path, output="jpeg", jpg_quality=quality)
+    os.replace(tmp_path, target)
+    return os.path.getsize(target)
+
+
+def _document_info(doc) -> Dict[str, Any]:
+    metadata = {k: v for k, v in (doc.metadata or {}).items() if v}
+    return {"page_count": doc.page_count, "metadata": metadata}
+
+
+def _inspect(path: str) -> Dict[str, Any]:
+    doc = _fitz.open(path)
+    try:
+        return _document_info(doc)
+    finally:
+        doc.close()
+
+
+def _render_cover(path: str, target: str, zoom: float, quality: int) -> Dict[str, Any]:
+    doc = _fitz.open(path)
+    try:
+        info = _document_info(doc)
+        pix = doc.load_page(0).get_pixmap(matrix=_fitz.Matrix(zoom, zoom), alpha=False)
+        info["cover_bytes"] = _atomic_save(pix, target, quality)
+        return info
+    finally:
+        doc.close()
+
+
+def _render_pages(path: str, pages: List[int], width: int, out_dir: str, quality: int) -> List[str]:
+    doc = _fitz.open(path)
+    written = []
+    try:
+        for number in pages:
+            page = doc.load_page(number)
+            scale = width / max(page.rect.width, 1)
+            pix = page.get_pixmap(matrix=_fitz.Matrix(scale, scale), alpha=False)
+            target = os.path.join(out_dir, f"page_{number + 1:04d}.jpg")
+            _atomic_save(pix, target, quality)
+            written.append(target)
+        return written
+    finally:
+        doc.close()
+
+
+def _resize_image(source: str, targets: Dict[str, int], quality: int) -> Dict[str, int]:
+    # الفتح من المحتوى لا من الامتداد: الصور الأصلية تُحفظ بأسماء مؤقتة
+    with open(source, "rb") as f:
+        doc = _fitz.open(stream=f.read())
+    sizes = {}
+    try:
+        page = doc.load_page(0)
+        longest = max(page.rect.width, page.rect.height, 1)
+        for target, width in targets.items():
+            scale = min(1.0, width / longest)
+            pix = page.get_pixmap(matrix=_fitz.Matrix(scale, scale), alpha=False)
+            sizes[target] = _atomic_save(pix, target, quality)
+        return sizes
+    finally:
+        doc.close()
+
+
+class PdfRenderService:
+    """
+    كل عمل PyMuPDF (أغلفة الكتب، مصغرات الصور، البيانات الوصفية وعدد الصفحات)
+    يجري في Process Pool مخصص بعمال دافئين (fitz محمّل مسبقاً في كل عامل) بدل حلقة الأحداث أو Threads الطلبات.
+    - المهام الكبيرة (معاينات صفحات كثيرة) تُقسّم إلى دفعات صفحات توزع على العمال بالتوازي.
+    - العامل يكتب الصور على القرص مباشرة ويعيد المسار فقط، فلا تعبر البايتات حدود العمليات بالـ pickle.
+    - تجاوز المهلة ينهي عمليات الـ Pool فعلاً (مهمة بدأت لا تُلغى) ويُنشأ Pool جديد للمهام التالية.
+    - الـ Pool يبدأ عند أول مهمة ويُغلق بعد IDLE_SECONDS بلا عمل، فلا يحتفظ كل worker في gunicorn
+      بـ WORKERS عمليات دائمة (العدد الفعلي = workers × PDF_RENDER_WORKERS لو بدأت كلها مسبقاً).
+    """
+    WORKERS = max(1, int(os.getenv("PDF_RENDER_WORKERS", str(min(4, os.cpu_count() or 1)))))
+    TASK_TIMEOUT = int(os.getenv("PDF_RENDER_TIMEOUT", "120"))
+    IDLE_SECONDS = int(os.getenv("PDF_RENDER_IDLE_SECONDS", "300"))
+    PAGES_PER_TASK = 2
+    JPEG_QUALITY = 82
+    COVER_ZOOM = 1.5
+    PAGE_WIDTH = 400
+
+    _pool: Optional[ProcessPoolExecutor] = None
+    _pids = None  # أرقام عمليات الـ Pool الحالي (WORKERS خانة) يملؤها العمال عند بدئهم
+    _lock = threading.Lock()
+    _active = 0
+    _last_used = 0.0
+    _idle_timer: Optional[threading.Timer] = None
+
+    # =======================================================
+    # 1. إدارة الـ Pool
+    # =======================================================
+    @classmethod
+    def _get_pool(cls) -> ProcessPoolExecutor:
+        with cls._lock:
+            if cls._pool is None:
+                # spawn بدل fork: العملية الأم تحمل Threads واتصالات لا يصح نسخها
+                context = multiprocessing.get_context("spawn")
+                cls._pids = context.Array("i", cls.WORKERS)
+                cls._pool = ProcessPoolExecutor(max_workers=cls.WORKERS, mp_context=context,
+                                                initializer=_init_worker, initargs=(cls._pids,))
+            return cls._pool
+
+    @classmethod
+    def _reset_pool(cls, pool: Optional[ProcessPoolExecutor] = None, terminate: bool = False) -> None:
+        """
+        إسقاط الـ Pool الحالي (أو pool المحدد إن كان ما زال الحالي، حتى لا يُسقط Pool أحدث منه).
+        terminate=True يقتل العمليات المسجلة في _pids: shutdown وcancel لا يوقفان مهمة قيد التنفيذ.
+        """
+        with cls._lock:
+            if pool is not None and cls._pool is not pool:
+                return
+            pool, cls._pool = cls._pool, None
+            pids, cls._pids = cls._pids, None
+        if pool:
+            if terminate and pids is not None:
+                for pid in list(pids):
+                    if pid:
+                        try:
+                            os.kill(pid, signal.SIGTERM)
+                        except ProcessLookupError:
+                            pass
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    @classmethod
+    def _schedule_idle_check(cls) -> None:
+        with cls._lock:
+            if cls._idle_timer is not None:
+                return
+            timer = threading.Timer(cls.IDLE_SECONDS, cls._idle_check)
+            timer.daemon = True
+            cls._idle_timer = timer
+        timer.start()
+
+    @classmethod
+    def _idle_check(cls) -> None:
+        with cls._lock:
+            cls._idle_timer = None
+            idle = cls._active == 0 and time.monotonic() - cls._last_used >= cls.IDLE_SECONDS
+            pool = cls._pool
+        if pool is None:
+            return
+        if idle:
+            cls._reset_pool(pool)
+        else:
+            cls._schedule_idle_check()
+
+    @classmethod
+    def shutdown(cls) -> None:
+        cls._reset_pool()
+
+    @classmethod
+    def _gather(cls, fn, batches: List[tuple], timeout: Optional[int] = None) -> List[Any]:
+        """توزيع الدفعات على عمال الـ Pool وانتظارها بمهلة واحدة لكل المهمة"""
+        pool = cls._get_pool()
+        with cls._lock:
+            cls._active += 1
+        try:
+            futures = [pool.submit(fn, *args) for args in batches]
+            deadline = time.monotonic() + (timeout or cls.TASK_TIMEOUT)
+            return [f.result(timeout=max(0.0, deadline - time.monotonic())) for f in futures]
+        except FutureTimeout:
+            # مهام أخرى على نفس الـ Pool تفشل بـ BrokenProcessPool ويعالجها مستدعوها كخطأ عادي
+            cls._reset_pool(pool, terminate=True)
+            raise TimeoutError("تجاوزت معالجة الملف المهلة المسموحة")
+        except BrokenProcessPool:
+            cls._reset_pool(pool)
+            raise
+        finally:
+            with cls._lock:
+                cls._active -= 1
+                cls._last_used = time.monotonic()
+            cls._schedule_idle_check()
+
+    @classmethod
+    def _call(cls, fn, *args, timeout: Optional[int] = None):
+        return cls._gather(fn, [args], timeout)[0]
+
+    # =======================================================
+    # 2. واجهة الاستخدام
+    # =======================================================
+    @classmethod
+    def inspect(cls, path: str, timeout: Optional[int] = None) -> Dict[str, Any]:
+        """عدد الصفحات والبيانات الوصفية (العنوان، المؤلف...) لملف PDF"""
+        return cls._call(_inspect, path, timeout=timeout)
+
+    @classmethod
+    def render_cover(cls, path: str, target: str, timeout: Optional[int] = None) -> Dict[str, Any]:
+        """حفظ الصفحة الأولى كـ JPG في target مع إرجاع عدد الصفحات والبيانات الوصفية من نفس الفتح"""
+        return cls._call(_render_cover, path, target, cls.COVER_ZOOM, cls.JPEG_QUALITY, timeout=timeout)
+
+    @classmethod
+    def render_pages(cls, path: str, out_dir: str, pages: Optional[Iterable[int]] = None,
+                     width: int = PAGE_WIDTH, timeout: Optional[int] = None) -> List[str]:
+        """معاينات صفحات (page_0001.jpg ...) في out_dir، مقسمة على العمال بدفعات PAGES_PER_TASK"""
+        if pages is None:
+            pages = range(cls.inspect(path, timeout=timeout)["page_count"])
+        pages = list(pages)
+        if not pages:
+            return []
+        os.makedirs(out_dir, exist_ok=True)
+        batches = [(path, pages[start:start + cls.PAGES_PER_TASK], width, out_dir, cls.JPEG_QUALITY)
+                   for start in range(0, len(pages), cls.PAGES_PER_TASK)]
+        return [p for chunk in cls._gather(_render_pages, batches, timeout) for p in chunk]
+
+    @classmethod
+    def resize_image(cls, source: str, targets: Dict[str, int], quality: int = JPEG_QUALITY,
+                     timeout: Optional[int] = None) -> Dict[str, int]:
+        """تصغير صورة (أو أول صفحة من مستند) لعدة عروض بفتح واحد؛ targets: مسار الهدف -> العرض"""
+        return cls._call(_resize_image, source, targets, quality, timeout=timeout)
+
+    @staticmethod
+    def scratch_path(directory: str, suffix: str) -> str:
+        """مسار مؤقت فريد داخل directory لتبادل الملفات مع العمال"""
+        os.makedirs(directory, exist_ok=True)
+        fd, path = tempfile.mkstemp(suffix=suffix, dir=directory)
+        os.close(fd)
+        return path
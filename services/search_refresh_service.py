@@ -0,0 +1,193 @@
+# search_refresh_service.py
+import threading
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from postgresql import get_db_context
+from services.name_index_service import NameIndexService
+from services.page_index_service import PageIndexService
+
+
+class SearchRefreshService:
+    """
+    تحديث متسلسل لأسماء النسب في جدول family_search.
+    الـ Trigger يحدّث الاسم الكامل للعضو المعدّل فقط، فإذا تغيّر اسم جد أو أبوه تبقى أسماء أحفاده قديمة.
+    لذلك يضيف Trigger آخر العضو المتغير إلى طابور (family_search_refresh_queue) بدون تكرار،
+    ثم يعالج هذا الخيط الطابور في الخلفية: يجمع الفرع كاملاً باستعلام عودي واحد ويحدّثه على دفعات.
+    العضو يُحجز في الطابور أثناء المعالجة ولا يُحذف منه إلا بعد نجاح تحديث فرعه.
+    """
+    REFRESH_DELAY_SECONDS = 2   # تجميع عدة تعديلات متتالية في معالجة واحدة
+    ROOTS_PER_BATCH = 100       # عدد الأعضاء المسحوبين من الطابور في كل دورة
+    CHUNK_SIZE = 500            # عدد الأحفاد المحدّثين في كل معاملة
+    CLAIM_TIMEOUT_SECONDS = 600 # حجز أقدم من ذلك يُعتبر متروكاً (مات العامل أثناء المعالجة)
+
+    _lock = threading.Lock()
+    _run_lock = threading.Lock()
+    _timer: Optional[threading.Timer] = None
+
+    # =======================================================
+    # 1. الجدولة
+    # =======================================================
+    @classmethod
+    def schedule(cls) -> None:
+        with cls._lock:
+            if cls._timer is not None:
+                return
+            timer = threading.Timer(cls.REFRESH_DELAY_SECONDS, cls._run_scheduled)
+            timer.daemon = True
+            cls._timer = timer
+        timer.start()
+
+    @classmethod
+    def _run_scheduled(cls) -> None:
+        with cls._lock:
+            cls._timer = None
+        try:
+            cls.process_queue()
+        except Exception as e:
+            print(f"⚠️ تعذر تحديث أسماء النسب المتسلسلة: {e}")
+
+    # =======================================================
+    # 2. معالجة الطابور
+    # =======================================================
+    @classmethod
+    def _claim_roots(cls) -> List[Tuple[str, datetime]]:
+        """
+        حجز دفعة من الطابور دون حذفها؛ SKIP LOCKED يمنع حجز نفس العضو من عاملين في نفس الوقت.
+        الحجز الأقدم من CLAIM_TIMEOUT_SECONDS يعني أن العامل الذي أخذه مات، فيُحجز من جديد.
+        """
+        with get_db_context() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE family_search_refresh_queue SET claimed_at = NOW()
+                    WHERE code IN (
+                        SELECT code FROM family_search_refresh_queue
+                        WHERE claimed_at IS NULL OR claimed_at < NOW() - make_interval(secs => %s)
+                        ORDER BY queued_at
+                        LIMIT %s
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING code, queued_at
+                """, (cls.CLAIM_TIMEOUT_SECONDS, cls.ROOTS_PER_BATCH))
+                roots = [(r[0], r[1]) for r in cur.fetchall()]
+                conn.commit()
+        return roots
+
+    @staticmethod
+    def _complete_roots(roots: List[Tuple[str, datetime]]) -> None:
+        """حذف الأعضاء المعالَجين بعد نجاح التحديث؛ من تغيّر وقت إدراجه (تعديل جديد أثناء المعالجة) يبقى"""
+        with get_db_context() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    DELETE FROM family_search_refresh_queue q
+                    USING unnest(%s::text[], %s::timestamptz[]) AS done(code, queued_at)
+                    WHERE q.code = done.code AND q.queued_at = done.queued_at
+                """, ([code for code, _ in roots], [queued_at for _, queued_at in roots]))
+                conn.commit()
+
+    @staticmethod
+    def _release_roots(roots: List[Tuple[str, datetime]]) -> None:
+        """إلغاء الحجز بعد فشل التحديث حتى يُعاد في الدورة القادمة بدل ضياعه"""
+        with get_db_context() as conn:
+            with conn.cursor() as cur:
+                cur.execute("UPDATE family_search_refresh_queue SET claimed_at = NULL WHERE code = ANY(%s)",
+                            ([code for code, _ in roots],))
+                conn.commit()
+
+    @staticmethod
+    def _collect_descendants(roots: List[str]) -> List[str]:
+        # UNION (وليس UNION ALL) يزيل المكرر فيتوقف الاستعلام حتى لو وُجدت حلقة خاطئة في البيانات
+        with get_db_context() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    WITH RECURSIVE subtree(code) AS (
+                        SELECT n.code FROM family_name n
+                        WHERE n.f_code = ANY(%s) OR n.m_code = ANY(%s)
+                        UNION
+                        SELECT n.code FROM family_name n
+                        JOIN subtree s ON s.code IN (n.f_code, n.m_code)
+                    )
+                    SELECT code FROM subtree ORDER BY code
+                """, (roots, roots))
+                return [r[0] for r in cur.fetchall()]
+
+    @classmethod
+    def _refresh_chunk(cls, codes: List[str]) -> None:
+        with get_db_context() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE family_search fs
+                    SET full_name = fresh.full_name, updated_at = NOW()
+                    FROM (
+                        SELECT code, public.get_full_name(code, NULL, FALSE) AS full_name
+                        FROM family_name WHERE code = ANY(%s)
+                    ) fresh
+                    WHERE fs.code = fresh.code AND fs.full_name IS DISTINCT FROM fresh.full_name
+                """, (codes,))
+                renamed = cur.rowcount
+                conn.commit()
+        if renamed:
+            # تغيّر الأسماء يغيّر مفاتيح الترتيب ومواقع الصفحات
+            PageIndexService.invalidate()
+        NameIndexService.refresh_codes(codes)
+
+    @classmethod
+    def process_queue(cls) -> int:
+        """معالجة الطابور حتى يفرغ وإرجاع عدد الأحفاد الذين أعيد حساب أسمائهم"""
+        if not cls._run_lock.acquire(blocking=False):
+            # عامل آخر يعالج الطابور الآن؛ نعيد الجدولة حتى لا تضيع التعديلات الأخيرة
+            cls.schedule()
+            return 0
+        try:
+            refreshed = 0
+            while True:
+                roots = cls._claim_roots()
+                if not roots:
+                    break
+                try:
+                    descendants = cls._collect_descendants([code for code, _ in roots])
+                    for i in range(0, len(descendants), cls.CHUNK_SIZE):
+                        cls._refresh_chunk(descendants[i:i + cls.CHUNK_SIZE])
+                except Exception:
+                    cls._release_roots(roots)
+                    raise
+                cls._complete_roots(roots)
+                refreshed += len(descendants)
+            if refreshed:
+                print(f"🔁 تم تحديث أسماء النسب لـ {refreshed} من الأحفاد.")
+            return refreshed
+        finally:
+            cls._run_lock.release()
+
+    # =======================================================
+    # 3. إعادة البناء الكاملة
+    # =======================================================
+    @classmethod
+    def rebuild_all(cls) -> int:
+        """إعادة بناء جدول البحث كاملاً بعبارة SQL واحدة على المجموعة بدل التحديث صفاً بصف"""
+        with get_db_context() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO family_search (code, full_name, nick_name, level)
+                    SELECT code, public.get_full_name(code, NULL, FALSE), nick_name, level
+                    FROM family_name
+                    ON CONFLICT (code) DO UPDATE SET
+                        full_name = EXCLUDED.full_name,
+                        nick_name = EXCLUDED.nick_name,
+                        level = EXCLUDED.level,
+                        updated_at = NOW()
+                    WHERE (family_search.full_name, family_search.nick_name, family_search.level)
+                        IS DISTINCT FROM (EXCLUDED.full_name, EXCLUDED.nick_name, EXCLUDED.level)
+                """)
+                changed = cur.rowcount
+                cur.execute("""
+                    DELETE FROM family_search fs
+                    WHERE NOT EXISTS (SELECT 1 FROM family_name n WHERE n.code = fs.code)
+                """)
+                changed += cur.rowcount
+                conn.commit()
+
+        PageIndexService.invalidate()
+        NameIndexService.rebuild()
+        print(f"🔁 تمت إعادة بناء جدول البحث: {changed} سجل تغيّر.")
+        return changed
@@ -0,0 +1,191 @@
+# thumbnail_service.py
+import io
+import os
+import re
+import threading
+import tempfile
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from googleapiclient.http import MediaIoBaseDownload
+
+from services.pdf_render_service import PdfRenderService
+
+
+class ThumbnailService:
+    """
+    ذاكرة تخزين محلية لمصغرات صور أعضاء العائلة.
+    تُجلب الصورة الأصلية من Google Drive مرة واحدة فقط، وتُصغّر إلى مقاسات ثابتة،
+    ثم تُحفظ على القرص باسم معرف الملف في درايف مع إخلاء الأقدم استخداماً (LRU) عند امتلاء المساحة.
+    """
+    CACHE_DIR = os.getenv("FAMILY_THUMBS_DIR", os.path.join(tempfile.gettempdir(), "hottiyya_thumbs"))
+    MAX_CACHE_BYTES = int(os.getenv("FAMILY_THUMBS_MAX_MB", "200")) * 1024 * 1024
+    SIZES = {"sm": 160, "md": 500}
+    DEFAULT_SIZE = "md"
+    JPEG_QUALITY = 82
+    MAX_SOURCE_BYTES = 15 * 1024 * 1024  # حماية من تنزيل ملفات ضخمة بالخطأ
+
+    _DRIVE_ID_RE = re.compile(r"^[A-Za-z0-9_-]{10,200}$")
+
+    _lock = threading.Lock()
+    _loaded = False
+    _entries: "OrderedDict[str, int]" = OrderedDict()  # اسم الملف -> الحجم بالبايت (الأقدم أولاً)
+    _total_bytes = 0
+    _fetch_locks: Dict[str, threading.Lock] = {}
+
+    # =======================================================
+    # 1. أدوات مساعدة
+    # =======================================================
+    @staticmethod
+    def extract_drive_id(raw_path: Optional[str]) -> Optional[str]:
+        """تنظيف المعرف من أي روابط كاملة محفوظة قديماً في pic_path"""
+        if not raw_path or not raw_path.strip():
+            return None
+        drive_id = raw_path.strip()
+        if "id=" in drive_id:
+            drive_id = drive_id.split("id=")[-1].split("&")[0]
+        elif "/" in drive_id:
+            drive_id = drive_id.rstrip("/").split("/")[-1]
+        return drive_id or None
+
+    @classmethod
+    def is_valid_id(cls, drive_id: Optional[str]) -> bool:
+        return bool(drive_id and cls._DRIVE_ID_RE.match(drive_id))
+
+    @classmethod
+    def url_for(cls, drive_id: Optional[str], size: str = DEFAULT_SIZE) -> Optional[str]:
+        """الرابط المحلي الذي تستخدمه القوالب بدلاً من رابط مصغرات درايف"""
+        if not cls.is_valid_id(drive_id):
+            return None
+        return f"/family/thumb/{drive_id}?size={size}"
+
+    @classmethod
+    def drive_fallback_url(cls, drive_id: str, size: str = DEFAULT_SIZE) -> str:
+        width = cls.SIZES.get(size, cls.SIZES[cls.DEFAULT_SIZE])
+        return f"https://drive.google.com/thumbnail?id={drive_id}&sz=w{width}"
+
+    @classmethod
+    def _file_name(cls, drive_id: str, size: str) -> str:
+        return f"{drive_id}_{size}.jpg"
+
+    # =======================================================
+    # 2. فهرس الـ LRU
+    # =======================================================
+    @classmethod
+    def _ensure_loaded(cls) -> None:
+        """تحميل الملفات الموجودة مسبقاً على القرص مرتبة حسب آخر استخدام"""
+        if cls._loaded:
+            return
+        with cls._lock:
+            if cls._loaded:
+                return
+            os.makedirs(cls.CACHE_DIR, exist_ok=True)
+            files = []
+            for name in os.listdir(cls.CACHE_DIR):
+                path = os.path.join(cls.CACHE_DIR, name)
+                if name.endswith(".jpg") and os.path.isfile(path):
+                    stat = os.stat(path)
+                    files.append((stat.st_mtime, name, stat.st_size))
+            for _, name, size in sorted(files):
+                cls._entries[name] = size
+                cls._total_bytes += size
+            cls._loaded = True
+
+    @classmethod
+    def _touch(cls, name: str) -> bool:
+        with cls._lock:
+            if name not in cls._entries:
+                return False
+            cls._entries.move_to_end(name)
+            return True
+
+    @classmethod
+    def _add_entry(cls, name: str, size: int) -> None:
+        with cls._lock:
+            cls._total_bytes -= cls._entries.pop(name, 0)
+            cls._entries[name] = size
+            cls._total_bytes += size
+            while cls._total_bytes > cls.MAX_CACHE_BYTES and len(cls._entries) > 1:
+                old_name, old_size = cls._entries.popitem(last=False)
+                cls._total_bytes -= old_size
+                try:
+                    os.remove(os.path.join(cls.CACHE_DIR, old_name))
+                except OSError:
+                    pass
+
+    @classmethod
+    def invalidate(cls, drive_id: Optional[str]) -> None:
+        """حذف كل مقاسات الصورة من الذاكرة المحلية (عند استبدال صورة العضو أو حذفه)"""
+        drive_id = cls.extract_drive_id(drive_id)
+        if not cls.is_valid_id(drive_id):
+            return
+        cls._ensure_loaded()
+        with cls._lock:
+            for size in cls.SIZES:
+                name = cls._file_name(drive_id, size)
+                cls._total_bytes -= cls._entries.pop(name, 0)
+                try:
+                    os.remove(os.path.join(cls.CACHE_DIR, name))
+                except OSError:
+                    pass
+
+    # =======================================================
+    # 3. الجلب والتصغير
+    # =======================================================
+    @staticmethod
+    def _download_original(drive_id: str) -> bytes:
+        # استيراد متأخر لتفادي الاستيراد الدائري مع خدمة العائلة
+        from services.family_service import FamilyService
+
+        drive_service = FamilyService.get_drive_service()
+        request = drive_service.files().get_media(fileId=drive_id)
+        buffer = io.BytesIO()
+        downloader = MediaIoBaseDownload(buffer, request)
+        done = False
+        while not done:
+            _, done = downloader.next_chunk()
+            if buffer.tell() > ThumbnailService.MAX_SOURCE_BYTES:
+                raise ValueError("حجم الصورة الأصلية أكبر من المسموح")
+        return buffer.getvalue()
+
+    @classmethod
+    def get_thumbnail_path(cls, drive_id: str, size: str = DEFAULT_SIZE) -> Optional[str]:
+        """إرجاع مسار المصغرة على القرص، مع جلبها وتصغيرها من درايف عند أول طلب فقط"""
+        if not cls.is_valid_id(drive_id):
+            return None
+        if size not in cls.SIZES:
+            size = cls.DEFAULT_SIZE
+        cls._ensure_loaded()
+
+        name = cls._file_name(drive_id, size)
+        path = os.path.join(cls.CACHE_DIR, name)
+        if cls._touch(name) and os.path.exists(path):
+            return path
+
+        # قفل لكل صورة حتى لا تُجلب نفس الصورة عدة مرات بطلبات متزامنة
+        with cls._lock:
+            fetch_lock = cls._fetch_locks.setdefault(drive_id, threading.Lock())
+        with fetch_lock:
+            if cls._touch(name) and os.path.exists(path):
+                return path
+            try:
+                original = cls._download_original(drive_id)
+                source = PdfRenderService.scratch_path(cls.CACHE_DIR, ".src")
+                try:
+                    with open(source, "wb") as f:
+                        f.write(original)
+                    # توليد كل المقاسات من تنزيل واحد وفتح واحد في عمال التصيير (تُكتب على القرص مباشرة)
+                    targets = {os.path.join(cls.CACHE_DIR, cls._file_name(drive_id, size_key)): width
+                               for size_key, width in cls.SIZES.items()}
+                    written = PdfRenderService.resize_image(source, targets, cls.JPEG_QUALITY)
+                finally:
+                    os.remove(source)
+                for target, size_bytes in written.items():
+                    cls._add_entry(os.path.basename(target), size_bytes)
+            except Exception as e:
+                print(f"⚠️ تعذر تجهيز مصغرة الصورة {drive_id}: {e}")
+                return None
+            finally:
+                with cls._lock:
+                    cls._fetch_locks.pop(drive_id, None)
+        return path if os.path.exists(path) else None
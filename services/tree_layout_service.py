@@ -0,0 +1,291 @@
+# tree_layout_service.py
+import json
+import hashlib
+from typing import List, Dict, Optional, Any, Iterable, Tuple
+
+from services.kinship_service import KinshipService
+from services.graph_snapshot_service import GraphSnapshotService
+
+
+class _MemoryTree:
+    """مصدر الشجرة من قواميس KinshipService (قبل كتابة أول لقطة مشتركة)"""
+
+    def has(self, code: Optional[str]) -> bool:
+        return bool(code) and code in KinshipService._info
+
+    def member(self, code: str) -> Dict[str, Any]:
+        return KinshipService._info.get(code, {})
+
+    def children(self, code: str) -> List[str]:
+        return sorted(KinshipService._children.get(code, ()))
+
+    def key(self, code: str) -> str:
+        """مفتاح التخطيط المحفوظ: الكود، ويُبطل بالمسار عند التعديل"""
+        return code
+
+
+class _SnapshotTree:
+    """نفس الواجهة فوق اللقطة المشتركة (mmap)، فلا تُنسخ الشجرة في ذاكرة كل worker"""
+
+    def __init__(self, graph):
+        self.graph = graph
+
+    def has(self, code: Optional[str]) -> bool:
+        return self.graph.index_of(code) >= 0
+
+    def member(self, code: str) -> Dict[str, Any]:
+        index = self.graph.index_of(code)
+        if index < 0:
+            return {}
+        member = {key: (self.graph.code(i) if i >= 0 else None) for key, i in self.graph.relatives(index).items()}
+        member.update(name=self.graph.name(index), gender=self.graph.gender(index))
+        return member
+
+    def children(self, code: str) -> List[str]:
+        # الأعضاء مرقّمون بترتيب أكوادهم، فترتيب الأرقام هو ترتيب الأكواد
+        index = self.graph.index_of(code)
+        return [self.graph.code(i) for i in sorted(self.graph.children(index))] if index >= 0 else []
+
+    def key(self, code: str) -> int:
+        """مفتاح التخطيط المحفوظ: بصمة الفرع، فالفرع الذي لم يتغير يعيد استخدام تخطيطه في اللقطة التالية"""
+        return self.graph.subtree_hash(self.graph.index_of(code))
+
+
+class _SubtreeLayout:
+    """تخطيط فرع نسبةً إلى جذره (x = 0): حدود الفرع اليسرى واليمنى لكل جيل وإزاحات الأبناء المباشرين"""
+    __slots__ = ("left", "right", "offsets")
+
+    def __init__(self, left: List[float], right: List[float], offsets: List[Tuple[str, float]]):
+        self.left = left
+        self.right = right
+        self.offsets = offsets
+
+
+class TreeLayoutService:
+    """
+    حساب إحداثيات الشجرة في الخادم بخوارزمية Reingold–Tilford (الشجرة المرتبة):
+    كل فرع يُخطط مرة واحدة ويُحفظ تخطيطه النسبي، ثم تُدفع الفروع المتجاورة أفقياً بمقارنة حدودها
+    جيلاً بجيل ويُوضع الأب (مع أزواجه على يمينه) في منتصف أبنائه.
+
+    يقرأ شجرة النسب من اللقطة المشتركة (GraphSnapshotService) وتُحفظ التخطيطات ببصمة الفرع، فمع كل لقطة
+    جديدة لا يُعاد إلا حساب الفروع التي تغيّرت بصمتها (العضو المعدّل وأصوله) ويُحذف ما لم يعد موجوداً.
+    حين لا توجد لقطة تُقرأ قواميس KinshipService وتُحفظ التخطيطات بالكود، وعند تعديل عضو
+    يُبطل تخطيطه وتخطيط أصوله فقط مع إعادة استخدام تخطيطات الفروع الأخرى كما هي.
+    """
+    SIBLING_GAP = 0.5   # المسافة بين حدود الفروع المتجاورة (بوحدة عرض البطاقة)
+    MAX_CACHED_PAYLOADS = 64
+
+    _layouts: Dict[Any, _SubtreeLayout] = {}  # مفتاحها tree.key: بصمة الفرع (لقطة) أو الكود (قواميس)
+    _payloads: Dict[str, Tuple[int, Dict[str, Any]]] = {}
+    _generation = 0  # يزداد مع أي تعديل؛ الحمولات الجاهزة صالحة لنفس الجيل فقط
+    _source: Optional[int] = None  # جيل اللقطة التي بُنيت منها التخطيطات (None = القواميس في الذاكرة)
+    _tree: Any = _MemoryTree()
+
+    # =======================================================
+    # 1. الإبطال التزايدي
+    # =======================================================
+    @classmethod
+    def invalidate(cls, codes: Iterable[str]) -> None:
+        """
+        إبطال تخطيط الأعضاء وأصولهم؛ يُستدعى قبل تحديث شجرة النسب وبعده ليشمل الأب القديم والجديد.
+        يشمل أزواج الأعضاء (في الاتجاهين): عدد الأزواج يحدد عرض بطاقة الزوج، فإضافة زوجة سبق تسجيلها
+        في w_code زوجها تغيّر عرض فرعه هو أيضاً.
+        تخطيطات اللقطة (ببصمة الفرع) لا تحتاج إبطالاً: اللقطة التالية تغيّر بصمة الفروع المتأثرة فقط.
+        """
+        with KinshipService._lock:
+            codes = {code for code in codes if code}
+            info = KinshipService._info
+            affected = set(codes)
+            for code in codes:
+                member = info.get(code, {})
+                affected.update(p for p in (member.get("w_code"), member.get("h_code")) if p)
+            affected.update(c for c, m in info.items() if m.get("w_code") in codes or m.get("h_code") in codes)
+            for code in affected:
+                current, steps = code, 0
+                while current and steps <= len(KinshipService._parent):
+                    cls._layouts.pop(current, None)
+                    current = KinshipService._parent.get(current)
+                    steps += 1
+            if cls._source is None:
+                cls._generation += 1
+                cls._payloads.clear()
+
+    @classmethod
+    def on_family_changing(cls, codes: List[str], removed: List[str], bulk: bool) -> None:
+        """مشترك FamilyEvents قبل KinshipService: إبطال التخطيط على مسار الأصول القديم"""
+        cls.invalidate(codes + removed)
+
+    @classmethod
+    def on_family_changed(cls, codes: List[str], removed: List[str], bulk: bool) -> None:
+        """مشترك FamilyEvents بعد KinshipService: إبطال المسار الجديد، أو كل التخطيطات بعد إعادة بناء الجدول"""
+        if bulk and KinshipService._built:
+            cls.reset()
+        else:
+            cls.invalidate(codes)
+
+    @classmethod
+    def reset(cls) -> None:
+        with KinshipService._lock:
+            cls._layouts.clear()
+            cls._payloads.clear()
+            cls._generation += 1
+
+    # =======================================================
+    # 2. الخوارزمية
+    # =======================================================
+    @classmethod
+    def _spouses(cls, code: str) -> List[str]:
+        """الأزواج المعروضون بجانب العضو: الزوج المسجل ثم الشركاء في الأبناء"""
+        tree = cls._tree
+        member = tree.member(code)
+        spouses: List[str] = []
+        for partner in (member.get("w_code"), member.get("h_code")):
+            if tree.has(partner) and partner not in spouses:
+                spouses.append(partner)
+        for child in tree.children(code):
+            child_info = tree.member(child)
+            partner = child_info.get("m_code") if child_info.get("f_code") == code else child_info.get("f_code")
+            if partner and partner != code and tree.has(partner) and partner not in spouses:
+                spouses.append(partner)
+        return spouses
+
+    @classmethod
+    def _compute(cls, code: str) -> _SubtreeLayout:
+        """تخطيط عقدة بعد توفر تخطيطات أبنائها"""
+        left_edge, right_edge = -0.5, 0.5 + len(cls._spouses(code))
+        children = cls._tree.children(code)
+        if not children:
+            return _SubtreeLayout([left_edge], [right_edge], [])
+
+        acc_left: List[float] = []
+        acc_right: List[float] = []
+        offsets: List[Tuple[str, float]] = []
+        for child in children:
+            layout = cls._layouts[cls._tree.key(child)]
+            if not offsets:
+                shift = 0.0
+            else:
+                # أقل إزاحة تمنع تداخل الفرع الجديد مع ما سبقه في كل الأجيال المشتركة
+                shared = min(len(acc_right), len(layout.left))
+                shift = max(acc_right[d] - layout.left[d] for d in range(shared)) + cls.SIBLING_GAP
+            for depth, value in enumerate(layout.left):
+                if depth >= len(acc_left):
+                    acc_left.append(value + shift)
+            for depth, value in enumerate(layout.right):
+                if depth < len(acc_right):
+                    acc_right[depth] = value + shift
+                else:
+                    acc_right.append(value + shift)
+            offsets.append((child, shift))
+
+        # توسيط الأبناء تحت العضو وأزواجه
+        delta = (left_edge + right_edge) / 2 - (offsets[0][1] + offsets[-1][1]) / 2
+        return _SubtreeLayout(
+            [left_edge] + [v + delta for v in acc_left],
+            [right_edge] + [v + delta for v in acc_right],
+            [(child, shift + delta) for child, shift in offsets],
+        )
+
+    @classmethod
+    def _ensure_layout(cls, root: str) -> None:
+        """حساب التخطيطات الناقصة في الفرع فقط (ترتيب لاحق بدون عودية)"""
+        key = cls._tree.key
+        stack = [(root, False)]
+        while stack:
+            code, children_ready = stack.pop()
+            if key(code) in cls._layouts:
+                continue
+            if children_ready:
+                cls._layouts[key(code)] = cls._compute(code)
+                continue
+            stack.append((code, True))
+            for child in cls._tree.children(code):
+                if key(child) not in cls._layouts:
+                    stack.append((child, False))
+
+    # =======================================================
+    # 3. الحمولة المضغوطة
+    # =======================================================
+    @classmethod
+    def _walk(cls, root: str) -> List[str]:
+        codes, stack = [], [root]
+        while stack:
+            code = stack.pop()
+            codes.append(code)
+            stack.extend(cls._tree.children(code))
+        return codes
+
+    @classmethod
+    def _build_payload(cls, root: str) -> Dict[str, Any]:
+        tree = cls._tree
+        cls._ensure_layout(root)
+        layouts = {code: cls._layouts[tree.key(code)] for code in cls._walk(root)}
+
+        # nodes: [code, name, x, y, parent_index, gender] — spouses: [code, name, x, y, partner_index]
+        nodes: List[List[Any]] = []
+        spouses: List[List[Any]] = []
+        stack: List[Tuple[str, float, int, int]] = [(root, 0.0, 0, -1)]
+        while stack:
+            code, x, depth, parent_index = stack.pop()
+            index = len(nodes)
+            member = tree.member(code)
+            gender = member.get("gender")
+            nodes.append([code, member["name"], x, depth, parent_index,
+                          "f" if gender == "أنثى" else "m" if gender == "ذكر" else ""])
+            for slot, partner in enumerate(cls._spouses(code), start=1):
+                spouses.append([partner, tree.member(partner)["name"], x + slot, depth, index])
+            for child, offset in reversed(layouts[code].offsets):
+                stack.append((child, x + offset, depth + 1, index))
+
+        layout = layouts[root]
+        min_x = min(layout.left)
+        for row in nodes:
+            row[2] = round(row[2] - min_x, 3)
+        for row in spouses:
+            row[2] = round(row[2] - min_x, 3)
+        payload = {
+            "root": root,
+            "width": round(max(layout.right) - min_x, 3),
+            "height": len(layout.left),
+            "nodes": nodes,
+            "spouses": spouses,
+        }
+        # النسخة من محتوى التخطيط لا من عداد العملية: نفس الـ ETag في كل الـ workers يعني نفس الشجرة
+        payload["version"] = hashlib.sha1(
+            json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        ).hexdigest()[:20]
+        return payload
+
+    @classmethod
+    def get_layout(cls, code: str) -> Optional[Dict[str, Any]]:
+        root = code.strip().upper()
+        graph = GraphSnapshotService.serving_graph()
+        if graph is None:
+            KinshipService.ensure_built()
+        else:
+            KinshipService.release()
+        with KinshipService._lock:
+            source = graph.generation if graph is not None else None
+            if source != cls._source:
+                if graph is not None:
+                    # إبقاء تخطيطات الفروع التي ما زالت بصمتها موجودة في اللقطة الجديدة فقط
+                    present = set(graph.subtree_hashes())
+                    cls._layouts = {key: layout for key, layout in cls._layouts.items() if key in present}
+                else:
+                    # تخطيطات القواميس قد تكون فاتها إبطال أثناء العمل باللقطة
+                    cls._layouts = {key: layout for key, layout in cls._layouts.items() if not isinstance(key, str)}
+                # الحمولات تحمل الأسماء، وهي خارج بصمة الفرع
+                cls._payloads.clear()
+                cls._generation += 1
+                cls._source = source
+                cls._tree = _SnapshotTree(graph) if graph is not None else _MemoryTree()
+            if not cls._tree.has(root):
+                return None
+            cached = cls._payloads.get(root)
+            if cached and cached[0] == cls._generation:
+                return cached[1]
+            payload = cls._build_payload(root)
+            if len(cls._payloads) >= cls.MAX_CACHED_PAYLOADS:
+                cls._payloads.pop(next(iter(cls._payloads)))
+            cls._payloads[root] = (cls._generation, payload)
+            return payload
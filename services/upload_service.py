@@ -0,0 +1,365 @@
+# upload_service.py
+import os
+import asyncio
+import hashlib
+import tempfile
+from typing import Optional, Dict, Any, List, Tuple
+
+from fastapi import Request, HTTPException
+from python_multipart.multipart import MultipartParser, parse_options_header
+from python_multipart.exceptions import MultipartParseError
+
+from core.config import MB, UPLOAD_ROUTE_LIMITS
+
+
+class UploadRejected(ValueError):
+    """رفض الملف المرفوع (صيغة أو محتوى أو حجم غير مسموح) مع رسالة جاهزة للعرض"""
+
+
+class UploadService:
+    """
+    طبقة استقبال موحدة للنماذج التي تحمل ملفات (المكتبة، المعرض، الأخبار، المقالات، شجرة العائلة):
+    - تقرأ جسم الطلب نفسه (request.stream) وتحلل multipart أثناء وصوله، فلا يُكتب الجسم في ملف
+      Starlette المؤقت ثم يُنسخ؛ كل ملف يُكتب مباشرة في وجهته على دفعات (CHUNK_SIZE) بدون حجب حلقة الأحداث.
+    - تفحص الامتداد من ترويسة الجزء قبل أي كتابة، والمحتوى الحقيقي من أول البايتات (التوقيع السحري)،
+      وتتوقف عن كتابة الملف فور تجاوز حد فئته؛ وتُعد بايتات الجسم كاملاً مقابل حد المسار (يشمل chunked).
+    - تحسب بصمة SHA-256 في نفس المرور.
+    """
+    CHUNK_SIZE = 1 * MB
+    FIELD_LIMIT = 1 * MB  # أقصى حجم لحقل نصي واحد
+    UPLOAD_DIR = os.getenv("UPLOADS_TMP_DIR", os.path.join(tempfile.gettempdir(), "hottiyya_uploads"))
+
+    # الامتداد -> (نوع MIME الحقيقي، الفئة)
+    FILE_TYPES = {
+        ".pdf": ("application/pdf", "document"),
+        ".doc": ("application/msword", "document"),
+        ".docx": ("application/vnd.openxmlformats-officedocument.wordprocessingml.document", "document"),
+        ".ppt": ("application/vnd.ms-powerpoint", "document"),
+        ".pptx": ("application/vnd.openxmlformats-officedocument.presentationml.presentation", "document"),
+        ".jpg": ("image/jpeg", "image"),
+        ".jpeg": ("image/jpeg", "image"),
+        ".png": ("image/png", "image"),
+        ".webp": ("image/webp", "image"),
+        ".gif": ("image/gif", "image"),
+        ".mp4": ("video/mp4", "video"),
+        ".mov": ("video/quicktime", "video"),
+        ".webm": ("video/webm", "video"),
+    }
+
+    # نوع الرفع -> الامتدادات المسموحة والحد الأقصى لكل فئة
+    PROFILES = {
+        "book": {"extensions": {".pdf", ".doc", ".docx", ".ppt", ".pptx"}, "limits": {"document": 40 * MB},
+                 "ext_error": "صيغة الملف غير مدعومة! المسموح: PDF, Word, PowerPoint"},
+        "image": {"extensions": {".jpg", ".jpeg", ".png", ".webp", ".gif"}, "limits": {"image": 5 * MB},
+                  "ext_error": "امتداد الصورة غير مدعوم! المسموح: JPG, PNG, WEBP, GIF"},
+        "news_media": {"extensions": {".jpg", ".jpeg", ".png", ".webp", ".gif", ".mp4", ".mov", ".webm"},
+                       "limits": {"image": 5 * MB, "video": 40 * MB},
+                       "ext_error": "نوع الملف غير مدعوم! يسمح بالصور أو الفيديوهات القصيرة فقط."},
+        "member_picture": {"extensions": {".jpg", ".jpeg", ".png", ".webp"}, "limits": {"image": 5 * MB},
+                           "ext_error": "نوع الصورة غير مدعوم! استخدم: JPG، PNG، WebP فقط"},
+    }
+
+    # =======================================================
+    # 1. الحدود وفحص المحتوى
+    # =======================================================
+    @staticmethod
+    def limit_for(path: str) -> Optional[int]:
+        for prefix, limit in UPLOAD_ROUTE_LIMITS.items():
+            if path == prefix or (prefix.endswith("/") and path.startswith(prefix)):
+                return limit
+        return None
+
+    @staticmethod
+    def matches_signature(mime: str, head: bytes) -> bool:
+        """هل تطابق البايتات الأولى من الملف نوعه المعلن بالامتداد"""
+        if mime == "application/pdf":
+            return b"%PDF-" in head[:1024]
+        if mime in ("application/msword", "application/vnd.ms-powerpoint"):
+            return head.startswith(b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1")  # OLE2
+        if mime.startswith("application/vnd.openxmlformats"):
+            return head.startswith(b"PK\x03\x04")  # ZIP
+        if mime == "image/jpeg":
+            return head.startswith(b"\xff\xd8\xff")
+        if mime == "image/png":
+            return head.startswith(b"\x89PNG\r\n\x1a\n")
+        if mime == "image/gif":
+            return head[:6] in (b"GIF87a", b"GIF89a")
+        if mime == "image/webp":
+            return head[:4] == b"RIFF" and head[8:12] == b"WEBP"
+        if mime in ("video/mp4", "video/quicktime"):
+            return head[4:8] in (b"ftyp", b"moov", b"mdat", b"wide", b"free")
+        if mime == "video/webm":
+            return head.startswith(b"\x1a\x45\xdf\xa3")  # EBML
+        return False
+
+    # =======================================================
+    # 2. الاستقبال
+    # =======================================================
+    @classmethod
+    async def receive_form(cls, request: Request, files: Dict[str, str],
+                           destinations: Optional[Dict[str, Tuple[str, str]]] = None) -> "UploadForm":
+        """
+        استقبال نموذج multipart من جسم الطلب مباشرة.
+        files: اسم الحقل -> نوع الرفع في PROFILES؛ حقول الملفات الأخرى تُتجاهل بدون كتابة.
+        destinations: اسم الحقل -> (المجلد، بادئة الاسم) لكتابة الملف مباشرة حيث سيُستخدم.
+        رفض ملف (صيغة/محتوى/حجم) لا يوقف الاستقبال بل يُسجل في form.errors، وتجاوز حد الجسم يرفع 413.
+        الملفات المستقبلة ملك المستدعي (form.discard بعد الاستخدام).
+        """
+        content_type, options = parse_options_header(request.headers.get("content-type"))
+        if content_type != b"multipart/form-data":
+            # نموذج بلا ملفات (urlencoded): حجمه محدود بحد المسار في الوسيط
+            data = await request.form()
+            form = UploadForm()
+            form.fields.update({key: value for key, value in data.items() if isinstance(value, str)})
+            return form
+        boundary = options.get(b"boundary")
+        if not boundary:
+            raise HTTPException(status_code=400, detail="طلب رفع غير صالح")
+
+        limit = cls.limit_for(request.url.path)
+        receiver = _MultipartReceiver(files, destinations or {})
+        parser = MultipartParser(boundary, receiver.callbacks)
+        received = 0
+        try:
+            async for chunk in request.stream():
+                received += len(chunk)
+                if limit and received > limit:
+                    raise HTTPException(status_code=413, detail=f"حجم الملفات المرفوعة كبير جداً! الحد الأقصى {limit // MB} ميجابايت.")
+                parser.write(chunk)
+                await receiver.drain()
+            parser.finalize()
+            await receiver.drain()
+            receiver.close()
+        except MultipartParseError:
+            receiver.abort()
+            raise HTTPException(status_code=400, detail="طلب رفع غير صالح")
+        except BaseException:
+            receiver.abort()
+            raise
+        return receiver.form
+
+    @staticmethod
+    def discard(upload: Optional[Dict[str, Any]]) -> None:
+        """حذف الملف المؤقت بأمان بعد انتهاء استخدامه"""
+        if upload and upload.get("path") and os.path.exists(upload["path"]):
+            try:
+                os.remove(upload["path"])
+            except OSError as e:
+                print(f"⚠️ تعذر حذف الملف المؤقت {upload['path']}: {e}")
+
+
+class UploadForm:
+    """نتيجة receive_form: الحقول النصية، والملفات المستقبلة، ورسالة رفض كل حقل ملف مرفوض"""
+
+    def __init__(self):
+        self.fields: Dict[str, str] = {}
+        # {"path", "size", "sha256", "mime", "category", "ext", "filename", "content_type"}
+        self.files: Dict[str, Dict[str, Any]] = {}
+        self.errors: Dict[str, str] = {}
+
+    def get(self, name: str, default: Optional[str] = None) -> Optional[str]:
+        return self.fields.get(name, default)
+
+    def file(self, name: str) -> Optional[Dict[str, Any]]:
+        return self.files.get(name)
+
+    def discard(self) -> None:
+        """حذف الملفات التي لم ينقلها المستدعي إلى مكانها النهائي"""
+        for upload in self.files.values():
+            UploadService.discard(upload)
+
+
+class _FileSink:
+    """ملف واحد أثناء الاستقبال: الامتداد عند فتحه، ثم التوقيع من أول البايتات، والحجم والبصمة مع كل دفعة"""
+    HEAD_BYTES = 1024
+
+    def __init__(self, kind: str, filename: str, content_type: str, dest_dir: Optional[str], prefix: str):
+        profile = UploadService.PROFILES[kind]
+        self.filename = filename
+        self.content_type = content_type
+        self.ext = os.path.splitext(filename)[1].lower()
+        if self.ext not in profile["extensions"]:
+            raise UploadRejected(profile["ext_error"])
+        self.mime, self.category = UploadService.FILE_TYPES[self.ext]
+        self.max_bytes = profile["limits"][self.category]
+
+        directory = dest_dir or UploadService.UPLOAD_DIR
+        os.makedirs(directory, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(prefix=prefix, suffix=self.ext, dir=directory)
+        self.out = os.fdopen(fd, "wb")
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.head = b""
+        self.pending = bytearray()
+
+    def _check_head(self) -> None:
+        if not UploadService.matches_signature(self.mime, self.head):
+            raise UploadRejected("محتوى الملف لا يطابق صيغته! قد يكون الملف تالفاً أو متنكراً بامتداد آخر.")
+
+    async def write(self, data: bytes) -> None:
+        if len(self.head) < self.HEAD_BYTES:
+            self.head += data[:self.HEAD_BYTES - len(self.head)]
+            if len(self.head) == self.HEAD_BYTES:
+                self._check_head()
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            raise UploadRejected(f"حجم الملف كبير جداً! الحد الأقصى المسموح به هو {self.max_bytes // MB} ميجابايت.")
+        self.digest.update(data)
+        self.pending += data
+        if len(self.pending) >= UploadService.CHUNK_SIZE:
+            await self._flush()
+
+    async def _flush(self) -> None:
+        if self.pending:
+            chunk, self.pending = bytes(self.pending), bytearray()
+            await asyncio.to_thread(self.out.write, chunk)
+
+    async def finish(self) -> Dict[str, Any]:
+        if self.size == 0:
+            raise UploadRejected("الملف المرفوع فارغ.")
+        if len(self.head) < self.HEAD_BYTES:
+            self._check_head()
+        await self._flush()
+        self.out.close()
+        return {"path": self.path, "size": self.size, "sha256": self.digest.hexdigest(), "mime": self.mime,
+                "category": self.category, "ext": self.ext, "filename": self.filename,
+                "content_type": self.content_type}
+
+    def abort(self) -> None:
+        self.out.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class _MultipartReceiver:
+    """
+    أحداث MultipartParser تُجمع أثناء write (دوال متزامنة) ثم تُعالج بعدها في drain،
+    حيث تُكتب دفعات الملفات في Thread منفصل.
+    """
+
+    def __init__(self, files: Dict[str, str], destinations: Dict[str, Tuple[str, str]]):
+        self.files = files
+        self.destinations = destinations
+        self.form = UploadForm()
+        self.events: List[Tuple[str, bytes]] = []
+        self.headers: Dict[bytes, bytes] = {}
+        self.header_field = b""
+        self.header_value = b""
+        self.name = ""
+        self.text: Optional[bytearray] = None
+        self.sink: Optional[_FileSink] = None
+
+        def on_data(event):
+            return lambda data, start, end: self.events.append((event, data[start:end]))
+
+        def on_mark(event):
+            return lambda: self.events.append((event, b""))
+
+        self.callbacks = {
+            "on_part_begin": on_mark("part_begin"),
+            "on_header_field": on_data("header_field"),
+            "on_header_value": on_data("header_value"),
+            "on_header_end": on_mark("header_end"),
+            "on_headers_finished": on_mark("headers_finished"),
+            "on_part_data": on_data("part_data"),
+            "on_part_end": on_mark("part_end"),
+        }
+
+    def _reject(self, error: UploadRejected) -> None:
+        if self.sink:
+            self.sink.abort()
+            self.sink = None
+        self.form.errors[self.name] = str(error)
+
+    def _open_part(self) -> None:
+        _, options = parse_options_header(self.headers.get(b"content-disposition", b""))
+        self.name = options.get(b"name", b"").decode("utf-8", "replace")
+        filename = options.get(b"filename")
+        if filename is None:
+            self.text = bytearray()
+            return
+        filename = filename.decode("utf-8", "replace")
+        kind = self.files.get(self.name)
+        # حقل ملف غير متوقع أو متكرر أو متروك فارغاً في المتصفح: تُتجاهل بياناته
+        if not kind or not filename.strip() or self.name in self.form.files or self.name in self.form.errors:
+            return
+        dest_dir, prefix = self.destinations.get(self.name, (None, "upload__"))
+        content_type = self.headers.get(b"content-type", b"").decode("latin-1")
+        try:
+            self.sink = _FileSink(kind, filename, content_type, dest_dir, prefix)
+        except UploadRejected as e:
+            self._reject(e)
+
+    async def drain(self) -> None:
+        events, self.events = self.events, []
+        for event, data in events:
+            if event == "part_begin":
+                self.headers, self.text, self.sink = {}, None, None
+            elif event == "header_field":
+                self.header_field += data
+            elif event == "header_value":
+                self.header_value += data
+            elif event == "header_end":
+                self.headers[self.header_field.lower()] = self.header_value
+                self.header_field, self.header_value = b"", b""
+            elif event == "headers_finished":
+                self._open_part()
+            elif event == "part_data":
+                if self.text is not None:
+                    self.text += data
+                    if len(self.text) > UploadService.FIELD_LIMIT:
+                        raise HTTPException(status_code=413, detail="حقل النموذج كبير جداً")
+                elif self.sink:
+                    try:
+                        await self.sink.write(data)
+                    except UploadRejected as e:
+                        self._reject(e)
+            elif event == "part_end":
+                if self.text is not None:
+                    self.form.fields[self.name] = self.text.decode("utf-8", "replace")
+                    self.text = None
+                elif self.sink:
+                    try:
+                        self.form.files[self.name] = await self.sink.finish()
+                    except UploadRejected as e:
+                        self._reject(e)
+                    self.sink = None
+
+    def close(self) -> None:
+        """جسم انتهى قبل حد الجزء الأخير: الملف الناقص لا يُعتمد"""
+        if self.sink:
+            self.sink.abort()
+            self.sink = None
+
+    def abort(self) -> None:
+        self.close()
+        self.form.discard()
+
+
+class UploadLimitMiddleware:
+    """
+    حد حجم جسم الطلب لمسارات الرفع على مستوى ASGI: الطلب الذي يعلن Content-Length أكبر من حد مساره
+    يُرد عليه بـ 413 قبل أن يبدأ التطبيق بقراءة جسمه.
+    الأجسام المجزأة (chunked) بلا Content-Length تُعد بايتاتها في UploadService.receive_form أثناء التحليل.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    @staticmethod
+    async def _reject(send, limit: int) -> None:
+        body = f"حجم الملفات المرفوعة كبير جداً! الحد الأقصى {limit // MB} ميجابايت.".encode("utf-8")
+        await send({"type": "http.response.start", "status": 413,
+                    "headers": [(b"content-type", b"text/plain; charset=utf-8"),
+                                (b"content-length", str(len(body)).encode("ascii")),
+                                (b"connection", b"close")]})
+        await send({"type": "http.response.body", "body": body})
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["method"] == "POST":
+            limit = UploadService.limit_for(scope["path"])
+            content_length = dict(scope["headers"]).get(b"content-length", b"")
+            if limit and content_length.isdigit() and int(content_length) > limit:
+                await self._reject(send, limit)
+                return
+        await self.app(scope, receive, send)
@@ -6,11 +6,12 @@
 // 1. دالة تصدير شجرة العائلة بصيغة Excel/CSV
 function exportTree() {
     const code = document.getElementById('treeCodeInput').value.trim();
-    if (!code) {
-        alert("يرجى إدخال كود الشخص أولاً!");
-        return;
-    }
-    window.location.href = `/data/export/family-tree/${code}`;
+    const gzipBox = document.getElementById('treeGzipInput');
+    const query = gzipBox && gzipBox.checked ? '?gzip=true' : '';
+    const formatBox = document.getElementById('treeFormatInput');
+    const format = formatBox ? formatBox.value : 'family-tree';
+    // الحقل الفارغ يعني تصدير العائلة كاملة (تصدير متدفق من الخادم)
+    window.location.href = `/data/export/${format}/${encodeURIComponent(code)}${query}`;
 }
 
 // 💡 يمكنك إضافة أي دالة جديدة هنا مستقبلاً (مثل: تحديث الإحصائيات، جلب بيانات بالـ AJAX، إلخ...)
\ No newline at end of file
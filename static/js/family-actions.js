@@ -8,6 +8,8 @@ document.addEventListener('DOMContentLoaded', () => {
     const codeInput = document.getElementById('memberCode');
     const statusIcon = document.getElementById('codeStatusIcon');
     const feedback = document.getElementById('codeFeedback');
+    // الكود المقترح يُحجز رقمه عند الحفظ؛ أي تعديل يدوي يجعله كوداً صريحاً
+    const autoCodeFlag = document.getElementById('memberCodeAuto');
     
     let abortController = null;
 
@@ -15,6 +17,7 @@ document.addEventListener('DOMContentLoaded', () => {
         codeInput.addEventListener('input', async function(e) {
             let val = e.target.value.trim().toUpperCase();
             e.target.value = val;
+            if (autoCodeFlag) autoCodeFlag.value = '';
 
             if (abortController) abortController.abort();
             abortController = new AbortController();
@@ -26,6 +29,7 @@ document.addEventListener('DOMContentLoaded', () => {
                     const data = await res.json();
                     if (data.next_code) {
                         e.target.value = data.next_code;
+                        if (autoCodeFlag) autoCodeFlag.value = '1';
                         e.target.setSelectionRange(1, data.next_code.length);
                         validateCode(data.next_code);
                     }
@@ -39,6 +43,7 @@ document.addEventListener('DOMContentLoaded', () => {
                     const data = await response.json();
                     if (data.next_code) {
                         e.target.value = data.next_code;
+                        if (autoCodeFlag) autoCodeFlag.value = '1';
                         validateCode(data.next_code); 
                     }
                 } catch (error) {
@@ -204,4 +209,46 @@ document.addEventListener('DOMContentLoaded', () => {
             }, false);
         });
     }
-});
\ No newline at end of file
+
+    // ==========================================
+    // 4️⃣ رابعاً: اقتراح أكواد الأب والأم والزوج بالبادئة أو بجزء من الاسم
+    // ==========================================
+    const suggestList = document.getElementById('memberCodeSuggestions');
+    const suggestInputs = document.querySelectorAll('input[data-code-suggest]');
+    let suggestController = null;
+    let suggestTimer = null;
+
+    async function loadSuggestions(text) {
+        if (suggestController) suggestController.abort();
+        suggestController = new AbortController();
+        try {
+            const response = await fetch(`/family/api/code-suggest?q=${encodeURIComponent(text)}`, { signal: suggestController.signal });
+            if (!response.ok) return;
+            const data = await response.json();
+            suggestList.innerHTML = '';
+            data.results.forEach(item => {
+                const option = document.createElement('option');
+                option.value = item.code;
+                option.label = item.nick_name ? `${item.full_name} (${item.nick_name})` : (item.full_name || '');
+                suggestList.appendChild(option);
+            });
+        } catch (err) {
+            if (err.name !== 'AbortError') console.error("خطأ في جلب اقتراحات الأكواد:", err);
+        }
+    }
+
+    if (suggestList) {
+        suggestInputs.forEach(input => {
+            input.addEventListener('input', function() {
+                const text = this.value.trim();
+                clearTimeout(suggestTimer);
+                if (text.length < 2) return;
+                suggestTimer = setTimeout(() => loadSuggestions(text), 150);
+            });
+            // عند اختيار اقتراح يُحفظ الكود بالأحرف الكبيرة كما يتوقعه الخادم
+            input.addEventListener('change', function() {
+                this.value = this.value.trim().toUpperCase();
+            });
+        });
+    }
+});
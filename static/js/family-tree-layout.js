@@ -0,0 +1,88 @@
+/**
+ * عرض الفرع كاملاً كرسم SVG من إحداثيات محسوبة في الخادم (/family/api/tree-layout/{code})
+ * المتصفح لا يحسب أي تخطيط: كل عقدة تأتي بموضعها (x بوحدة عرض البطاقة، y بالجيل).
+ */
+document.addEventListener('DOMContentLoaded', () => {
+    const button = document.getElementById('showFullLayout');
+    const container = document.getElementById('treeLayout');
+    if (!button || !container) return;
+
+    const UNIT_X = 130;  // عرض البطاقة مع الهامش بالبكسل
+    const UNIT_Y = 90;   // المسافة بين الأجيال
+    const BOX_W = 116;
+    const BOX_H = 34;
+    const SVG_NS = 'http://www.w3.org/2000/svg';
+
+    function svgEl(tag, attrs) {
+        const el = document.createElementNS(SVG_NS, tag);
+        for (const [key, value] of Object.entries(attrs)) el.setAttribute(key, value);
+        return el;
+    }
+
+    function drawBox(layer, code, name, x, y, cls) {
+        const link = svgEl('a', { href: `/family/details/${encodeURIComponent(code)}` });
+        link.appendChild(svgEl('rect', {
+            x: x - BOX_W / 2, y: y - BOX_H / 2, width: BOX_W, height: BOX_H, rx: 8, class: cls
+        }));
+        const label = svgEl('text', { x: x, y: y + 5, 'text-anchor': 'middle', class: 'layout-label' });
+        label.textContent = name || code;
+        const title = svgEl('title', {});
+        title.textContent = code;
+        link.appendChild(label);
+        link.appendChild(title);
+        layer.appendChild(link);
+    }
+
+    function render(layout) {
+        // الإحداثيات من اليسار لليمين؛ نعكس المحور الأفقي لتناسب اتجاه الصفحة العربية
+        const width = (layout.width + 1) * UNIT_X;
+        const height = layout.height * UNIT_Y + BOX_H;
+        const px = x => width - (x + 0.5) * UNIT_X;
+        const py = y => y * UNIT_Y + BOX_H;
+
+        const svg = svgEl('svg', { width: width, height: height, class: 'layout-svg' });
+        const edges = svgEl('g', { class: 'layout-edges' });
+        const boxes = svgEl('g', {});
+        svg.appendChild(edges);
+        svg.appendChild(boxes);
+
+        layout.nodes.forEach(([code, name, x, y, parentIndex, gender]) => {
+            if (parentIndex >= 0) {
+                const parent = layout.nodes[parentIndex];
+                const midY = py(y) - UNIT_Y / 2;
+                edges.appendChild(svgEl('path', {
+                    d: `M${px(parent[2])},${py(parent[3]) + BOX_H / 2} V${midY} H${px(x)} V${py(y) - BOX_H / 2}`
+                }));
+            }
+            drawBox(boxes, code, name, px(x), py(y), gender === 'f' ? 'layout-box layout-female' : 'layout-box');
+        });
+        layout.spouses.forEach(([code, name, x, y, partnerIndex]) => {
+            const partner = layout.nodes[partnerIndex];
+            edges.appendChild(svgEl('line', {
+                x1: px(partner[2]), y1: py(y), x2: px(x), y2: py(y), class: 'layout-marriage'
+            }));
+            drawBox(boxes, code, name, px(x), py(y), 'layout-box layout-spouse');
+        });
+
+        container.innerHTML = '';
+        container.appendChild(svg);
+    }
+
+    button.addEventListener('click', async () => {
+        button.disabled = true;
+        container.style.display = '';
+        container.innerHTML = '<p class="text-muted">جاري التحميل...</p>';
+        try {
+            const response = await fetch(`/family/api/tree-layout/${encodeURIComponent(container.dataset.root)}`, {
+                headers: { 'Accept': 'application/json' }
+            });
+            if (!response.ok) throw new Error(`HTTP ${response.status}`);
+            render(await response.json());
+        } catch (err) {
+            container.innerHTML = '<p class="text-muted">تعذر تحميل الشجرة.</p>';
+            console.error('خطأ في تحميل تخطيط الشجرة:', err);
+        } finally {
+            button.disabled = false;
+        }
+    });
+});
@@ -0,0 +1,106 @@
+/**
+ * الشجرة التفاعلية - تحميل كسول مستوى بمستوى من /family/api/tree/{code}
+ * يعتمد على ETag الذي يرسله الخادم: المتصفح يعيد التحقق ويستقبل 304 إذا لم يتغير الفرع.
+ */
+document.addEventListener('DOMContentLoaded', () => {
+    const container = document.getElementById('lazyTree');
+    if (!container) return;
+
+    async function fetchNode(code, cursor) {
+        let url = `/family/api/tree/${encodeURIComponent(code)}`;
+        if (cursor) url += `?cursor=${encodeURIComponent(cursor)}`;
+        const response = await fetch(url, { headers: { 'Accept': 'application/json' } });
+        if (!response.ok) throw new Error(`HTTP ${response.status}`);
+        return response.json();
+    }
+
+    function memberLink(member) {
+        const link = document.createElement('a');
+        link.href = `/family/details/${encodeURIComponent(member.code)}`;
+        link.className = 'relation-link';
+        link.textContent = member.name || member.code;
+        link.title = member.full_name || '';
+        return link;
+    }
+
+    function renderNode(member, spouses) {
+        const li = document.createElement('li');
+        const row = document.createElement('div');
+        row.className = 'tree-node';
+
+        const toggle = document.createElement('button');
+        toggle.type = 'button';
+        toggle.className = 'tree-toggle';
+        toggle.textContent = member.has_children ? '+' : '·';
+        toggle.disabled = !member.has_children;
+
+        row.appendChild(toggle);
+        row.appendChild(memberLink(member));
+
+        if (spouses && spouses.length) {
+            const spouseSpan = document.createElement('span');
+            spouseSpan.className = 'tree-spouses';
+            spouseSpan.textContent = '— ' + spouses.map(s => s.name).join('، ');
+            row.appendChild(spouseSpan);
+        }
+        li.appendChild(row);
+
+        let childrenList = null;
+        toggle.addEventListener('click', async () => {
+            if (childrenList) {
+                const hidden = childrenList.style.display === 'none';
+                childrenList.style.display = hidden ? '' : 'none';
+                toggle.textContent = hidden ? '−' : '+';
+                return;
+            }
+            toggle.disabled = true;
+            try {
+                childrenList = document.createElement('ul');
+                li.appendChild(childrenList);
+                await loadChildren(member.code, childrenList, null);
+                toggle.textContent = '−';
+            } catch (err) {
+                console.error('خطأ في تحميل الأبناء:', err);
+            } finally {
+                toggle.disabled = false;
+            }
+        });
+
+        return li;
+    }
+
+    async function loadChildren(code, list, cursor) {
+        const data = await fetchNode(code, cursor);
+        for (const child of data.children) {
+            list.appendChild(renderNode(child, null));
+        }
+        if (data.next_cursor) {
+            const moreItem = document.createElement('li');
+            const moreBtn = document.createElement('button');
+            moreBtn.type = 'button';
+            moreBtn.className = 'tree-more';
+            moreBtn.textContent = 'عرض المزيد من الأبناء...';
+            moreBtn.addEventListener('click', async () => {
+                moreItem.remove();
+                await loadChildren(code, list, data.next_cursor);
+            });
+            moreItem.appendChild(moreBtn);
+            list.appendChild(moreItem);
+        }
+        return data;
+    }
+
+    (async () => {
+        try {
+            const data = await fetchNode(container.dataset.root, null);
+            const rootList = document.createElement('ul');
+            const rootItem = renderNode(data.node, data.spouses);
+            rootList.appendChild(rootItem);
+            container.innerHTML = '';
+            container.appendChild(rootList);
+        } catch (err) {
+            container.innerHTML = '<p class="text-muted">تعذر تحميل الشجرة.</p>';
+            console.error('خطأ في تحميل الشجرة:', err);
+        }
+    })();
+});
@@ -42,31 +42,46 @@ function handleCounterClick(element) {
     }
 }
 
-// وظيفة مراقبة الرفع (Polling)
+// وظيفة مراقبة المعالجة والرفع (Polling) عبر واجهة الحالة الخفيفة بدل إعادة جلب الصفحة كاملة
+const STATUS_LABELS = {
+    queued: "في طابور المعالجة...",
+    processing: "جاري المعالجة والرفع..."
+};
+
 async function monitorUploads() {
-    const pendingBooks = document.querySelectorAll('.btn-pending');
+    const pendingBooks = document.querySelectorAll('.btn-pending[data-book-id]');
     if (pendingBooks.length === 0) return;
 
-    console.log("🔍 هناك كتب قيد الرفع، بدأت مراقبة الحالة...");
+    console.log("🔍 هناك كتب قيد المعالجة، بدأت مراقبة الحالة...");
+    const ids = Array.from(pendingBooks, btn => btn.dataset.bookId).join(',');
     
     const interval = setInterval(async () => {
         try {
-            const response = await fetch(window.location.href, { cache: "no-store" });
-            const html = await response.text();
-            const parser = new DOMParser();
-            const doc = parser.parseFromString(html, 'text/html');
-            
-            const stillPending = doc.querySelectorAll('.btn-pending').length;
+            const response = await fetch(`/library/api/status?ids=${ids}`, { cache: "no-store" });
+            if (!response.ok) return;
+            const data = await response.json();
+
+            let finished = false;
+            pendingBooks.forEach(btn => {
+                const info = data.books[btn.dataset.bookId];
+                // الكتاب حُذف أو انتهت معالجته (ready / error)
+                if (!info || !(info.status in STATUS_LABELS)) {
+                    finished = true;
+                    return;
+                }
+                const label = btn.querySelector('.pending-label');
+                if (label) label.textContent = STATUS_LABELS[info.status];
+            });
             
-            if (stillPending < pendingBooks.length) {
-                console.log("✅ اكتمل رفع الكتاب، جاري تحديث الصفحة...");
+            if (finished) {
+                console.log("✅ انتهت معالجة كتاب، جاري تحديث الصفحة...");
                 clearInterval(interval);
                 window.location.reload(); 
             }
         } catch (error) { 
             console.error("عذراً، فشلت محاولة مراقبة الرفع:", error);
         }
-    }, 10000); 
+    }, 5000); 
 }
 
 // تشغيل الوظائف عند اكتمال تحميل الصفحة
@@ -20,4 +20,20 @@ def normalize_arabic(text):
     # ❌ حذف: توحيد الهاء والتاء المربوطة
     # text = text.replace("ة", "ه") 
 
-    return text
\ No newline at end of file
+    return text
+
+
+def fold_arabic(text):
+    """
+    توحيد أقوى من normalize_arabic مخصص للمطابقة التقريبية فقط (وليس للعرض أو التخزين):
+    يوحّد الهمزات على الواو والياء، والتاء المربوطة، والألف المقصورة التي يخطئ فيها الأقارب كثيراً.
+    """
+    if not text:
+        return text
+
+    text = normalize_arabic(text)
+    text = text.replace("ؤ", "و").replace("ئ", "ي").replace("ء", "")
+    text = text.replace("ة", "ه").replace("ى", "ي")
+    # إزالة التطويل (ـ)
+    text = text.replace("ـ", "")
+    return text